@@ -4,37 +4,38 @@ import os.path
 import datetime
 from urllib.parse import urljoin
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.files.base import File
-from django_redis import get_redis_connection
+from django.utils.functional import cached_property
 
 from easypush.utils.log import Logger
 from easypush.utils.settings import config
 from easypush.utils.settings import DEFAULT_EASYPUSH_ALIAS
-from easypush.core.crypto import AESCipher
-from easypush.core.locker.lock import DistributedLock
-from easypush.core.request.http_client import HttpFactory
+from easypush.core.request.http_client import PooledHttpFactory, AsyncHttpFactory
 from easypush.core.request.multipart import MultiPartForm
+from easypush.core.limiter.bucket import get_rate_limiter
+from .token import AccessTokenManager
 
 
 class RequestApiBase:
     API_BASE_URL = None
     log_cls = Logger
 
-    REQUEST_CLS = HttpFactory
+    REQUEST_CLS = PooledHttpFactory
+    ASYNC_REQUEST_CLS = AsyncHttpFactory
     MULTIPART_FORM_CLS = MultiPartForm
 
     def __init__(self, *args, **kwargs):
         self._logger = None
         self._log_path = config.log_path
 
-    def _request(self, method, endpoint, **kwargs):
+    def _prepare_request(self, endpoint, **kwargs):
         api_base_url = self.API_BASE_URL or self._api_base_url
 
         if not api_base_url:
             raise ValueError("One Push Client `API_BASE_URL` not allowed empty.")
 
-        req_func = self._get if method == "GET" else self._post
         base_url = endpoint.replace(".", "/")
         url = urljoin(api_base_url, base_url)
 
@@ -63,14 +64,43 @@ class RequestApiBase:
             headers['Content-Type'] = 'application/json'  # default header
 
         kwargs["headers"] = headers
+        return url, kwargs
+
+    @property
+    def rate_limiter(self):
+        """ Limiter of the client owning this api, see `ClientMixin.rate_limiter` """
+        return getattr(getattr(self, "_client", None), "rate_limiter", None)
+
+    def _request(self, method, endpoint, **kwargs):
+        req_func = self._get if method == "GET" else self._post
+        url, kwargs = self._prepare_request(endpoint, **kwargs)
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
         return req_func(url, **kwargs)
 
+    async def _arequest(self, method, endpoint, **kwargs):
+        req_func = self._aget if method == "GET" else self._apost
+        url, kwargs = self._prepare_request(endpoint, **kwargs)
+
+        if self.rate_limiter is not None:
+            await self.rate_limiter.aacquire()
+
+        return await req_func(url, **kwargs)
+
     def _get(self, url, params=None, **kwargs):
         return self.REQUEST_CLS(url, params=params, **kwargs).get()
 
     def _post(self, url, params=None, data=None, **kwargs):
         return self.REQUEST_CLS(url, params=params, **kwargs).post(data=data)
 
+    async def _aget(self, url, params=None, **kwargs):
+        return await self.ASYNC_REQUEST_CLS(url, params=params, **kwargs).get()
+
+    async def _apost(self, url, params=None, data=None, **kwargs):
+        return await self.ASYNC_REQUEST_CLS(url, params=params, **kwargs).post(data=data)
+
     @property
     def logger(self):
         if self._logger is None:
@@ -134,34 +164,31 @@ class ClientMixin(RequestApiBase):
     def get_access_token(self):
         raise NotImplementedError
 
-    @property
-    def access_token(self):
-        def get_cache_token(conn, key, ths):
-            cache_token = conn.hgetall(key) or {}
-            access_token = cache_token.get("access_token")
+    @cached_property
+    def rate_limiter(self):
+        """ Shared token bucket of the app, see EASYPUSH[alias]["RATE_LIMIT"] """
+        return get_rate_limiter(self)
 
-            if access_token is not None:
-                ths.logger.info("[%s] => From redis token: %s" % (ths.__class__.__name__, cache_token))
-                return access_token
+    @cached_property
+    def token_manager(self):
+        return AccessTokenManager(client=self)
 
-        def get_token(conn, key, ths):
-            token = ths.get_access_token()
-            ths.logger.info("[%s] => From api token ok: %s" % (ths.__class__.__name__, token))
+    @property
+    def access_token(self):
+        return self.token_manager.get_token()
 
-            conn.hmset(key, token)
-            conn.expire(key, ths.TOKEN_EXPIRE_TIME - 10 * 60)
+    def invalidate_token(self):
+        """ The platform rejected the token, the next call fetches a new one """
+        self.token_manager.invalidate()
 
-            return token["access_token"]
+    async def aaccess_token(self):
+        """ Coroutine version of `access_token`, only the redis and lock round trips run in a worker thread """
+        access_token = self.token_manager.get_cached_token()
 
-        redis_conn = get_redis_connection()
-        raw_key = "{agent_id}:{corp_id}:{app_key}:{app_secret}:{using}".format(using=self.using, **self.conf)
-        redis_key = AESCipher.crypt_md5(raw_key)
+        if access_token is not None:
+            return access_token
 
-        return DistributedLock(
-            key="%s_AccessToken_Lock_%s" % (self.using, redis_key),
-            func=get_token, func_args=(redis_conn, redis_key, self),
-            before_func=get_cache_token, before_func_args=(redis_conn, redis_key, self),
-        )
+        return await sync_to_async(lambda: self.access_token, thread_sensitive=False)()
 
     @property
     def conf(self):
@@ -0,0 +1,227 @@
+import json
+import time
+import logging
+import threading
+
+import redis
+from django_redis import get_redis_connection
+from django.utils.functional import cached_property
+
+from easypush.core.crypto import AESCipher
+from easypush.core.locker.lock import DistributedLock
+from easypush.core.locker.quorum import QuorumLock
+from easypush.utils.settings import config
+from easypush.utils.decorators import token_cache, get_token_timeout, is_cacheable_token
+
+logger = logging.getLogger("django")
+
+
+class AccessTokenManager:
+    """ Two-tier access token cache of one application
+
+    L1: process-local `token_cache` (shared with `token_expire_cache`), no network round trip.
+    L2: redis hash shared by all processes.
+
+    Concurrent misses are collapsed into one upstream `get_access_token` call: threads of a process wait
+    on a per-app lock, processes race for a redis lock and the losers are woken up by the winner, which
+    publishes the fresh token on a pub/sub channel. Once the L1 token enters its refresh-ahead window it
+    is still served while one background thread fetches the next one.
+
+    With several `lock_nodes` configured the refresh lock is a quorum lock, and when redis can not be
+    reached at all the token is fetched and kept in L1 only.
+    """
+    REDIS_EXPIRE_MARGIN = 10 * 60
+    LOCK_EXPIRE = 30
+    WAIT_TIMEOUT = 10
+
+    _refreshing = set()
+    _refreshing_lock = threading.Lock()
+
+    def __init__(self, client):
+        self.client = client
+        self.using = client.using
+        self.cache_key = client.get_access_token.get_cache_key(client)
+
+        raw_key = "{agent_id}:{corp_id}:{app_key}:{app_secret}:{using}".format(
+            agent_id=client._agent_id, corp_id=client._corp_id,
+            app_key=client._app_key, app_secret=client._app_secret, using=self.using,
+        )
+        self.redis_key = AESCipher.crypt_md5(raw_key)
+        self.lock_key = "%s_AccessToken_Lock_%s" % (self.using, self.redis_key)
+        self.channel = "%s_AccessToken_Ready_%s" % (self.using, self.redis_key)
+
+    @cached_property
+    def redis_conn(self):
+        return get_redis_connection()
+
+    @cached_property
+    def unlock_script(self):
+        return self.redis_conn.register_script(DistributedLock.UNLOCK_SCRIPT)
+
+    @cached_property
+    def quorum_lock(self):
+        lock_nodes = config.lock_nodes
+        return QuorumLock(lock_nodes) if len(lock_nodes) > 1 else None
+
+    @property
+    def timeout(self):
+        return self.client.TOKEN_EXPIRE_TIME
+
+    @property
+    def refresh_ahead(self):
+        return min(token_cache.refresh_ahead, self.timeout / 10)
+
+    def get_cached_token(self):
+        """ L1 only, None when missing or due for refresh """
+        token = token_cache.get(self.cache_key)
+        return token["access_token"] if token else None
+
+    def get_token(self):
+        token = token_cache.get(self.cache_key)
+
+        if token is None:
+            stale_token = token_cache.get(self.cache_key, stale=True)
+
+            if stale_token is not None:
+                # Refresh-ahead: keep serving the still valid token
+                self._refresh_in_background()
+                token = stale_token
+            else:
+                token = self._load()
+
+        return token["access_token"]
+
+    def invalidate(self):
+        """ Drop the token from both tiers, eg: the platform answered `access_token expired` """
+        token_cache.delete(self.cache_key)
+        self.redis_conn.delete(self.redis_key)
+
+    def _refresh_in_background(self):
+        with self._refreshing_lock:
+            if self.cache_key in self._refreshing:
+                return
+
+            self._refreshing.add(self.cache_key)
+
+        def refresh():
+            try:
+                self._load(min_ttl=self.refresh_ahead)
+            except Exception as e:
+                logger.error("[%s] => Refresh token error: %s", self.__class__.__name__, e)
+            finally:
+                with self._refreshing_lock:
+                    self._refreshing.discard(self.cache_key)
+
+        t = threading.Thread(target=refresh, name="easypush-token-refresh")
+        t.daemon = True
+        t.start()
+
+    def _set_local(self, token, timeout):
+        token_cache.set(self.cache_key, token, timeout=timeout)
+
+    def _get_from_redis(self, min_ttl=0):
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.redis_key)
+            pipe.ttl(self.redis_key)
+            cache_token, ttl = pipe.execute()
+
+        token = {self._to_text(k): self._to_text(v) for k, v in (cache_token or {}).items()}
+
+        if token.get("access_token") and ttl > min_ttl:
+            self._set_local(token, timeout=ttl)
+
+            logger.info("[%s] => From redis token: %s", self.client.__class__.__name__, token)
+            return token
+
+    def _fetch(self):
+        """ Upstream `get_access_token` bypassing the `token_expire_cache` decorator """
+        get_access_token = self.client.get_access_token
+        token = getattr(get_access_token, "__wrapped__", get_access_token.__func__)(self.client)
+        logger.info("[%s] => From api token ok: %s", self.client.__class__.__name__, token)
+
+        if not is_cacheable_token(token):
+            raise ValueError("[%s] get access token error: %s" % (self.client.__class__.__name__, token))
+
+        timeout = get_token_timeout(token, self.timeout)
+        redis_timeout = max(timeout - self.REDIS_EXPIRE_MARGIN, int(timeout / 2))
+        mapping = {k: v for k, v in token.items() if isinstance(v, (str, int, float))}
+
+        try:
+            with self.redis_conn.pipeline(transaction=False) as pipe:
+                pipe.hset(self.redis_key, mapping=mapping)
+                pipe.expire(self.redis_key, redis_timeout)
+                pipe.publish(self.channel, json.dumps(dict(mapping, ttl=redis_timeout)))
+                pipe.execute()
+        except redis.RedisError as e:
+            logger.error("[%s] => Save token to redis error: %s", self.client.__class__.__name__, e)
+
+        self._set_local(mapping, timeout=redis_timeout)
+        return mapping
+
+    def _load(self, min_ttl=0):
+        # Threads of this process: only one goes on
+        with token_cache.get_key_lock(self.cache_key):
+            if min_ttl == 0:
+                token = token_cache.get(self.cache_key)
+                if token is not None:
+                    return token
+
+            try:
+                pubsub = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)  # Subscribe before checking, no notification can be missed
+            except redis.RedisError as e:
+                logger.error("[%s] => Redis unavailable, token from api: %s", self.client.__class__.__name__, e)
+                return self._fetch()
+
+            try:
+                token = self._get_from_redis(min_ttl=min_ttl)
+                if token is not None:
+                    return token
+
+                # Processes: the one holding the redis lock calls the platform api
+                uniq_val = DistributedLock.get_unique_id()
+
+                if self._acquire_lock(uniq_val):
+                    try:
+                        return self._fetch()
+                    finally:
+                        self._release_lock(uniq_val)
+
+                return self._wait_published(pubsub) or self._get_from_redis() or self._fetch()
+            finally:
+                pubsub.close()
+
+    def _acquire_lock(self, uniq_val):
+        expire = self.LOCK_EXPIRE * 1000
+
+        if self.quorum_lock:
+            return self.quorum_lock.acquire(self.lock_key, uniq_val, expire) > 0
+
+        return self.redis_conn.set(self.lock_key, uniq_val, px=expire, nx=True)
+
+    def _release_lock(self, uniq_val):
+        if self.quorum_lock:
+            self.quorum_lock.release(self.lock_key, uniq_val)
+        else:
+            self.unlock_script(keys=[self.lock_key], args=[uniq_val])
+
+    def _wait_published(self, pubsub):
+        deadline = time.monotonic() + self.WAIT_TIMEOUT
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            message = pubsub.get_message(timeout=remaining)
+
+            if message and message.get("type") == "message":
+                token = json.loads(self._to_text(message["data"]))
+                self._set_local(token, timeout=token.pop("ttl", self.timeout))
+
+                logger.info("[%s] => From published token: %s", self.client.__class__.__name__, token)
+                return token
+
+    @staticmethod
+    def _to_text(value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
@@ -22,6 +22,7 @@ class DingBase(ClientMixin):
     CLIENT_NAME = "ding_talk"
     TOKEN_EXPIRE_TIME = 2 * 60 * 60
     MEDIA_EXPIRE_TIME = 10 * 365 * 24 * 60 * 60
+    API_BASE_URL = "https://oapi.dingtalk.com/"
 
     def __init__(self, msg_type=None, **kwargs):
         super().__init__(**kwargs)
@@ -79,16 +80,7 @@ class DingTalkClient(DingBase, DingMessageBodyParser):
 
         return result
 
-    def send(self, msgtype, body_kwargs, userid_list=(),
-                   dept_id_list=(), to_all_user=False, result_processor=None):
-        """ 企业会话消息异步发送
-        :param msgtype: 消息类型
-        :param body_kwargs: dict, 不同消息体对应的参数
-        :param userid_list: list|tuple, 接收者的用户userid列表
-        :param dept_id_list: list|tuple, 接收者的部门id列表
-        :param to_all_user: bool, 是否发送给企业全部用户
-        :param result_processor, callable, 结果处理器
-        """
+    def _get_send_params(self, msgtype, body_kwargs, userid_list=(), dept_id_list=(), to_all_user=False):
         if not isinstance(userid_list, (typing.Tuple, typing.List)):
             raise ValueError("parameter `user_id_list` must is list|tuple")
 
@@ -97,26 +89,54 @@ class DingTalkClient(DingBase, DingMessageBodyParser):
 
         self._msg_type = msgtype
         message_body = self.get_message_body(**body_kwargs)
-
         assert isinstance(message_body, BodyBase), "Parameter `msg_body` must is a instance of BodyBase"
-        assert result_processor is None or callable(result_processor), "result_processor must be callable or None"
 
         userid_list = ",".join(map(to_text, userid_list))
         dept_id_list = ",".join(map(to_text, dept_id_list))
 
-        params = optionaldict(dict(
+        return optionaldict(dict(
             msg=message_body.get_dict(), agent_id=self._agent_id,
             userid_list=userid_list or None, dept_id_list=dept_id_list or None,
             to_all_user='true' if to_all_user else 'false'
         ))
 
+    def send(self, msgtype, body_kwargs, userid_list=(),
+                   dept_id_list=(), to_all_user=False, result_processor=None):
+        """ 企业会话消息异步发送
+        :param msgtype: 消息类型
+        :param body_kwargs: dict, 不同消息体对应的参数
+        :param userid_list: list|tuple, 接收者的用户userid列表
+        :param dept_id_list: list|tuple, 接收者的部门id列表
+        :param to_all_user: bool, 是否发送给企业全部用户
+        :param result_processor, callable, 结果处理器
+        """
+        assert result_processor is None or callable(result_processor), "result_processor must be callable or None"
+        params = self._get_send_params(msgtype, body_kwargs, userid_list, dept_id_list, to_all_user)
+
         # Set result_processor
         method = 'dingtalk.oapi.message.corpconversation.asyncsend_v2'
+
+        # The dingtalk-sdk does not go through `_request`
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
         result = self._message._top_request(method, params=params, result_processor=result_processor)
 
         response_key = method.replace('.', '_') + "_response"
         return result.get(response_key, result)
 
+    async def asend(self, msgtype, body_kwargs, userid_list=(), dept_id_list=(), to_all_user=False):
+        """ Coroutine version of `send`, posts to `topapi/message/corpconversation/asyncsend_v2` directly
+        because the dingtalk-sdk client is blocking.
+        """
+        params = self._get_send_params(msgtype, body_kwargs, userid_list, dept_id_list, to_all_user)
+        access_token = await self.aaccess_token()
+
+        return await self._arequest(
+            method="POST", endpoint="topapi.message.corpconversation.asyncsend_v2",
+            params=dict(access_token=access_token), data=dict(params),
+        )
+
     def recall(self, task_id):
         """ 撤回工作通知消息
         :param task_id: 发送工作通知返回的 taskId
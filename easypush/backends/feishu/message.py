@@ -20,14 +20,25 @@ class FeishuMessage(RequestApiBase):
             "Content-Type": "application/json; charset=utf-8",
         }
 
-    def send(self, payload, receive_id):
+    def _get_payload(self, payload, receive_id):
         new_payload = payload[self._client.msgtype]
         new_payload["msg_type"] = new_payload.pop("msgtype")
         new_payload.update(receive_id=receive_id, uuid=str(uuid.uuid1()))
 
+        return new_payload
+
+    def send(self, payload, receive_id):
         return self._request(
             method="POST",
             endpoint="im.v1.messages",
             headers=self._headers, ignore_error=True,
-            params=dict(receive_id_type="open_id"), data=new_payload,
+            params=dict(receive_id_type="open_id"), data=self._get_payload(payload, receive_id),
+        )
+
+    async def asend(self, payload, receive_id):
+        return await self._arequest(
+            method="POST",
+            endpoint="im.v1.messages",
+            headers=self._headers, ignore_error=True,
+            params=dict(receive_id_type="open_id"), data=self._get_payload(payload, receive_id),
         )
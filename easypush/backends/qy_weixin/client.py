@@ -47,6 +47,16 @@ class QyWeixinClient(QyWeixinBase, QyWXMessageBodyParser):
         self._check_media_exist(filename, media_file)
         return self._message.media_upload(media_type, filename, media_file)
 
+    def _get_message_body(self, msgtype, body_kwargs, userid_list=()):
+        if not isinstance(userid_list, (typing.Tuple, typing.List)):
+            raise ValueError("parameter `user_id_list` must is list|tuple")
+
+        self._msg_type = msgtype
+        message_body = self.get_message_body(**body_kwargs)
+        assert isinstance(message_body, MsgBodyBase), "Parameter `msg_body` must is a instance of MsgBodyBase"
+
+        return message_body
+
     def send(self, msgtype, body_kwargs, userid_list=(), dept_id_list=(), to_all_user=False):
         """ 企业会话消息异步发送
         :param msgtype: 消息类型
@@ -55,12 +65,7 @@ class QyWeixinClient(QyWeixinBase, QyWXMessageBodyParser):
         :param dept_id_list: list|tuple, 接收者的部门id列表
         :param to_all_user: bool, 暂未使用
         """
-        if not isinstance(userid_list, (typing.Tuple, typing.List)):
-            raise ValueError("parameter `user_id_list` must is list|tuple")
-
-        self._msg_type = msgtype
-        message_body = self.get_message_body(**body_kwargs)
-        assert isinstance(message_body, MsgBodyBase), "Parameter `msg_body` must is a instance of MsgBodyBase"
+        message_body = self._get_message_body(msgtype, body_kwargs, userid_list)
 
         return self._message.send_message(
             message_body,
@@ -68,6 +73,16 @@ class QyWeixinClient(QyWeixinBase, QyWXMessageBodyParser):
             toparty=dept_id_list, totag=()
         )
 
+    async def asend(self, msgtype, body_kwargs, userid_list=(), dept_id_list=(), to_all_user=False):
+        """ Coroutine version of `send` """
+        message_body = self._get_message_body(msgtype, body_kwargs, userid_list)
+
+        return await self._message.asend_message(
+            message_body,
+            agent_id=self._agent_id, touser=userid_list,
+            toparty=dept_id_list, totag=()
+        )
+
     def recall(self, task_id):
         return self._message.recall(msgid=task_id)
 
@@ -53,13 +53,7 @@ class QyMessage(RequestApiBase):
     def send_to_conversation(self, sender, cid, msg_body):
         """ 发送普通消息 """
 
-    def send_message(self, msg_body, agent_id, touser=(), toparty=(), totag=()):
-        """ 应用支持推送文本、图片、视频、文件、图文等类型
-        @:param msg_body:
-        @:param touser: 成员ID列表（消息接收者，多个接收者用‘|’分隔，最多支持1000个）
-        @:param toparty: 部门ID列表，多个接收者用‘|’分隔，最多支持100个
-        @:param totag: 标签ID列表，多个接收者用‘|’分隔，最多支持100个
-        """
+    def _get_message_payload(self, msg_body, agent_id, touser=(), toparty=(), totag=()):
         if isinstance(touser, (list, tuple)):
             touser = "|".join(map(to_text, touser))
 
@@ -75,11 +69,32 @@ class QyMessage(RequestApiBase):
         new_msg_body = msg_body[self._client.msgtype]
         new_msg_body.update(agentid=agent_id, touser=touser, toparty=toparty, totag=totag)
 
+        return new_msg_body
+
+    def send_message(self, msg_body, agent_id, touser=(), toparty=(), totag=()):
+        """ 应用支持推送文本、图片、视频、文件、图文等类型
+        @:param msg_body:
+        @:param touser: 成员ID列表（消息接收者，多个接收者用‘|’分隔，最多支持1000个）
+        @:param toparty: 部门ID列表，多个接收者用‘|’分隔，最多支持100个
+        @:param totag: 标签ID列表，多个接收者用‘|’分隔，最多支持100个
+        """
+        new_msg_body = self._get_message_payload(msg_body, agent_id, touser, toparty, totag)
+
         return self._request(
             method="POST", endpoint="message.send",
             params=dict(access_token=self._client.access_token), data=new_msg_body,
         )
 
+    async def asend_message(self, msg_body, agent_id, touser=(), toparty=(), totag=()):
+        """ Coroutine version of `send_message` """
+        new_msg_body = self._get_message_payload(msg_body, agent_id, touser, toparty, totag)
+        access_token = await self._client.aaccess_token()
+
+        return await self._arequest(
+            method="POST", endpoint="message.send",
+            params=dict(access_token=access_token), data=new_msg_body,
+        )
+
     def get_send_progress(self, agent_id, task_id):
         pass
 
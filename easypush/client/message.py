@@ -113,7 +113,8 @@ class AppMessageHandler(MessageBase):
         else:
             return self._client.upload_media(media_type, filename=filename, media_file=media_file)
 
-    def async_send(self, msgtype, body_kwargs, userid_list=(), dept_id_list=(), async_mode=False):
+    def async_send(self, msgtype, body_kwargs, userid_list=(), dept_id_list=(), async_mode=False, priority=None):
+        """ :param priority: str, lane of the mq task when sent asynchronously, see `MessagePriorityEnum` """
         async_mode = async_mode or self.async_mode
 
         if async_mode:
@@ -123,7 +124,7 @@ class AppMessageHandler(MessageBase):
 
             data = dict(
                 app_token=app_obj.app_token, msg_type=msgtype, receiver_mobile="",
-                msg_body_json=body_kwargs, receiver_userid=",".join(userid_list),
+                msg_body_json=body_kwargs, receiver_userid=",".join(userid_list), priority=priority,
             )
             serializers.AppMsgPushRecordSerializer.async_send_mq(
                 data=data,  task_fun=tasks.send_message_by_mq
@@ -136,6 +137,14 @@ class AppMessageHandler(MessageBase):
         )
         return self._get_result(data=result)
 
+    async def asend(self, msgtype, body_kwargs, userid_list=(), dept_id_list=()):
+        """ Coroutine version of `async_send(async_mode=False)`, sends directly to the platform """
+        result = await self._client.asend(
+            msgtype=msgtype, body_kwargs=body_kwargs,
+            userid_list=userid_list, dept_id_list=dept_id_list
+        )
+        return self._get_result(data=result)
+
     def recall(self, task_id):
         return self._client.recall(task_id=task_id)
 
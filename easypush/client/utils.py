@@ -1,29 +1,48 @@
+import threading
+
 from . import AppMessageHandler
 from easypush.core.crypto import AESCipher
 from easypush.models import AppTokenPlatformModel
 
 push_backend_mapping = {}
+push_send_lock_mapping = {}
+_push_backend_lock = threading.Lock()
 
 
 def get_push_backend(app_id=None, instance=None):
     assert app_id is not None or instance is not None, "Not exist app object."
 
-    global push_backend_mapping
-
     if app_id:
         instance = AppTokenPlatformModel.objects.get(id=app_id)
 
-    app_token = instance.app_token
-    app_md5 = AESCipher.crypt_md5(app_token)
+    app_md5 = AESCipher.crypt_md5(instance.app_token)
+    push = push_backend_mapping.get(app_md5)
+
+    if push is None:
+        with _push_backend_lock:
+            push = push_backend_mapping.get(app_md5)
 
-    if app_md5 in push_backend_mapping:
-        return push_backend_mapping[app_md5]
+            if push is None:
+                push = AppMessageHandler(
+                    backend=instance.platform_type,
+                    corp_id=instance.corp_id, agent_id=instance.agent_id,
+                    app_key=instance.app_key, app_secret=instance.app_secret,
+                )
+                push_backend_mapping[app_md5] = push
 
-    push = AppMessageHandler(
-        backend=instance.platform_type,
-        corp_id=instance.corp_id, agent_id=instance.agent_id,
-        app_key=instance.app_key, app_secret=instance.app_secret,
-    )
-    push_backend_mapping[app_md5] = push
     return push
 
+
+def get_push_send_lock(instance):
+    """ One lock per app: the cached backend client keeps the message type of the send in progress
+        (`_msg_type`, read back by the parser and the message builder), so the sends of one app
+        from several threads must not interleave.
+    """
+    app_md5 = AESCipher.crypt_md5(instance.app_token)
+    lock = push_send_lock_mapping.get(app_md5)
+
+    if lock is None:
+        with _push_backend_lock:
+            lock = push_send_lock_mapping.setdefault(app_md5, threading.Lock())
+
+    return lock
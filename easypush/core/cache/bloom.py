@@ -0,0 +1,168 @@
+import math
+import hashlib
+import logging
+from itertools import islice
+from datetime import datetime, timedelta
+
+from django_redis import get_redis_connection
+from django.utils.functional import cached_property
+
+from easypush.utils.settings import config, DEFAULTS
+
+logger = logging.getLogger("django")
+
+
+class BloomFilter:
+    """ Bloom filter sizing and hashing, the bits live in redis bitmaps
+
+        m = -n * ln(p) / ln(2)^2 bits and k = m / n * ln(2) hashes for `capacity` n and `error_rate` p,
+        eg: n=1,000,000 p=0.001 => 1.8MB, k=10. Positions are derived by double hashing on md5.
+    """
+    MAX_BITS = 2 ** 32  # Max length of a redis string
+
+    def __init__(self, capacity, error_rate):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be in (0, 1)")
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+
+        if self.num_bits > self.MAX_BITS:
+            raise ValueError("Bloom filter of %s bits exceeds a redis bitmap" % self.num_bits)
+
+    def get_offsets(self, item):
+        digest = hashlib.md5(item.encode("utf-8") if isinstance(item, str) else item).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+
+class TimeBucketedBloomFilter:
+    """ One bloom filter(redis bitmap) per `bucket_days`, membership is checked over the last `days`
+
+        Items are added to the bucket of their send time, old buckets simply expire, so the filter covers a
+        sliding window without ever deleting bits. Checks run in a Lua script, one call per chunk of items,
+        returning at the first unset bit of each bucket. The false positive rate of the window is about
+        `error_rate * days / bucket_days`.
+    """
+    CHECK_SCRIPT = """
+        local k = tonumber(ARGV[1])
+        local result = {}
+        local index = 2
+
+        for item = 1, (#ARGV - 1) / k do
+            local found = 0
+
+            for _, key in ipairs(KEYS) do
+                local hit = 1
+                for i = 0, k - 1 do
+                    if redis.call("GETBIT", key, ARGV[index + i]) == 0 then
+                        hit = 0
+                        break
+                    end
+                end
+
+                if hit == 1 then
+                    found = 1
+                    break
+                end
+            end
+
+            result[item] = found
+            index = index + k
+        end
+
+        return result
+    """
+
+    def __init__(self, name, capacity=None, error_rate=None, days=None, bucket_days=None,
+                 chunk_size=None, redis_conn=None):
+        """
+        :param name: str, key prefix of the buckets
+        :param capacity: int, expected items per bucket
+        :param error_rate: float, false positive rate of one bucket
+        :param days: int, window of the membership check
+        :param bucket_days: int, days covered by one bucket
+        """
+        options = dict(DEFAULTS["fingerprint_bloom"], **config.fingerprint_bloom)
+
+        self.name = name
+        self.days = days or options["days"]
+        self.bucket_days = bucket_days or options["bucket_days"]
+        self.chunk_size = chunk_size or config.fingerprint_chunk_size
+        self.bloom = BloomFilter(capacity or options["capacity"], error_rate or options["error_rate"])
+
+        self._redis_conn = redis_conn
+
+    @cached_property
+    def redis_conn(self):
+        return self._redis_conn or get_redis_connection()
+
+    @cached_property
+    def check_script(self):
+        return self.redis_conn.register_script(self.CHECK_SCRIPT)
+
+    def get_bucket_key(self, when):
+        bucket = (when.date() - datetime(1970, 1, 1).date()).days // self.bucket_days
+        return "%s:bloom:%s" % (self.name, bucket)
+
+    def get_window_keys(self, now=None):
+        now = now or datetime.now()
+        bucket_cnt = int(math.ceil(self.days / self.bucket_days)) + 1
+        keys = [self.get_bucket_key(now - timedelta(days=i * self.bucket_days)) for i in range(bucket_cnt)]
+
+        return list(dict.fromkeys(keys))
+
+    def _chunks(self, items):
+        iterator = iter(items)
+
+        while True:
+            chunk = list(islice(iterator, self.chunk_size))
+            if not chunk:
+                return
+
+            yield chunk
+
+    def add_many(self, items, when=None):
+        """ Add items sent at `when`(default now) """
+        when = when or datetime.now()
+        key = self.get_bucket_key(when)
+        expire_at = when + timedelta(days=self.days + self.bucket_days)
+
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for chunk in self._chunks(items):
+                for item in chunk:
+                    for offset in self.bloom.get_offsets(item):
+                        pipe.setbit(key, offset, 1)
+
+                pipe.expireat(key, expire_at)
+                pipe.execute()
+
+    def add(self, item, when=None):
+        self.add_many([item], when=when)
+
+    def contains_many(self, items, now=None):
+        """ :return: list of bool, False means surely never added in the window """
+        result = []
+        keys = self.get_window_keys(now)
+
+        for chunk in self._chunks(items):
+            args = [self.bloom.num_hashes]
+            for item in chunk:
+                args.extend(self.bloom.get_offsets(item))
+
+            result.extend(bool(found) for found in self.check_script(keys=keys, args=args))
+
+        return result
+
+    def __contains__(self, item):
+        return self.contains_many([item])[0]
+
+
+def get_log_fingerprint_filter():
+    """ Dedup index of `APP_LOG_FINGERPRINT_KEY` """
+    return TimeBucketedBloomFilter(name="easypush:log_fingerprint")
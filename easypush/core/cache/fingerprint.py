@@ -0,0 +1,130 @@
+import time
+import logging
+from itertools import islice
+
+from django_redis import get_redis_connection
+from django.utils.functional import cached_property
+
+from easypush.utils.settings import config
+
+logger = logging.getLogger("django")
+
+
+class FingerprintStore:
+    """ Message and log fingerprints in redis, `key: id` with a TTL
+
+        Keys are written with `SET key value EX timeout` in pipelines of `chunk_size` commands, so a big
+        batch never turns into one long blocking EVAL and the memory of a pipeline stays bounded.
+    """
+    DEFAULT_EXPIRE = 7 * 60 * 60
+
+    def __init__(self, redis_conn=None, chunk_size=None, timeout=None):
+        """
+        :param redis_conn: redis client, default `get_redis_connection()`
+        :param chunk_size: int, commands per pipeline, default EASYPUSH["fingerprint_chunk_size"]
+        :param timeout: int, expire time(seconds) of the keys
+        """
+        self._redis_conn = redis_conn
+        self.chunk_size = chunk_size or config.fingerprint_chunk_size
+        self.timeout = timeout or self.DEFAULT_EXPIRE
+
+    @cached_property
+    def redis_conn(self):
+        return self._redis_conn or get_redis_connection()
+
+    def _chunks(self, iterable):
+        iterator = iter(iterable)
+
+        while True:
+            chunk = list(islice(iterator, self.chunk_size))
+            if not chunk:
+                return
+
+            yield chunk
+
+    def set_many(self, mapping, timeout=None):
+        """ :return: int, count of keys written """
+        total_cnt = 0
+        timeout = timeout or self.timeout
+
+        with self.redis_conn.pipeline(transaction=False) as pipe:
+            for chunk in self._chunks(mapping.items()):
+                for key, value in chunk:
+                    pipe.set(key, value, ex=timeout)
+
+                pipe.execute()
+                total_cnt += len(chunk)
+
+        return total_cnt
+
+    def get_many(self, keys):
+        """ :return: list, values in the order of `keys`, None when missing """
+        values = []
+
+        for chunk in self._chunks(keys):
+            values.extend(self.redis_conn.mget(chunk))
+
+        return values
+
+
+def set_many_by_lua(redis_conn, mapping, timeout):
+    """ The former way: MSET, then one EVAL looping EXPIRE over all the keys """
+    expire_lua = """
+        for i=1, ARGV[1], 1 do
+            redis.call("EXPIRE", KEYS[i], ARGV[2]);
+        end
+    """
+    cmd = redis_conn.register_script(expire_lua)
+    redis_conn.mset(mapping)
+    cmd(keys=list(mapping.keys()), args=[len(mapping), timeout])
+
+
+def delete_by_prefix(redis_conn, prefix, chunk_size=1000):
+    """ UNLINK the keys starting with `prefix`, scanned by SCAN MATCH, :return: int, count of keys deleted """
+    deleted_cnt = 0
+    keys = []
+
+    for key in redis_conn.scan_iter(match=prefix + "*", count=chunk_size):
+        keys.append(key)
+
+        if len(keys) >= chunk_size:
+            deleted_cnt += redis_conn.unlink(*keys)
+            keys = []
+
+    if keys:
+        deleted_cnt += redis_conn.unlink(*keys)
+
+    return deleted_cnt
+
+
+def test_by_pipeline_vs_lua(redis_url="redis://127.0.0.1:6379/15", sizes=(10000, 100000, 1000000), chunk_size=1000):
+    """ Compare the chunked pipeline writer with MSET + Lua EXPIRE loop on `redis_url`
+        Keys are written under a prefix unique to the run and only those keys are deleted afterwards.
+
+        python -c "import django; django.setup(); \
+            from easypush.core.cache.fingerprint import test_by_pipeline_vs_lua; test_by_pipeline_vs_lua()"
+    """
+    import uuid
+    import redis
+
+    redis_conn = redis.Redis.from_url(redis_url)
+    store = FingerprintStore(redis_conn=redis_conn, chunk_size=chunk_size)
+    prefix = "easypush:bench:%s:" % uuid.uuid4().hex
+
+    try:
+        for size in sizes:
+            mapping = {prefix + "app_id:1:msg_fingerprint:%032x:userid:%s" % (i, i): i for i in range(size)}
+
+            for name, func in [
+                ("mset+lua", lambda: set_many_by_lua(redis_conn, mapping, store.timeout)),
+                ("pipeline", lambda: store.set_many(mapping)),
+            ]:
+                delete_by_prefix(redis_conn, prefix, chunk_size)
+
+                start_time = time.time()
+                func()
+                cost_time = time.time() - start_time
+
+                print("%-8s keys: %-8s cost: %.4fs, qps: %.2fw" % (name, size, cost_time, size / cost_time / 10000.0))
+    finally:
+        delete_by_prefix(redis_conn, prefix, chunk_size)
@@ -1,6 +1,7 @@
 import datetime
 
-from django.db import models
+from django.db import models, transaction, DatabaseError
+from django.db.models import Case, When, Value, F
 from django.utils import timezone
 
 from django.db.models.base import ModelBase
@@ -96,6 +97,85 @@ class BaseAbstractModel(models.Model):
 
         return obj
 
+    @classmethod
+    def bulk_create_objects(cls, kwargs_list, lookup_fields=(), batch_size=None):
+        """ 批量创建对象(一条 INSERT), 数据库不支持返回主键时(eg: MySQL)通过 lookup_fields 一次回查主键
+        :param kwargs_list: list, 每个对象的字段
+        :param lookup_fields: tuple, 有索引且能唯一确定新对象的字段, 相同字段取最新(id最大)的记录
+        :raise DatabaseError: 仍有对象回查不到主键
+        """
+        obj_list = [cls.create_object(force_insert=False, **kwargs) for kwargs in kwargs_list]
+
+        if not obj_list:
+            return obj_list
+
+        obj_list = cls.objects.bulk_create(obj_list, batch_size=batch_size)
+        missing_pk_objs = [obj for obj in obj_list if obj.pk is None]
+
+        if missing_pk_objs and lookup_fields:
+            query = {"%s__in" % name: {getattr(obj, name) for obj in missing_pk_objs} for name in lookup_fields}
+            queryset = cls.objects.filter(**query).order_by("id").values_list("id", *lookup_fields)
+            pk_mapping = {tuple(row[1:]): row[0] for row in queryset}
+
+            for obj in missing_pk_objs:
+                obj.pk = pk_mapping.get(tuple(getattr(obj, name) for name in lookup_fields))
+
+        unsaved_cnt = sum(1 for obj in obj_list if obj.pk is None)
+        if unsaved_cnt:
+            raise DatabaseError("%s: primary key of %s/%s objects not found by %s" % (
+                cls.__name__, unsaved_cnt, len(obj_list), lookup_fields))
+
+        return obj_list
+
+    @classmethod
+    def bulk_update_values(cls, key_field, values_mapping, batch_size=None):
+        """ 按 key_field 批量更新不同的值, 一条 UPDATE ... SET field = CASE WHEN ... END WHERE key IN (...)
+            相同的值合并为一个 WHEN key IN (...), 数据库执行失败时(eg: 参数个数超限)退回 bulk_update
+
+        :param key_field: str, 唯一字段, eg: msg_uid
+        :param values_mapping: dict, {key: {field: value}}, 行内缺少的字段保持原值
+        :param batch_size: int, bulk_update 每批的对象数
+        :return: int, 更新的行数
+        """
+        if not values_mapping:
+            return 0
+
+        keys = list(values_mapping)
+        field_names = list(dict.fromkeys(name for values in values_mapping.values() for name in values))
+        update_kwargs = {}
+
+        for name in field_names:
+            output_field = cls._meta.get_field(name)
+            value_keys = {}  # value: [key, ...]
+
+            for key, values in values_mapping.items():
+                if name in values:
+                    value_keys.setdefault(values[name], []).append(key)
+
+            if len(value_keys) == 1 and len(next(iter(value_keys.values()))) == len(keys):
+                update_kwargs[name] = next(iter(value_keys))
+                continue
+
+            whens = [
+                When(**{"%s__in" % key_field: value_key_list}, then=Value(value, output_field=output_field))
+                for value, value_key_list in value_keys.items()
+            ]
+            update_kwargs[name] = Case(*whens, default=F(name), output_field=output_field)
+
+        queryset = cls.objects.filter(**{"%s__in" % key_field: keys})
+
+        try:
+            with transaction.atomic(using=queryset.db):
+                return queryset.update(**update_kwargs)
+        except DatabaseError:
+            obj_list = list(queryset.only("id", key_field, *field_names))
+
+            for obj in obj_list:
+                for name, value in values_mapping[getattr(obj, key_field)].items():
+                    setattr(obj, name, value)
+
+            return cls.objects.bulk_update(obj_list, field_names, batch_size=batch_size or 500)
+
     @classmethod
     def deprecated_fields(cls):
         return [_field.name for _field in BaseAbstractModel._meta.fields]
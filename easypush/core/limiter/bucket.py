@@ -0,0 +1,214 @@
+import time
+import asyncio
+import logging
+import threading
+
+import redis
+from asgiref.sync import sync_to_async
+from django_redis import get_redis_connection
+from django.utils.functional import cached_property
+
+from .local import LocalRateLimiter
+from easypush.utils.settings import config
+
+logger = logging.getLogger("django")
+
+
+class RedisRateLimiter:
+    """ Token bucket shared by all the workers, the bucket lives in a redis hash
+
+        Every process takes up to `prefetch` permits per round trip and spends them locally, a permit not
+        spent in `PREFETCH_TTL` seconds is dropped rather than hoarded, so the global rate stays just under
+        `rate` instead of bursting and backing off. The bucket is refilled with the redis clock.
+        When redis is unavailable the process falls back to a local bucket of the same rate.
+    """
+    KEY_PREFIX = "easypush:ratelimit:"
+    PREFETCH_TTL = 1.0
+
+    TAKE_SCRIPT = """
+        -- Writes after TIME, needed before redis 5
+        if redis.replicate_commands then
+            redis.replicate_commands()
+        end
+
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local requested = tonumber(ARGV[3])
+
+        local now = redis.call("TIME")
+        now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+
+        local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+        local tokens = tonumber(bucket[1]) or burst
+        local ts = tonumber(bucket[2]) or now
+
+        tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+        local granted = math.min(requested, math.floor(tokens))
+        tokens = tokens - granted
+
+        redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", now)
+        redis.call("PEXPIRE", KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+
+        local wait = 0
+        if granted == 0 then
+            wait = math.ceil((1 - tokens) * 1000 / rate)
+        end
+
+        return {granted, wait}
+    """
+
+    def __init__(self, name, rate, burst=None, prefetch=1, redis_conn=None):
+        """
+        :param name: str, bucket name, eg: qy_weixin:corp_id:agent_id
+        :param rate: float, permits per second of all the workers
+        :param burst: int, bucket size, default `rate`
+        :param prefetch: int, permits taken per redis round trip
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.key = self.KEY_PREFIX + name
+        self.rate = float(rate)
+        self.burst = int(burst or max(1, rate))
+        self.prefetch = max(1, min(int(prefetch), self.burst))
+
+        self._redis_conn = redis_conn
+        self._permits = 0
+        self._permits_deadline = 0
+        self._lock = threading.Lock()
+        self._fallback = LocalRateLimiter(rate, burst=self.burst)
+
+    @cached_property
+    def redis_conn(self):
+        return self._redis_conn or get_redis_connection()
+
+    @cached_property
+    def take_script(self):
+        return self.redis_conn.register_script(self.TAKE_SCRIPT)
+
+    def _take_local(self):
+        with self._lock:
+            if self._permits > 0 and time.monotonic() < self._permits_deadline:
+                self._permits -= 1
+                return True
+
+            self._permits = 0
+            return False
+
+    def try_acquire(self):
+        """ :return: float, 0 if acquired else seconds to wait for a permit """
+        if self._take_local():
+            return 0
+
+        try:
+            granted, wait_ms = self.take_script(keys=[self.key], args=[self.rate, self.burst, self.prefetch])
+        except redis.RedisError as e:
+            logger.warning("[%s] => Bucket<%s> redis error: %s, limited locally", self.__class__.__name__, self.key, e)
+            return self._fallback.try_acquire()
+
+        if not granted:
+            return wait_ms / 1000.0
+
+        with self._lock:
+            self._permits += int(granted) - 1
+            self._permits_deadline = time.monotonic() + self.PREFETCH_TTL
+
+        return 0
+
+    def acquire(self, timeout=None):
+        """ :return: bool, False when no permit in `timeout` seconds """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            wait_time = self.try_acquire()
+            if not wait_time:
+                return True
+
+            if deadline is not None and time.monotonic() + wait_time > deadline:
+                return False
+
+            time.sleep(wait_time)
+
+    async def aacquire(self, timeout=None):
+        """ Coroutine version of `acquire`, only the redis round trip runs in a worker thread """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            if self._take_local():
+                return True
+
+            wait_time = await sync_to_async(self.try_acquire, thread_sensitive=False)()
+            if not wait_time:
+                return True
+
+            if deadline is not None and time.monotonic() + wait_time > deadline:
+                return False
+
+            await asyncio.sleep(wait_time)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limit_options(client):
+    """ RATE_LIMIT of the app of `client`, looked up in order:
+        1) the alias `client.using`
+        2) the alias of the same platform, corp and agent: a client built from a database app
+           (see `get_push_backend`) uses the platform as `using`, eg: qy_weixin
+        3) the platform default of EASYPUSH["rate_limits"]
+    """
+    alias_conf = config.attrs.get(client.using)
+
+    if not isinstance(alias_conf, dict) or not alias_conf.get("RATE_LIMIT"):
+        alias_conf = None
+
+        for conf in config.attrs.values():
+            if not isinstance(conf, dict) or not conf.get("BACKEND") or not conf.get("CORP_ID"):
+                continue
+
+            if conf["BACKEND"].rsplit(".", 2)[-2] != client.client_name:
+                continue
+
+            if str(conf["CORP_ID"]) == str(client._corp_id) and str(conf.get("AGENT_ID")) == str(client._agent_id):
+                alias_conf = conf
+                break
+
+    options = alias_conf and alias_conf.get("RATE_LIMIT")
+    return options or config.rate_limits.get(client.client_name)
+
+
+def get_rate_limiter(client):
+    """ Limiter of the app(corp and agent) of `client`, None when no RATE_LIMIT applies
+
+    Example::
+        EASYPUSH = {
+            "qy_weixin": {
+                "BACKEND": "easypush.backends.qy_weixin.QyWeixinClient",
+                ...,
+                # rate: calls per second, burst: bucket size, prefetch: permits per redis round trip,
+                # per: "agent"(each app) or "corp"(all the apps of the corp)
+                "RATE_LIMIT": {"rate": 20, "burst": 20, "prefetch": 5, "per": "agent"},
+            },
+            # Apps configured by no alias, eg: sent by MQ from the database
+            "rate_limits": {"ding_talk": {"rate": 20}},
+        }
+    """
+    options = get_rate_limit_options(client)
+    if not options:
+        return None
+
+    name_parts = [client.client_name, client._corp_id]
+    if options.get("per", "agent") == "agent":
+        name_parts.append(client._agent_id)
+
+    name = ":".join(str(part) for part in name_parts)
+
+    if name not in _limiters:
+        with _limiters_lock:
+            if name not in _limiters:
+                _limiters[name] = RedisRateLimiter(
+                    name, rate=options["rate"], burst=options.get("burst"), prefetch=options.get("prefetch", 1)
+                )
+
+    return _limiters[name]
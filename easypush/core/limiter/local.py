@@ -0,0 +1,89 @@
+import time
+import threading
+
+from easypush.utils.settings import config, DEFAULTS
+
+
+class LocalRateLimiter:
+    """ Token bucket of one process: `rate` permits per second, up to `burst` at once """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """ :return: float, 0 if acquired else seconds to wait for a permit """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """ :return: bool, False when no permit in `timeout` seconds """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            wait_time = self.try_acquire()
+            if not wait_time:
+                return True
+
+            if deadline is not None and time.monotonic() + wait_time > deadline:
+                return False
+
+            time.sleep(wait_time)
+
+
+class PlatformGate:
+    """ Caps the concurrent calls and the rate of the api calls to one platform
+
+    Example::
+        >>> with get_platform_gate("qy_weixin"):
+        ...     push.async_send(...)
+    """
+
+    def __init__(self, concurrency, rate):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.limiter = LocalRateLimiter(rate)
+
+    def __enter__(self):
+        self.semaphore.acquire()
+
+        try:
+            self.limiter.acquire()
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.semaphore.release()
+
+
+_gates = {}
+_gates_lock = threading.Lock()
+
+
+def get_platform_gate(platform_type):
+    """ Gate shared by the threads of the process, see EASYPUSH["dispatch_limits"] """
+    if platform_type not in _gates:
+        with _gates_lock:
+            if platform_type not in _gates:
+                limits = dict(DEFAULTS["dispatch_limits"], **config.dispatch_limits)
+                options = limits.get(platform_type) or limits["default"]
+                _gates[platform_type] = PlatformGate(options["concurrency"], options["rate"])
+
+    return _gates[platform_type]
@@ -3,15 +3,11 @@ import string
 import random
 import threading
 
-try:
-    from redlock import Redlock
-except ImportError:
-    Redlock = None
-
 from django_redis import get_redis_connection
 from django.utils.functional import cached_property
 
-from .watch import LockWatcher
+from .quorum import QuorumLock
+from .watch import LockWatcher, lease_renewer
 
 
 class AcquireLockError(Exception):
@@ -30,7 +26,55 @@ class TaskCallableError(Exception):
     pass
 
 
+class LockMetrics:
+    """ Process wide counters of lock acquisition, thread-safe """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.acquisitions = 0           # Locks acquired
+            self.contentions = 0            # Acquired after waiting at least once
+            self.timeouts = 0               # Gave up after `wait_timeout`
+            self.wait_time_total = 0.0      # Seconds
+            self.wait_time_max = 0.0
+
+    def record(self, wait_time, contended, timeout=False):
+        with self._lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.acquisitions += 1
+                self.contentions += int(contended)
+
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    def snapshot(self):
+        with self._lock:
+            attempts = self.acquisitions + self.timeouts
+
+            return dict(
+                acquisitions=self.acquisitions,
+                contentions=self.contentions,
+                timeouts=self.timeouts,
+                wait_time_total=self.wait_time_total,
+                wait_time_max=self.wait_time_max,
+                wait_time_avg=self.wait_time_total / attempts if attempts else 0.0,
+            )
+
+
+lock_metrics = LockMetrics()
+
+
 class DistributedLock:
+    WAIT_POLL = "poll"
+    WAIT_NOTIFY = "notify"
+    NOTIFY_MAX_BLOCK = 5  # Seconds, keep BLPOP under the redis client socket timeout
+    NOTIFY_WAITER_TTL = 3 * NOTIFY_MAX_BLOCK  # Seconds, a waiter not refreshed in time is skipped
+
     UNLOCK_SCRIPT = """
         if redis.call("get",KEYS[1]) == ARGV[1] then
             return redis.call("del",KEYS[1])
@@ -39,10 +83,82 @@ class DistributedLock:
         end
     """
 
+    # Notify mode, the waiters are queued in arrival order(FIFO):
+    #   KEYS[1]: lock, KEYS[2]: list of the waiting tokens
+    #   ARGV[1]: token, ARGV[2]: lock ttl(ms), ARGV[3]: waiter ttl(ms), ARGV[4]: prefix of the waiter keys
+    # A waiter refreshes its key `prefix..token` every round, the lock is never handed to a waiter gone away.
+    # Acquired at once only when the lock is free and nobody waits before: a newcomer never jumps the queue.
+    ACQUIRE_NOTIFY_SCRIPT = """
+        local owner = redis.call("get",KEYS[1])
+        if owner == ARGV[1] then
+            return 1
+        end
+
+        if not owner then
+            local head = redis.call("lindex",KEYS[2],0)
+            while head and head ~= ARGV[1] and redis.call("exists",ARGV[4]..head) == 0 do
+                redis.call("lpop",KEYS[2])
+                head = redis.call("lindex",KEYS[2],0)
+            end
+
+            if not head or head == ARGV[1] then
+                if head then
+                    redis.call("lpop",KEYS[2])
+                end
+                redis.call("del",ARGV[4]..ARGV[1])
+                redis.call("set",KEYS[1],ARGV[1],"px",ARGV[2])
+                return 1
+            end
+        end
+
+        if redis.call("exists",ARGV[4]..ARGV[1]) == 0 then
+            redis.call("rpush",KEYS[2],ARGV[1])
+        end
+        redis.call("set",ARGV[4]..ARGV[1],1,"px",ARGV[3])
+        redis.call("pexpire",KEYS[2],ARGV[3])
+        return 0
+    """
+
+    # Release by handing the lock over to the head waiter still alive, then wake it up on its own list
+    #   ARGV[5]: prefix of the wake-up lists
+    UNLOCK_NOTIFY_SCRIPT = """
+        if redis.call("get",KEYS[1]) ~= ARGV[1] then
+            return 0
+        end
+
+        local head = redis.call("lpop",KEYS[2])
+        while head do
+            if redis.call("exists",ARGV[4]..head) == 1 then
+                redis.call("del",ARGV[4]..head)
+                redis.call("set",KEYS[1],head,"px",ARGV[2])
+                redis.call("rpush",ARGV[5]..head,1)
+                redis.call("pexpire",ARGV[5]..head,ARGV[3])
+                return 1
+            end
+            head = redis.call("lpop",KEYS[2])
+        end
+
+        redis.call("del",KEYS[1])
+        return 1
+    """
+
+    # Give up waiting, :return: 1 if the lock was handed over in the meantime
+    #   ARGV[2]: prefix of the waiter keys, ARGV[3]: prefix of the wake-up lists
+    CANCEL_NOTIFY_SCRIPT = """
+        if redis.call("get",KEYS[1]) == ARGV[1] then
+            return 1
+        end
+
+        redis.call("lrem",KEYS[2],0,ARGV[1])
+        redis.call("del",ARGV[2]..ARGV[1],ARGV[3]..ARGV[1])
+        return 0
+    """
+
     def __init__(self, key,
                  func, func_args=(), func_kwargs=None,
                  before_func=None, before_func_args=(), before_func_kwargs=None,
-                 expire=None, interval_waits=None, watch_on=False):
+                 expire=None, interval_waits=None, watch_on=False,
+                 wait_mode=None, wait_timeout=None, nodes=None):
         """ 分布式锁, 当任务需要唯一执行时可使用该方法
             :param key: str, 分布式锁 Key
             :param func: callable, 执行的任务的可调用对象
@@ -54,6 +170,10 @@ class DistributedLock:
             :param expire: int, 锁和task最大过期时间(秒)
             :param interval_waits: int, 下一次获取锁的间隔时间(秒)
             :param watch_on: bool, 是否给锁续命，直至task结束
+            :param wait_mode: str, 等锁方式: `poll` 间隔轮询(默认), `notify` 排队阻塞等待,
+                解锁时按到达顺序(FIFO)移交给下一个等待者
+            :param wait_timeout: int|float, 最长等锁时间(秒), 超时抛出 AcquireLockError, 默认一直等待
+            :param nodes: list, 多个独立 redis 节点(CACHES alias/url/client), 过半节点加锁成功才算获得锁(Redlock)
             :return:
         """
         self.key = key
@@ -70,16 +190,42 @@ class DistributedLock:
         self.interval_waits = interval_waits or 0.1
         self.watch_on = watch_on
 
+        self.wait_mode = wait_mode or self.WAIT_POLL
+        self.wait_timeout = wait_timeout
+        self.queue_key = "%s:waiters" % key
+        self.waiter_prefix = "%s:waiter:" % key
+        self.wake_prefix = "%s:wake:" % key
+
+        if self.wait_mode not in (self.WAIT_POLL, self.WAIT_NOTIFY):
+            raise ValueError("wait_mode must be `%s` or `%s`" % (self.WAIT_POLL, self.WAIT_NOTIFY))
+
+        self.quorum_lock = QuorumLock(nodes) if nodes else None
+
+        if self.quorum_lock and self.wait_mode == self.WAIT_NOTIFY:
+            raise ValueError("wait_mode `%s` only works with a single redis node" % self.WAIT_NOTIFY)
+
     @cached_property
     def script_sha(self):
         # script_sha is str, Same as script_sha, same result every time
+        if self.wait_mode == self.WAIT_NOTIFY:
+            return self.redis_conn.script_load(self.UNLOCK_NOTIFY_SCRIPT)
+
         return self.redis_conn.script_load(self.UNLOCK_SCRIPT)
 
+    @cached_property
+    def acquire_script_sha(self):
+        return self.redis_conn.script_load(self.ACQUIRE_NOTIFY_SCRIPT)
+
+    @cached_property
+    def cancel_script_sha(self):
+        return self.redis_conn.script_load(self.CANCEL_NOTIFY_SCRIPT)
+
     @cached_property
     def redis_conn(self):
         return get_redis_connection()
 
-    def get_unique_id(self):
+    @staticmethod
+    def get_unique_id():
         CHARACTERS = string.ascii_letters + string.digits
         return ''.join(random.choice(CHARACTERS) for _ in range(22)).encode()
 
@@ -90,8 +236,12 @@ class DistributedLock:
         # Here is Distributed Lock
         # 1: Self-implemented locker(distributed locker) for a single redis instance, redis.set is atomic,
         #      but not blocking, so use `while` for checking, then must sleep
-        # 2: The redlock-py package is a distributed locker on multiple instances of redis，
+        # 2: `nodes` given, Redlock on multiple instances of redis (see QuorumLock),
         #      after the locker is acquired, it is not blocking, you still need to use `while` for checking
+        start_time = time.monotonic()
+        deadline = None if self.wait_timeout is None else start_time + self.wait_timeout
+        contended = False
+
         while True:
             if callable(self.before_func):
                 args = self.before_func_args
@@ -99,18 +249,26 @@ class DistributedLock:
                 pre_result = self.before_func(*args, **(kwargs or {}))
 
                 if pre_result is not None:
+                    if contended and self.wait_mode == self.WAIT_NOTIFY:
+                        self._leave_queue(uniq_val)
+
                     return pre_result
 
             # Warning(Important): If the `task` spend time than the `expire`, the locker will not work,
             # so you must prolong Time To Live for the locker
-            if self.redis_conn.set(self.key, uniq_val, px=lock_watcher.expire, nx=True):
+            if self._acquire(uniq_val, lock_watcher.expire):
                 # print("calculate-%s：%s" % (threading.get_ident(), datetime.now()))
+                lock_metrics.record(time.monotonic() - start_time, contended)
+
+                lease_ids = []
+
                 try:
-                    # 护线程给lock_key续命，目前测试发现整体上会稍微降低整个系统的效率
+                    # 共享的续命线程给lock_key续命(TTL的70%时批量续期)，不再每把锁启动一个 `watchdog` 线程
                     if self.watch_on:
-                        t = threading.Thread(target=lock_watcher.watchdog)
-                        t.setDaemon(True)  # When the main thread terminates, the daemon thread automatically terminates
-                        t.start()
+                        lease_ids = [
+                            lease_renewer.register(self.key, uniq_val, lock_watcher.expire, conn)
+                            for conn in self._get_nodes()
+                        ]
 
                     if callable(self.func):
                         return self.func(*self.func_args, **(self.func_kwargs or {}))
@@ -119,16 +277,86 @@ class DistributedLock:
                 except Exception as e:
                     raise TaskRunningError("Task running business error: {0}".format(e))
                 finally:
+                    for lease_id in lease_ids:
+                        lease_renewer.cancel(lease_id)
+
                     self._unlock(uniq_val)
 
-            time.sleep(self.interval_waits)  # Sleep `delay` seconds
+            contended = True
+            remaining = None if deadline is None else deadline - time.monotonic()
+
+            if remaining is not None and remaining <= 0:
+                if self.wait_mode == self.WAIT_NOTIFY:
+                    self._leave_queue(uniq_val)
+
+                lock_metrics.record(time.monotonic() - start_time, contended, timeout=True)
+                raise AcquireLockError("Acquire locker<%s> timeout after %ss" % (self.key, self.wait_timeout))
+
+            if self.wait_mode == self.WAIT_NOTIFY:
+                self._wait_notify(uniq_val, remaining)
+            else:
+                # Random delay on multiple nodes, clients retrying at the same time would split the votes
+                interval_waits = self.interval_waits
+                if self.quorum_lock:
+                    interval_waits *= random.uniform(0.5, 1.5)
+
+                time.sleep(interval_waits if remaining is None else min(interval_waits, remaining))
+
+    def _get_nodes(self):
+        return self.quorum_lock.nodes if self.quorum_lock else [self.redis_conn]
+
+    def _acquire(self, uniq_val, expire):
+        """ :param expire: int, milliseconds """
+        if self.quorum_lock:
+            return self.quorum_lock.acquire(self.key, uniq_val, expire) > 0
+
+        if self.wait_mode == self.WAIT_NOTIFY:
+            args = (uniq_val, expire, self.NOTIFY_WAITER_TTL * 1000, self.waiter_prefix)
+            return self.redis_conn.evalsha(self.acquire_script_sha, 2, self.key, self.queue_key, *args) == 1
+
+        return self.redis_conn.set(self.key, uniq_val, px=expire, nx=True)
+
+    def _wait_notify(self, uniq_val, remaining=None):
+        """ Block until the lock is handed over, at most the lock TTL in case the holder died """
+        pttl = self.redis_conn.pttl(self.key)
+
+        if pttl == -2:
+            # Free but not handed over yet: the waiters before are taking it
+            block_ms = self.interval_waits * 1000
+        else:
+            block_ms = min(pttl if pttl > 0 else self.expire * 1000, self.NOTIFY_MAX_BLOCK * 1000)
+
+        if remaining is not None:
+            block_ms = min(block_ms, remaining * 1000)
+
+        # BLPOP timeout 0 blocks forever
+        wake_key = self.wake_prefix + self._to_text(uniq_val)
+        self.redis_conn.blpop([wake_key], timeout=max(block_ms, 10) / 1000.0)
+
+    def _leave_queue(self, uniq_val):
+        """ Stop waiting, a lock handed over in the meantime goes to the next waiter """
+        args = (uniq_val, self.waiter_prefix, self.wake_prefix)
+
+        if self.redis_conn.evalsha(self.cancel_script_sha, 2, self.key, self.queue_key, *args) == 1:
+            self._unlock(uniq_val)
+
+    @staticmethod
+    def _to_text(value):
+        return value.decode() if isinstance(value, bytes) else str(value)
 
     def _unlock(self, uniq_val):
         # Recommend to use, only release the locker you put on yourself
         try:
             # You could use `eval` or `evalsha` cmd, but performance of `evalsha might be better
             # redis_conn.eval(unlock_script, 1, lock_key, uniq_val)
-            self.redis_conn.evalsha(self.script_sha, 1, self.key, uniq_val)
+            if self.quorum_lock:
+                self.quorum_lock.release(self.key, uniq_val)
+            elif self.wait_mode == self.WAIT_NOTIFY:
+                args = (uniq_val, self.expire * 1000, self.NOTIFY_WAITER_TTL * 1000,
+                        self.waiter_prefix, self.wake_prefix)
+                self.redis_conn.evalsha(self.script_sha, 2, self.key, self.queue_key, *args)
+            else:
+                self.redis_conn.evalsha(self.script_sha, 1, self.key, uniq_val)
 
             # Also use register_script method,
             # command = redis_conn.register_script(unlock_script)
@@ -0,0 +1,144 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import redis
+from redis.retry import Retry
+from redis.backoff import NoBackoff
+from django_redis import get_redis_connection
+
+logger = logging.getLogger("django")
+
+
+class _Node:
+    """ One redis node with its own workers, a slow or down node can only hold up its own calls """
+    MAX_WORKERS = 4
+    MAX_PENDING = 16  # Calls queued on a stuck node beyond that fail at once
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix="easypush-quorum")
+
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _done(self, future):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, func, *args):
+        """ :return: Future or None when the node is saturated """
+        with self._lock:
+            if self._pending >= self.MAX_PENDING:
+                return None
+
+            self._pending += 1
+
+        future = self.executor.submit(func, self.conn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+
+class QuorumLock:
+    """ Redlock: lock on N independent redis nodes, owned when a majority of them granted it
+
+        The SET NX PX commands are sent to all the nodes in parallel and a node that does not answer in
+        `node_timeout` counts as a failure, so a slow or down node never serializes the acquisition.
+        The lock is only valid for `ttl - elapsed - drift`, drift compensating the clocks of the nodes.
+    """
+    CLOCK_DRIFT_FACTOR = 0.01
+    CLOCK_DRIFT_MIN = 2  # milliseconds
+
+    UNLOCK_SCRIPT = """
+        if redis.call("get",KEYS[1]) == ARGV[1] then
+            return redis.call("del",KEYS[1])
+        else
+            return 0
+        end
+    """
+
+    _nodes = {}
+    _nodes_lock = threading.Lock()
+
+    def __init__(self, nodes, node_timeout=None):
+        """
+        :param nodes: list, redis nodes, item is a django `CACHES` alias, a redis url or a redis client
+        :param node_timeout: float, max seconds to wait for the nodes
+        """
+        if not nodes:
+            raise ValueError("QuorumLock requires at least one redis node")
+
+        self.node_timeout = node_timeout or 0.05
+        self._nodes = [self.get_node(node) for node in nodes]
+        self.quorum = len(self._nodes) // 2 + 1
+
+    @property
+    def nodes(self):
+        return [node.conn for node in self._nodes]
+
+    def get_node(self, node):
+        """ Nodes(and their workers) are shared by all the quorum locks of the process """
+        key = node if isinstance(node, str) else id(node)
+
+        with self._nodes_lock:
+            if key not in QuorumLock._nodes:
+                if not isinstance(node, str):
+                    conn = node
+                elif "://" in node:
+                    # No retry: a down node must fail fast rather than back off for seconds
+                    conn = redis.Redis.from_url(
+                        node, socket_timeout=self.node_timeout, socket_connect_timeout=self.node_timeout,
+                        retry=Retry(NoBackoff(), 0),
+                    )
+                else:
+                    conn = get_redis_connection(node)
+
+                QuorumLock._nodes[key] = _Node(conn)
+
+            return QuorumLock._nodes[key]
+
+    def _call_all(self, func, *args):
+        """ Run `func(conn, *args)` on every node in parallel, :return: list of result, None if failed """
+        futures = [node.submit(func, *args) for node in self._nodes]
+        wait([f for f in futures if f is not None], timeout=self.node_timeout)
+
+        results = []
+        for future in futures:
+            if future is None or not future.done() or future.exception() is not None:
+                results.append(None)
+            else:
+                results.append(future.result())
+
+        return results
+
+    @staticmethod
+    def _set_node(conn, key, value, ttl):
+        return conn.set(key, value, px=ttl, nx=True)
+
+    def _unlock_node(self, conn, key, value):
+        return conn.eval(self.UNLOCK_SCRIPT, 1, key, value)
+
+    def acquire(self, key, value, ttl):
+        """ Try once
+        :param ttl: int, milliseconds
+        :return: int, remaining validity(milliseconds) of the lock, 0 if not acquired
+        """
+        start_time = time.monotonic()
+        results = self._call_all(self._set_node, key, value, ttl)
+
+        elapsed = int((time.monotonic() - start_time) * 1000)
+        drift = int(ttl * self.CLOCK_DRIFT_FACTOR) + self.CLOCK_DRIFT_MIN
+        validity = ttl - elapsed - drift
+
+        if sum(bool(ret) for ret in results) >= self.quorum and validity > 0:
+            return validity
+
+        # Not acquired: release the nodes that may have granted it, also the slow ones
+        self.release(key, value)
+        return 0
+
+    def release(self, key, value):
+        for index, ret in enumerate(self._call_all(self._unlock_node, key, value)):
+            if ret is None:
+                logger.debug("[%s] => Release lock<%s> on node %s failed", self.__class__.__name__, key, index)
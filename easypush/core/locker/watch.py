@@ -1,8 +1,15 @@
+import os
 import time
+import heapq
+import logging
+import itertools
+import threading
 
 from django_redis import get_redis_connection
 from django.utils.functional import cached_property
 
+logger = logging.getLogger("django")
+
 
 class LockWatcher:
     delay_script = """
@@ -22,7 +29,7 @@ class LockWatcher:
 
     def __init__(self, key, value, expire, conn=None):
         self.key = key
-        self.value = str(value)
+        self.value = value.decode() if isinstance(value, bytes) else str(value)
         self.expire = int(expire * 1000)  # milliseconds
         self.redis_conn = conn or get_redis_connection()
 
@@ -55,3 +62,134 @@ class LockWatcher:
                 timestamp = self.get_timestamp()
 
             time.sleep(0.1)
+
+
+class LeaseRenewer:
+    """ One timer thread per process renewing all the held lock leases
+
+    Leases are kept in a heap ordered by their next renewal time (70% of the TTL). The due ones are
+    renewed together, one pipeline per redis connection, and a lease is dropped as soon as it is
+    cancelled or the lock no longer belongs to us.
+    """
+    RENEW_RATIO = 0.7
+    RETRY_RATIO = 0.1  # Renewal failed(eg: network error), try again soon
+
+    def __init__(self):
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._heap = []             # [(due_timestamp, lease_id)]
+        self._leases = {}           # lease_id: (key, value, expire_ms, conn)
+        self._scripts = {}          # id(conn): registered delay script
+        self._counter = itertools.count(1)
+        self._thread = None
+
+    def _ensure_thread(self):
+        """ Must hold `self._cond` """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="easypush-lease-renewer")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def register(self, key, value, expire, conn=None):
+        """ Keep the lock `key` owned with `value` alive until `cancel`
+        :param expire: int, lock TTL(milliseconds)
+        :return: lease id
+        """
+        if self._pid != os.getpid():
+            # Forked: the parent's thread and leases do not exist here
+            self._pid = os.getpid()
+            self._reset()
+
+        conn = conn or get_redis_connection()
+
+        with self._cond:
+            lease_id = next(self._counter)
+            self._leases[lease_id] = (key, value, expire, conn)
+            heapq.heappush(self._heap, (time.monotonic() + expire * self.RENEW_RATIO / 1000.0, lease_id))
+
+            self._ensure_thread()
+            self._cond.notify()
+
+        return lease_id
+
+    def cancel(self, lease_id):
+        with self._cond:
+            # The heap entry is discarded lazily when it becomes due
+            self._leases.pop(lease_id, None)
+
+    def _get_script(self, conn):
+        script = self._scripts.get(id(conn))
+
+        if script is None:
+            script = self._scripts[id(conn)] = conn.register_script(LockWatcher.delay_script)
+
+        return script
+
+    def _pop_due(self):
+        """ Block until some leases are due, :return: {id(conn): [(lease_id, lease)]} """
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][1] not in self._leases:
+                    heapq.heappop(self._heap)
+
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                timeout = self._heap[0][0] - time.monotonic()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+
+                now = time.monotonic()
+                batches = {}
+
+                while self._heap and self._heap[0][0] <= now:
+                    _, lease_id = heapq.heappop(self._heap)
+                    lease = self._leases.get(lease_id)
+
+                    if lease is not None:
+                        batches.setdefault(id(lease[3]), []).append((lease_id, lease))
+
+                if batches:
+                    return batches
+
+    def _reschedule(self, lease_id, delay):
+        with self._cond:
+            if lease_id in self._leases:
+                heapq.heappush(self._heap, (time.monotonic() + delay, lease_id))
+
+    def _renew(self, leases):
+        conn = leases[0][1][3]
+        script = self._get_script(conn)
+
+        try:
+            with conn.pipeline(transaction=False) as pipe:
+                for _, (key, value, expire, _) in leases:
+                    script(keys=[key], args=[value, expire], client=pipe)
+
+                results = pipe.execute()
+        except Exception as e:
+            logger.error("[%s] => Renew %s leases error: %s", self.__class__.__name__, len(leases), e)
+
+            for lease_id, (_, _, expire, _) in leases:
+                self._reschedule(lease_id, expire * self.RETRY_RATIO / 1000.0)
+            return
+
+        for (lease_id, (key, _, expire, _)), renewed in zip(leases, results):
+            if renewed:
+                self._reschedule(lease_id, expire * self.RENEW_RATIO / 1000.0)
+            else:
+                logger.warning("[%s] => Lease of lock<%s> lost", self.__class__.__name__, key)
+                self.cancel(lease_id)
+
+    def _run(self):
+        while True:
+            for leases in self._pop_due().values():
+                self._renew(leases)
+
+
+lease_renewer = LeaseRenewer()
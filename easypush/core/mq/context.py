@@ -1,27 +1,29 @@
-import re
-import time
 import json
 import logging
 import inspect
 import numbers
 import importlib
+import threading
 from collections.abc import Mapping
 from datetime import timedelta, datetime
 
 from django.conf import settings
 
-from celery import Celery
 from celery import current_app, current_task
 from celery.app import backends
 from celery.app.task import Task
 from celery.app.amqp import AMQP, task_message
-from celery.states import SUCCESS
+from celery.states import FAILURE
 from celery.utils.nodenames import anon_nodename
+from celery.utils import uuid
 from celery.utils.saferepr import saferepr
 from celery.utils.time import maybe_make_aware
 from celery.exceptions import BackendError, CeleryError
 
 from easypush import easypush
+from easypush.utils.constants import MessagePriorityEnum
+from .retry import RetryPolicy
+from .tracing import tracer
 
 
 __all__ = ["ContextTask", "Amqp", "get_celery_app"]
@@ -30,11 +32,11 @@ __all__ = ["ContextTask", "Amqp", "get_celery_app"]
 task_logger = logging.getLogger("celery.task")
 worker_logger = logging.getLogger("celery.worker")
 
-DEFAULT_COUNTDOWN = 0.1
 DEFAULT_MAX_RETRIES = 3
 DEFAULT_RETRY_KEY = "MAX_RETRY_CNT"
 celery_app = None
 empty = object()
+_result_backends = threading.local()  # registry: {(app id, to_backend alias): result backend}
 
 
 def get_celery_app():
@@ -72,7 +74,10 @@ def _send_periodic_task_alert(task_name, task_result=None, is_periodic=False, **
         if alert_obj:
             msgtype = alert_obj.msg_type
             body_kwargs = json.loads(alert_obj.msg_body)
-            easypush.async_send(msgtype, body_kwargs=body_kwargs, async_mode=True)
+            # 告警走紧急通道, 不被群发消息阻塞
+            easypush.async_send(
+                msgtype, body_kwargs=body_kwargs, async_mode=True, priority=MessagePriorityEnum.URGENT.type
+            )
 
 
 class Amqp(AMQP):
@@ -141,6 +146,12 @@ class Amqp(AMQP):
 
 
 class ContextBaseTask(Task):
+    failure_retry = empty   # Task option, see `RetryPolicy`, default: RetryPolicy()
+
+    _task_to_backend = empty  # Resolved once per task class, see `_get_task_to_backend`
+    _retry_policy = None
+    _has_retry_keyword = False
+
     @property
     def backend(self):
         """ Default backend: self.app.backend (celery.app.base:Celery.backend)
@@ -148,36 +159,11 @@ class ContextBaseTask(Task):
         根据 task 指定的存储方式将结果存储到不同的物理介质:
             celery.app.backends:BACKEND_ALIASES OR django-db
         """
-        task_run = self.run
-        backend_aliases = backends.BACKEND_ALIASES
-
-        sig = inspect.signature(task_run)
-        parameters = sig.parameters
-        task_to_backend = parameters.get(self.app.conf.CELERY_TASK_TO_BACKEND)
-        to_backend = task_to_backend.default if task_to_backend else None
-        to_backend = None if to_backend == "default" else to_backend
+        to_backend = self._get_task_to_backend()
 
         if to_backend:
             # 任务结果存储到不同介质
-            result_backend = getattr(self.app.conf, "CELERY_RESULT_BACKEND_" + to_backend.upper(), None)
-
-            if to_backend not in backend_aliases:
-                raise BackendError("Celery result backend is unknown!")
-
-            if result_backend is None:
-                raise BackendError("Celery configuration don't `%s`" % result_backend)
-
-            var_backend_name = "_%s_result_backend" % to_backend
-            _backend = getattr(self, var_backend_name, None)
-
-            if _backend:
-                return _backend
-
-            new_backend, url = backends.by_url(result_backend, self.app.loader)
-            _backend = new_backend(app=self.app, url=url)
-            setattr(self, var_backend_name, _backend)
-
-            return _backend
+            return self._get_result_backend(to_backend)
 
         else:
             # 与 celery 原生一样, 取决于 CELERY_RESULT_BACKEND
@@ -187,85 +173,108 @@ class ContextBaseTask(Task):
 
             return backend
 
+    def _get_task_to_backend(self):
+        """ Alias of the result backend declared by the task function, eg: def task(..., to_backend="redis")
+            The signature is only inspected at the first access of the task class.
+        """
+        cls = self.__class__
+
+        if cls._task_to_backend is empty:
+            parameters = inspect.signature(self.run).parameters
+            task_to_backend = parameters.get(self.app.conf.CELERY_TASK_TO_BACKEND)
+            to_backend = task_to_backend.default if task_to_backend else None
+
+            cls._task_to_backend = None if to_backend == "default" else to_backend
+
+        return cls._task_to_backend
+
+    def _get_result_backend(self, to_backend):
+        """ Backends are shared by the tasks of a thread, like `app.backend` they are not thread-safe """
+        registry = _result_backends.__dict__.setdefault("registry", {})
+        key = (id(self.app), to_backend)
+
+        if key not in registry:
+            result_backend_key = "CELERY_RESULT_BACKEND_" + to_backend.upper()
+            result_backend = getattr(self.app.conf, result_backend_key, None)
+
+            if to_backend not in backends.BACKEND_ALIASES:
+                raise BackendError("Celery result backend is unknown!")
+
+            if result_backend is None:
+                raise BackendError("Celery configuration don't `%s`" % result_backend_key)
+
+            backend_cls, url = backends.by_url(result_backend, self.app.loader)
+            registry[key] = backend_cls(app=self.app, url=url)
+
+        return registry[key]
+
     @backend.setter
     def backend(self, value):  # noqa
         self._backend = value
         worker_logger.info("ContextTask.backend -> Set value: %s", value)
 
-    def log_info(self, log_kwargs, current_running_fun=None):
-        if self is empty:
-            worker_logger.info(">>>>>> ContextTask.log have't bond task instance !!!")
-
-        log_kwargs.pop("self", None)
-        log_kwargs["self_id"] = id(self)
-        log_msg = log_kwargs.pop("log_msg", "")
-        task_cls_name = self.app.task_cls.__name__
-
-        log_msg = "{task_cls_name}.{current_running_fun} {log_msg} -> {running_fun_kwargs}".format(
-            task_cls_name=task_cls_name, log_msg=log_msg,
-            current_running_fun=current_running_fun, running_fun_kwargs=log_kwargs
-        )
-        worker_logger.info(log_msg)
-
     @classmethod
     def on_bound(cls, app):
         worker_logger.info("ContextTask.on_bound -> app: %s, type(app): %s", app, type(app))
+        cls._task_to_backend = empty  # Resolved again with the config of the new app
+
+        # Retry decided in `after_return` without inspecting the task again
+        if getattr(cls, "autoretry_for", None):
+            cls._retry_policy = None  # Retried by celery itself
+        elif cls.failure_retry is empty:
+            cls._retry_policy = RetryPolicy(max_attempts=DEFAULT_MAX_RETRIES)
+        else:
+            cls._retry_policy = RetryPolicy.from_option(cls.failure_retry)
+
+        cls._has_retry_keyword = cls._has_keyword_params_from_task()
 
     def on_success(self, retval, task_id, args, kwargs):
-        log_kwargs = dict(locals(), requestId=self.request.id, delivery_info=self.request.delivery_info)
-        self.log_info(current_running_fun=inspect.stack()[0][3], log_kwargs=log_kwargs)
+        payload = dict(retval=retval, delivery_info=self.request.delivery_info)
+        tracer.trace(self, "on_success", payload=payload, level=logging.DEBUG)
 
     def on_retry(self, exc, task_id, args, kwargs, einfo):
-        self.log_info(current_running_fun=inspect.stack()[0][3], log_kwargs=dict(locals()))
+        payload = dict(args=args, kwargs=kwargs)
+        tracer.trace(self, "on_retry", "exc: %r" % exc, payload=payload, level=logging.WARNING)
 
         # super().on_retry(exc, task_id, args, kwargs, einfo)
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
-        self.log_info(current_running_fun=inspect.stack()[0][3], log_kwargs=dict(locals()))
+        payload = dict(args=args, kwargs=kwargs)
+        tracer.trace(self, "on_failure", "exc: %r" % exc, payload=payload, level=logging.ERROR)
 
     def after_return(self, status, retval, task_id, args, kwargs, einfo):
-        log_kwargs = dict(locals(), requestId=self.request.id)
-        current_running_fun = inspect.stack()[0][3]
-        self.log_info(current_running_fun=current_running_fun, log_kwargs=log_kwargs)
+        tracer.trace(self, "after_return", status, level=logging.DEBUG)
 
         # 任意多的消息绑定的任务(self)有且仅有一个实例, self.request 也如此
         # 消息消费失败，将重新推回rabbitmq队列
         # ??? 最好的方法是消息重试结束后不能ack，让消息继续在mq中
-        if status != SUCCESS:
-            retry_log_kwargs = dict(Retry=True, args=args, kwargs=kwargs, task_id=task_id)
-            self.log_info(current_running_fun=current_running_fun, log_kwargs=retry_log_kwargs)
-
-            # 默认最大尝试3次
-            # 方法一: 使用 apply_async 将消息再次推入到 RabbitMQ 中, 时间消耗在于将消息再次推入MQ
-            #        需要每个task参数中必须带有关键字参数kwargs, 若task_id相同，任务结果入库只有一条记录，相反会有3条.
-            #        注意: 每次 self.request 实例可能相同
-            #
-            # 方法二: 在每个具体的 task 里，使用self.retry(....)
-            #        消息仍在 RabbitMQ 中， 因为没有 ACK, 性能比[方法一]好点, 但是会与[方法一]冲突
-            #        注意: 每次 self.request 实例也可能相同
-            if not self._check_task_retry():
-                has_keyword = self._has_keyword_params_from_task()
-
-                if has_keyword:
-                    default_max_retries = kwargs.get(DEFAULT_RETRY_KEY, DEFAULT_MAX_RETRIES)
-                    current_retry_cnt = default_max_retries - 1
-                else:
-                    current_retry_cnt = getattr(self, DEFAULT_RETRY_KEY, 3) - 1
+        # RETRY: 任务自己调用了 self.retry(...), 消息仍在 MQ 中, 不再重复推送
+        retry_policy = self._retry_policy
+
+        if status == FAILURE and retry_policy is not None and retry_policy.is_retryable(retval):
+            payload = dict(args=args, kwargs=kwargs)
+            tracer.trace(self, "after_return", "Retry", payload=payload, level=logging.WARNING)
 
-                worker_logger.info("after_return.task: %s, %s, current_retry_cnt:%s", self, id(self), current_retry_cnt)
+            # 使用 apply_async 将消息再次推入到 RabbitMQ 中, 剩余次数记录在任务的关键字参数 MAX_RETRY_CNT,
+            # 若task_id相同，任务结果入库只有一条记录. 任务没有关键字参数时只能记在任务(唯一实例)上
+            if self._has_retry_keyword:
+                remaining_cnt = kwargs.get(DEFAULT_RETRY_KEY, retry_policy.max_attempts) - 1
+            else:
+                remaining_cnt = getattr(self, DEFAULT_RETRY_KEY, retry_policy.max_attempts) - 1
+
+            worker_logger.info("after_return.task: %s, %s, remaining_cnt:%s", self, id(self), remaining_cnt)
 
-                if current_retry_cnt > 0:
-                    if has_keyword:
-                        kwargs[DEFAULT_RETRY_KEY] = current_retry_cnt
-                    else:
-                        setattr(self, DEFAULT_RETRY_KEY, current_retry_cnt)
+            if remaining_cnt > 0:
+                if self._has_retry_keyword:
+                    kwargs[DEFAULT_RETRY_KEY] = remaining_cnt
+                else:
+                    setattr(self, DEFAULT_RETRY_KEY, remaining_cnt)
 
-                    self.apply_async(args, kwargs, task_id=task_id, countdown=DEFAULT_COUNTDOWN)
+                retries = max(0, retry_policy.max_attempts - remaining_cnt - 1)
+                self.apply_async(args, kwargs, task_id=task_id, countdown=retry_policy.get_countdown(retries))
 
     def run(self, *args, **kwargs):
         """The body of the task executed by workers."""
-        self.log_info(current_running_fun=inspect.stack()[0][3], log_kwargs=dict(locals()))
-
         raise NotImplementedError('BaseJobTask must define the run method.')
 
     def __call__(self, *args, **kwargs):
@@ -292,71 +301,25 @@ class ContextBaseTask(Task):
                   # BaseTask.__call__ = __protected_call__
 
         """
-        start = time.time()     # 这种方式统计task耗时很不准确
-        request_id = self.request.id
-        log_kwargs = dict(request_id=request_id, self=self, log_msg='Start')
-        self.log_info(current_running_fun=inspect.stack()[0][3], log_kwargs=dict(log_kwargs, args=args, kwargs=kwargs))
+        start = tracer.timer()
+        tracer.trace(self, "__call__", "Start", level=logging.DEBUG)
 
         result = super().__call__(*args, **kwargs)
 
-        log_kwargs.update(log_msg="End", costTime=time.time() - start)
-        self.log_info(current_running_fun=inspect.stack()[0][3], log_kwargs=log_kwargs)
+        # 一个任务一行 INFO, 参数按采样率输出
+        cost_msg = "End, cost: %.4fs" % (tracer.timer() - start)
+        tracer.trace(self, "__call__", cost_msg, payload=dict(args=args, kwargs=kwargs))
 
         # _send_periodic_task_alert(self.name, task_result=result, **kwargs)
         return result
 
-    def _check_task_retry(self):
-        """ 自定义方法：检查任务函数是否自带重试机制
-        Example:
-            @celery_app.task(bind=True)
-            def test_retry_message(self, *args, **kwargs):
-                try:
-                    pass
-                except Exception as e:
-                    '''
-                    retry的参数可以有：
-                        exc：指定抛出的异常
-                        throw：重试时是否通知worker是重试任务
-                        eta：指定重试的时间／日期
-                        countdown：在多久之后重试（每多少秒重试一次）
-                        max_retries：最大重试次数
-                    '''
-                    raise self.retry(exc=e, countdown=10, max_retries=3)
-        """
-        task_retry_key = "_auto_task_retry"
-        auto_task_retry = getattr(self, task_retry_key, None)
-
-        if auto_task_retry:
-            return auto_task_retry
-
-        run = self.run
-        source_code = inspect.getsource(run)
-
-        retry_pattern = r"^\s+?raise\s+%s\.retry\(.*?\)"
-        deco_regex = re.compile(r"@.*?\.task\(bind=True\)", re.S | re.M)
-        fun_declaration_regex = re.compile(r"def\s.*?\((.*?),.*?\)", re.S | re.M)
-
-        deco_m = deco_regex.search(source_code)
-        fun_declaration_m = fun_declaration_regex.search(source_code)
-
-        if deco_m and fun_declaration_m and fun_declaration_m.group(1):
-            instance_var = fun_declaration_m.group(1)
-            retry_regex = re.compile(retry_pattern % instance_var, re.S | re.M)
-            retry_m = retry_regex.search(source_code)
-
-            if retry_m:
-                setattr(self, task_retry_key, True)
-                return True
-
-        setattr(self, task_retry_key, False)
-        return False
-
-    def _has_keyword_params_from_task(self):
-        """ 判断任务函数的参数签名 """
-        wrapped_func = self.__wrapped__
+    @classmethod
+    def _has_keyword_params_from_task(cls):
+        """ 判断任务函数的参数签名(任务绑定时执行一次) """
+        wrapped_func = getattr(cls, "__wrapped__", cls.run)
         params = inspect.signature(wrapped_func).parameters
 
-        worker_logger.info("_has_keyword_params_from_task.task_name: %s, wrapped_func:%s", self.name, wrapped_func)
+        worker_logger.info("_has_keyword_params_from_task.task_name: %s, wrapped_func:%s", cls.name, wrapped_func)
 
         for name, param in params.items():
             if name == DEFAULT_RETRY_KEY:
@@ -374,28 +337,36 @@ class ContextTask(ContextBaseTask):
     Default config: celery.app.defaults
     """
 
-    def _get_raw_app(self):
+    RAW_MESSAGE_OPTIONS = ("countdown", "eta", "expires", "time_limit", "soft_time_limit", "ignore_result")
+
+    def _get_raw_amqp(self):
+        """ Builder of the raw messages, bound to the app of the task: same routes, queues and producer pool """
         cls = self.__class__
-        _app_name = "RAW_CELERY_APP"
-        raw_app = getattr(cls, _app_name, None)
+        raw_amqp = getattr(cls, "RAW_AMQP", None)
 
-        if raw_app:
-            return raw_app
+        if raw_amqp is None or raw_amqp.app is not self.app:
+            raw_amqp = Amqp(self.app)
+            setattr(cls, "RAW_AMQP", raw_amqp)
 
-        raw_app = Celery(main="raw_msg_app", amqp="property.core.mq.context:Amqp", task_cls=cls)
-        raw_app.config_from_object(obj=self.app.conf)
+        return raw_amqp
 
-        setattr(cls, _app_name, raw_app)
-        return raw_app
+    def _get_raw_options(self, **options):
+        preopts = self._get_exec_options()
+        options = dict(preopts, **options) if options else preopts
+
+        options.setdefault('ignore_result', self.ignore_result)
+        if self.priority:
+            options.setdefault('priority', self.priority)
+
+        return options
+
+    def _publish_raw(self, raw_amqp, producer, payload, shadow=None, **options):
+        """ :param payload: tuple (args, kwargs) or dict(args=..., kwargs=..., task_id=...) """
+        if isinstance(payload, Mapping):
+            args, kwargs, task_id = payload.get("args"), payload.get("kwargs"), payload.get("task_id")
+        else:
+            (args, kwargs), task_id = payload, None
 
-    def apply_async_raw(self, args=None, kwargs=None, task_id=None, producer=None,
-                        link=None, link_error=None, shadow=None, **options):
-        """ Send raw message
-        task_always_eager:
-            默认值：禁用, 本方法丢弃同步发送消息
-            如果设置成 True，所有的任务都将在本地执行知道任务返回。apply_async() 以及Task.delay()将返回一个
-            EagerResult 实例，模拟AsyncResult实例的API和行为，除了这个结果是已经计算过的之外。
-        """
         if self.typing:
             try:
                 check_arguments = self.__header__
@@ -409,21 +380,78 @@ class ContextTask(ContextBaseTask):
         else:
             shadow = shadow or self.shadow_name(args, kwargs, options)
 
-        preopts = self._get_exec_options()
-        options = dict(preopts, **options) if options else preopts
+        task_id = task_id or uuid()
+        options = raw_amqp.router.route(options, self.name, args, kwargs, task_type=self)
+        message_options = {key: options.pop(key) for key in self.RAW_MESSAGE_OPTIONS if key in options}
 
-        options.setdefault('ignore_result', self.ignore_result)
-        if self.priority:
-            options.setdefault('priority', self.priority)
+        message = raw_amqp.create_task_message(
+            task_id, self.name, args, kwargs, shadow=shadow,
+            create_sent_event=self.app.conf.task_send_sent_event, **message_options
+        )
+        raw_amqp.send_task_message(producer, self.name, message, **options)
 
-        app = self._get_raw_app()
+        return self.AsyncResult(task_id)
 
-        # 异步发送消息
-        return app.send_task(
-            self.name, args, kwargs, task_id=task_id, producer=producer,
-            link=link, link_error=link_error, result_cls=self.AsyncResult,
-            shadow=shadow, task_type=self, **options
-        )
+    def apply_async_raw(self, args=None, kwargs=None, task_id=None, producer=None, shadow=None, **options):
+        """ Send raw message: body `[args, kwargs, {}]`, consumable by the workers of other languages(eg:java)
+        task_always_eager:
+            默认值：禁用, 本方法丢弃同步发送消息
+            如果设置成 True，所有的任务都将在本地执行知道任务返回。apply_async() 以及Task.delay()将返回一个
+            EagerResult 实例，模拟AsyncResult实例的API和行为，除了这个结果是已经计算过的之外。
+        """
+        raw_amqp = self._get_raw_amqp()
+        options = self._get_raw_options(**options)
+
+        # 异步发送消息, 使用 app 的连接池
+        with self.app.producer_or_acquire(producer) as P:
+            payload = dict(args=args, kwargs=kwargs, task_id=task_id)
+            return self._publish_raw(raw_amqp, P, payload, shadow=shadow, **options)
+
+    def apply_async_raw_many(self, payloads, connection=None, transaction=True, shadow=None, **options):
+        """ Send a batch of raw messages on one channel of a pooled connection
+
+            With `broker_transport_options={"confirm_publish": True}` every message waits for the publisher
+            confirm of the broker. Otherwise, if the transport supports it(amqp), the batch is published in a
+            channel transaction: all the messages or none. AMQP forbids both modes on one channel.
+
+        :param payloads: list of (args, kwargs) or dict(args=..., kwargs=..., task_id=...)
+        :param transaction: bool, publish in a channel transaction when the broker doesn't confirm
+        :return: list of AsyncResult, in the order of `payloads`
+        """
+        raw_amqp = self._get_raw_amqp()
+        options = self._get_raw_options(**options)
+        confirm_publish = (self.app.conf.broker_transport_options or {}).get("confirm_publish", False)
+
+        with self.app.connection_or_acquire(connection) as conn:
+            # Own channel: the transaction mode can't leak to the pooled producers.
+            # A pooled connection released after an error comes back closed
+            conn.ensure_connection(max_retries=self.app.conf.broker_connection_max_retries)
+            channel = conn.channel()
+            use_tx = transaction and not confirm_publish and hasattr(channel, "tx_select")
+
+            try:
+                producer = raw_amqp.Producer(channel, auto_declare=False)
+
+                if use_tx:
+                    channel.tx_select()
+
+                try:
+                    results = [
+                        self._publish_raw(raw_amqp, producer, payload, shadow=shadow, **options)
+                        for payload in payloads
+                    ]
+                except Exception:
+                    if use_tx:
+                        channel.tx_rollback()
+                    raise
+
+                if use_tx:
+                    channel.tx_commit()
+            finally:
+                channel.close()
+
+        task_logger.info("ContextTask.apply_async_raw_many <%s> sent %s raw messages", self.name, len(results))
+        return results
 
     def delay(self, *args, **kwargs):
         """ 追踪 task 日志 """
@@ -0,0 +1,120 @@
+import random
+
+from easypush.utils.constants import AppPlatformEnum, PushErrorEnum
+
+TRANSIENT_ERRCODE = 500  # Exception raised while calling the platform, eg: network error
+
+# Errcode of the message apis by platform, the others are permanent
+ERRCODE_MAPPING = {
+    AppPlatformEnum.QY_WEIXIN.type: {
+        -1: PushErrorEnum.SYSTEM_BUSY,
+        40014: PushErrorEnum.TOKEN_EXPIRED,     # invalid access_token
+        42001: PushErrorEnum.TOKEN_EXPIRED,     # access_token expired
+        45009: PushErrorEnum.RATE_LIMITED,      # api freq out of limit
+        45033: PushErrorEnum.RATE_LIMITED,      # api concurrent out of limit
+        40003: PushErrorEnum.INVALID_USER,      # invalid userid
+        81013: PushErrorEnum.INVALID_USER,      # user & party & tag all invalid
+    },
+    AppPlatformEnum.DING_DING.type: {
+        -1: PushErrorEnum.SYSTEM_BUSY,
+        40014: PushErrorEnum.TOKEN_EXPIRED,     # 不合法的access_token
+        42001: PushErrorEnum.TOKEN_EXPIRED,     # access_token超时
+        90002: PushErrorEnum.RATE_LIMITED,      # 服务器繁忙, 调用频率过高
+        90018: PushErrorEnum.RATE_LIMITED,      # 应用调用接口的qps超限
+        33012: PushErrorEnum.INVALID_USER,      # 无效的userid
+    },
+    AppPlatformEnum.FEISHU.type: {
+        99991661: PushErrorEnum.TOKEN_EXPIRED,  # missing access token
+        99991663: PushErrorEnum.TOKEN_EXPIRED,  # invalid tenant access token
+        99991668: PushErrorEnum.TOKEN_EXPIRED,  # invalid access token
+        99991677: PushErrorEnum.TOKEN_EXPIRED,  # access token expired
+        99991400: PushErrorEnum.RATE_LIMITED,   # request trigger frequency limit
+        11232: PushErrorEnum.RATE_LIMITED,      # create message trigger rate limit
+        230013: PushErrorEnum.INVALID_USER,     # bot has no availability to this user
+    },
+}
+
+# Backoff(seconds) by kind: (base, cap), doubled per retry
+BACKOFF_MAPPING = {
+    PushErrorEnum.TOKEN_EXPIRED: (0.5, 5),
+    PushErrorEnum.RATE_LIMITED: (2, 120),
+    PushErrorEnum.SYSTEM_BUSY: (1, 60),
+}
+
+
+def classify_errcode(platform_type, errcode):
+    """ :return: PushErrorEnum or None when succeeded """
+    if errcode == 0:
+        return None
+
+    if errcode == TRANSIENT_ERRCODE:
+        return PushErrorEnum.SYSTEM_BUSY
+
+    return ERRCODE_MAPPING.get(platform_type, {}).get(errcode, PushErrorEnum.PERMANENT)
+
+
+def get_backoff(retries, kind=None):
+    """ Exponential backoff with equal jitter: half of the delay is fixed, the other half random, so the
+        retries of many workers spread out without retrying at once.
+
+    :param retries: int, retries already done
+    :param kind: PushErrorEnum
+    :return: float, countdown seconds
+    """
+    base, cap = BACKOFF_MAPPING.get(kind, BACKOFF_MAPPING[PushErrorEnum.SYSTEM_BUSY])
+    return _equal_jitter(min(cap, base * 2 ** retries))
+
+
+def _equal_jitter(delay):
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+class RetryPolicy:
+    """ Declarative retry of a failed task, given as the `failure_retry` task option(not to be confused with
+        `retry_policy` of apply_async, the retry of the publishing) and resolved once when the task is bound
+
+    Example::
+        @celery_app.task(failure_retry=RetryPolicy(max_attempts=5, retry_on=(redis.RedisError, )))
+        def task_a(**kwargs): ...
+
+        @celery_app.task(failure_retry=dict(max_attempts=2, backoff_base=10))
+        def task_b(**kwargs): ...
+
+        @celery_app.task(bind=True, failure_retry=None)    # No retry by the ContextTask, eg: raise self.retry(...)
+        def task_c(self, **kwargs): ...
+    """
+
+    def __init__(self, max_attempts=3, backoff_base=1, backoff_cap=60, retry_on=(Exception, ), ignore_on=()):
+        """
+        :param max_attempts: int, executions of the task including the first one
+        :param backoff_base: float, countdown(seconds) before the first retry, doubled per retry
+        :param backoff_cap: float, max countdown(seconds)
+        :param retry_on: tuple, exception classes to retry
+        :param ignore_on: tuple, exception classes never retried, even if in `retry_on`
+        """
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retry_on = tuple(retry_on)
+        self.ignore_on = tuple(ignore_on)
+
+    @classmethod
+    def from_option(cls, option):
+        """ :param option: RetryPolicy, dict of the arguments or None(disabled) """
+        if option is None or option is False:
+            return None
+
+        if isinstance(option, cls):
+            return option
+
+        if isinstance(option, dict):
+            return cls(**option)
+
+        raise TypeError("failure_retry must be a RetryPolicy, a dict or None, not %r" % (option, ))
+
+    def is_retryable(self, exc):
+        return isinstance(exc, self.retry_on) and not isinstance(exc, self.ignore_on)
+
+    def get_countdown(self, retries):
+        """ :param retries: int, retries already done """
+        return _equal_jitter(min(self.backoff_cap, self.backoff_base * 2 ** retries))
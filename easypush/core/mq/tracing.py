@@ -0,0 +1,126 @@
+import time
+import random
+import logging
+
+from celery.utils.saferepr import saferepr
+
+from easypush.utils.settings import config
+
+worker_logger = logging.getLogger("celery.worker")
+
+
+class LazyRepr:
+    """ `saferepr` of the payload, only computed when the log record is emitted """
+    __slots__ = ("payload", )
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        return saferepr(self.payload, maxlen=1024)
+
+
+class TaskTracer:
+    """ Structured trace of the task hooks
+
+        One line per hook: `<hook> <task name>[<task id>] <msg>`, the payload(args, kwargs, retval...)
+        is appended only when the logger is enabled for DEBUG or for a `sample_rate` share of the calls,
+        and is formatted by the logging module itself, never for a dropped record.
+
+    Example::
+        >>> tracer.trace(task, "on_success", payload=dict(retval=retval))
+    """
+
+    def __init__(self, logger=None, sample_rate=None):
+        """
+        :param logger: logging.Logger, default `celery.worker`
+        :param sample_rate: float, share of the payloads logged above DEBUG,
+                            default EASYPUSH["task_trace_sample_rate"]
+        """
+        self.logger = logger or worker_logger
+        self.sample_rate = config.task_trace_sample_rate if sample_rate is None else sample_rate
+
+    def with_payload(self):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            return True
+
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def trace(self, task, hook, msg="", payload=None, level=logging.INFO):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        fmt = "ContextTask.%s %s[%s] %s"
+        args = [hook, task.name, task.request.id, msg]
+
+        if payload is not None and self.with_payload():
+            fmt += " -> %s"
+            args.append(LazyRepr(payload))
+
+        self.logger.log(level, fmt, *args)
+
+    @staticmethod
+    def timer():
+        return time.perf_counter()
+
+
+tracer = TaskTracer()
+
+
+def test_by_trace_overhead(count=20000):
+    """ Per-task overhead of the hooks: inspect.stack() + dict(locals()) repr vs the tracer
+        Both log to a logger enabled for INFO whose handler drops the records.
+
+        python -c "import django; django.setup(); \
+            from easypush.core.mq.tracing import test_by_trace_overhead; test_by_trace_overhead()"
+    """
+    import inspect
+    from celery import Celery
+
+    logger = logging.getLogger("easypush.trace.benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    app = Celery("trace_benchmark", broker="memory://")
+    bench_tracer = TaskTracer(logger=logger, sample_rate=0)
+
+    @app.task
+    def add(x, y, **kwargs):
+        return x + y
+
+    def legacy_log(task, log_kwargs, current_running_fun):
+        log_kwargs.pop("self", None)
+        log_kwargs["self_id"] = id(task)
+        log_msg = log_kwargs.pop("log_msg", "")
+        logger.info("{cls}.{fun} {msg} -> {kwargs}".format(
+            cls=task.__class__.__name__, fun=current_running_fun, msg=log_msg, kwargs=log_kwargs
+        ))
+
+    def legacy_hooks(task, args, kwargs):
+        # __call__ start/end, on_success and after_return as before
+        start = time.time()
+        legacy_log(task, dict(request_id=task.request.id, log_msg="Start", args=args, kwargs=kwargs),
+                   inspect.stack()[0][3])
+        retval = task.run(*args, **kwargs)
+        legacy_log(task, dict(request_id=task.request.id, log_msg="End", costTime=time.time() - start),
+                   inspect.stack()[0][3])
+        legacy_log(task, dict(locals(), requestId=task.request.id), inspect.stack()[0][3])
+        legacy_log(task, dict(locals(), requestId=task.request.id), inspect.stack()[0][3])
+
+    def traced_hooks(task, args, kwargs):
+        start = bench_tracer.timer()
+        bench_tracer.trace(task, "__call__", "Start", payload=dict(args=args, kwargs=kwargs), level=logging.DEBUG)
+        retval = task.run(*args, **kwargs)
+        bench_tracer.trace(task, "__call__", "End cost:%.4fs" % (bench_tracer.timer() - start))
+        bench_tracer.trace(task, "on_success", payload=dict(retval=retval), level=logging.DEBUG)
+        bench_tracer.trace(task, "after_return", "SUCCESS", level=logging.DEBUG)
+
+    for name, hooks in [("legacy", legacy_hooks), ("tracer", traced_hooks)]:
+        start_time = time.perf_counter()
+
+        for i in range(count):
+            hooks(add, (i, i), {"msg_uid_list": ["2702976118339", "2702976118349"]})
+
+        cost_time = time.perf_counter() - start_time
+        print("%-6s tasks: %s, cost: %.4fs, per task: %.2fus" % (name, count, cost_time, cost_time / count * 1e6))
@@ -1,12 +1,21 @@
 import json
 import socket
 import ftplib
+import asyncio
+import weakref
 import traceback
 import http.cookiejar
 import urllib.parse
 import urllib.error as error
 import urllib.request as urllib2
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .pool import connection_pool
+
 errors = (error.URLError, error.HTTPError, error.ContentTooShortError) + \
          (socket.gaierror, ) + \
          ftplib.all_errors
@@ -91,11 +100,7 @@ class HttpFactory:
 
         return opener
 
-    def urlopen(self, method="GET"):
-        assert method in ["GET", "POST"], "Method:%s not allowed!" % method
-
-        self._set_opener()
-
+    def _prepare_request(self):
         url = self.url
         data = self.data
         params = urllib.parse.urlencode(self.params)
@@ -114,9 +119,107 @@ class HttpFactory:
             else:
                 data = urllib.parse.urlencode(data).encode("utf-8")
 
+        return url, data
+
+    def urlopen(self, method="GET"):
+        assert method in ["GET", "POST"], "Method:%s not allowed!" % method
+
+        self._set_opener()
+        url, data = self._prepare_request()
+
         request = urllib2.Request(url, data=data, headers=self.headers, method=method)
         try:
             self._response = urllib2.urlopen(request)
         except errors:
             traceback.format_exc()
 
+
+class PooledHttpFactory(HttpFactory):
+    """ Same interface as `HttpFactory`, but sockets are kept alive and reused through `pool` """
+
+    def __init__(self, url, params=None, headers=None, timeout=None, pool=None, **kwargs):
+        super().__init__(url, params=params, headers=headers, timeout=timeout, **kwargs)
+        self.pool = pool or connection_pool
+        self.add_headers(key="Connection", value="keep-alive")
+
+    def urlopen(self, method="GET"):
+        assert method in ["GET", "POST"], "Method:%s not allowed!" % method
+
+        url, data = self._prepare_request()
+        response = self.pool.urlopen(method, url, body=data, headers=self.headers, timeout=self.timeout)
+
+        if response.status >= 400 and not self.ignore_error:
+            raise error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+        self._response = response
+
+
+class AsyncHttpFactory(HttpFactory):
+    """ Coroutine version of `HttpFactory` backed by `aiohttp`
+
+    One `aiohttp.ClientSession` (keep-alive connector) is shared by all requests of the same event loop,
+    so a single loop can keep hundreds of platform requests in flight.
+    """
+    CONNECTOR_LIMIT = 200
+    CONNECTOR_LIMIT_PER_HOST = 100
+    KEEPALIVE_TIMEOUT = 60
+
+    _sessions = weakref.WeakKeyDictionary()
+
+    def __init__(self, url, params=None, headers=None, timeout=None, **kwargs):
+        if aiohttp is None:
+            raise ImportError("AsyncHttpFactory requires `aiohttp`, please `pip install easypush[async]`")
+
+        super().__init__(url, params=params, headers=headers, timeout=timeout, **kwargs)
+
+    @classmethod
+    def get_session(cls):
+        loop = asyncio.get_running_loop()
+        session = cls._sessions.get(loop)
+
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=cls.CONNECTOR_LIMIT, limit_per_host=cls.CONNECTOR_LIMIT_PER_HOST,
+                keepalive_timeout=cls.KEEPALIVE_TIMEOUT,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            cls._sessions[loop] = session
+
+        return session
+
+    @classmethod
+    async def close_session(cls):
+        """ Close the session of the running loop, call it before the loop is closed """
+        session = cls._sessions.pop(asyncio.get_running_loop(), None)
+
+        if session is not None:
+            await session.close()
+
+    async def get(self):
+        await self.urlopen(method="GET")
+        return self._response
+
+    async def post(self, data=None):
+        self.data = data
+        await self.urlopen(method="POST")
+
+        return self._response
+
+    async def urlopen(self, method="GET"):
+        assert method in ["GET", "POST"], "Method:%s not allowed!" % method
+
+        url, data = self._prepare_request()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        session = self.get_session()
+
+        async with session.request(method, url, data=data, headers=self.headers, timeout=timeout) as response:
+            if response.status >= 400 and not self.ignore_error:
+                raise error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+            raw_content = await response.read()
+            content_type = response.headers.get("Content-Type", "")
+
+            if "application/json" in content_type:
+                self._response = json.loads(raw_content)
+            else:
+                self._response = raw_content.decode(response.charset or "utf-8")
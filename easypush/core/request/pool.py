@@ -0,0 +1,211 @@
+import ssl
+import time
+import select
+import threading
+import http.client
+import urllib.parse
+
+__all__ = ["HttpConnectionPool", "PoolTimeoutError", "connection_pool"]
+
+# Errors raised when the server has silently closed an idle keep-alive connection
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected, http.client.CannotSendRequest,
+    http.client.BadStatusLine, ConnectionResetError, BrokenPipeError,
+)
+
+# Sent again when a stale connection fails after the request was written, the server may have processed it
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+
+class PoolTimeoutError(Exception):
+    """ No connection of the host pool became free in time """
+
+
+class PooledResponse:
+    """ Fully read response, the socket has already been given back to the pool """
+
+    def __init__(self, status, reason, headers, content):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._content = content
+
+    def read(self):
+        return self._content
+
+    def close(self):
+        pass
+
+
+class _HostPool:
+    def __init__(self, scheme, host, port, maxsize, idle_timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+
+        self._idle = []             # LIFO stack of (connection, last_used_timestamp)
+        self._created = 0
+        self._cond = threading.Condition()
+
+    def _new_connection(self, timeout):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(
+                self.host, self.port, timeout=timeout, context=ssl.create_default_context()
+            )
+
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    @staticmethod
+    def _is_dropped(conn):
+        """ An idle socket readable before any request: the server sent FIN(or garbage), don't reuse it """
+        if conn.sock is None:
+            return True
+
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+
+        return bool(readable)
+
+    def _evict_idle(self, now):
+        """ Close connections idle for longer than `idle_timeout` or closed by the server, must hold `self._cond` """
+        alive = []
+
+        for conn, last_used in self._idle:
+            if now - last_used > self.idle_timeout or self._is_dropped(conn):
+                conn.close()
+                self._created -= 1
+            else:
+                alive.append((conn, last_used))
+
+        self._idle = alive
+
+    def acquire(self, timeout, block_timeout):
+        """ :return: (connection, is_reused) """
+        deadline = time.monotonic() + block_timeout
+
+        with self._cond:
+            while True:
+                self._evict_idle(time.monotonic())
+
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+
+                if self._created < self.maxsize:
+                    self._created += 1
+                    return self._new_connection(timeout), False
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeoutError("%s://%s:%s pool exhausted(maxsize:%s)" % (
+                        self.scheme, self.host, self.port, self.maxsize))
+
+                self._cond.wait(remaining)
+
+    def release(self, conn, reusable=True):
+        with self._cond:
+            if reusable:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                conn.close()
+                self._created -= 1
+
+            self._cond.notify()
+
+    def clear(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                conn.close()
+                self._created -= 1
+
+            self._idle = []
+            self._cond.notify_all()
+
+
+class HttpConnectionPool:
+    """ Thread-safe keep-alive connection pool, one bounded pool per (scheme, host, port)
+
+    Connections are reused in LIFO order so that the hottest socket is used first, and the
+    ones idle for more than `idle_timeout` seconds are closed lazily on the next acquire.
+    """
+    DEFAULT_MAXSIZE = 10
+    DEFAULT_IDLE_TIMEOUT = 60
+    DEFAULT_BLOCK_TIMEOUT = 10
+
+    def __init__(self, maxsize=None, idle_timeout=None, block_timeout=None):
+        self.maxsize = maxsize or self.DEFAULT_MAXSIZE
+        self.idle_timeout = idle_timeout or self.DEFAULT_IDLE_TIMEOUT
+        self.block_timeout = block_timeout or self.DEFAULT_BLOCK_TIMEOUT
+
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get_host_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        pool = self._pools.get(key)
+
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+
+                if pool is None:
+                    pool = _HostPool(scheme, host, port, self.maxsize, self.idle_timeout)
+                    self._pools[key] = pool
+
+        return pool
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=None):
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+
+        host_pool = self.get_host_pool(scheme, parts.hostname, port)
+        conn, is_reused = host_pool.acquire(timeout, self.block_timeout)
+
+        try:
+            response = self._send(conn, is_reused, method, path, body, headers)
+            content = response.read()
+        except Exception:
+            # Timeout or IncompleteRead of the body as well: the connection is dropped, never leaked
+            host_pool.release(conn, reusable=False)
+            raise
+
+        host_pool.release(conn, reusable=not response.will_close)
+
+        return PooledResponse(response.status, response.reason, response.headers, content)
+
+    @staticmethod
+    def _send(conn, is_reused, method, path, body, headers):
+        """ A reused connection closed by the server is retried once with a fresh socket: always when the
+            request could not be written, only for the idempotent methods when it failed after(eg: a POST
+            sending messages may have been processed).
+        """
+        is_written = False
+
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            is_written = True
+            return conn.getresponse()
+        except STALE_CONNECTION_ERRORS:
+            if not is_reused or (is_written and method.upper() not in IDEMPOTENT_METHODS):
+                raise
+
+        conn.close()
+        conn.request(method, path, body=body, headers=headers or {})
+        return conn.getresponse()
+
+    def clear(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.clear()
+
+
+connection_pool = HttpConnectionPool()
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from easypush.serializers import AppMsgPushRecordSerializer
+
+
+class Command(BaseCommand):
+    help = "Rebuild the message fingerprints and the log fingerprint bloom filter from the pushed logs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None, help="Days of history, default the bloom window")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Rows fetched per query")
+        parser.add_argument("--raw-sql", action="store_true", help="Query the logs with native sql")
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+
+        msg_cnt, log_cnt = AppMsgPushRecordSerializer().rebuild_fingerprints(
+            days=options["days"], chunk_size=options["chunk_size"], is_raw_sql=options["raw_sql"]
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            "Fingerprints rebuilt: %s messages, %s logs, cost %.2fs" % (msg_cnt, log_cnt, time.time() - start_time)
+        ))
@@ -0,0 +1,43 @@
+# Generated by Django 4.1.3 on 2026-10-17 13:17
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def backfill_fingerprint(apps, schema_editor):
+    """ md5 of `msg_body_json`, the same as `AppMsgPushRecordSerializer.get_fingerprint` """
+    AppMessageModel = apps.get_model("easypush", "AppMessageModel")
+    queryset = AppMessageModel.objects.filter(fingerprint="").only("id", "msg_body_json")
+
+    batch = []
+    for msg_obj in queryset.iterator(chunk_size=2000):
+        msg_obj.fingerprint = hashlib.md5(msg_obj.msg_body_json.encode("utf-8")).hexdigest()
+        batch.append(msg_obj)
+
+        if len(batch) >= 2000:
+            AppMessageModel.objects.bulk_update(batch, ["fingerprint"])
+            batch = []
+
+    if batch:
+        AppMessageModel.objects.bulk_update(batch, ["fingerprint"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('easypush', '0008_celerytaskresultalertmodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appmessagemodel',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=100, verbose_name='消息指纹'),
+        ),
+        migrations.AddIndex(
+            model_name='appmessagemodel',
+            index=models.Index(fields=['app', 'fingerprint'], name='easypush_msg_app_fp_idx'),
+        ),
+        migrations.RunPython(backfill_fingerprint, migrations.RunPython.noop),
+    ]
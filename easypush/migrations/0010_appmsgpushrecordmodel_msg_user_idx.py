@@ -0,0 +1,17 @@
+# Generated by Django 4.1.3 on 2026-10-17 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('easypush', '0009_appmessagemodel_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appmsgpushrecordmodel',
+            index=models.Index(fields=['app_msg_id', 'receiver_userid'], name='easypush_log_msg_user_idx'),
+        ),
+    ]
@@ -118,11 +118,12 @@ class AppMessageModel(BaseAbstractModel):
     msg_type = models.CharField(verbose_name="消息类型", max_length=50, choices=MSG_CHOICES, default=0, blank=True)
     msg_body_json = models.CharField(verbose_name="消息JSON数据", max_length=2000, default="", blank=True)
     platform_type = models.CharField(verbose_name="平台类型", max_length=100, choices=PLATFORM_CHOICES, default="")
-    # fingerprint = models.CharField(verbose_name="消息指纹", max_length=100, default="", blank=True)
+    fingerprint = models.CharField(verbose_name="消息指纹", max_length=100, default="", blank=True)
     remark = models.CharField(verbose_name="说明", max_length=200, default="", blank=True)
 
     class Meta:
         db_table = "easypush_app_message_info"
+        indexes = [models.Index(fields=["app", "fingerprint"], name="easypush_msg_app_fp_idx")]
 
     def __str__(self):
         return "Message<Id:%s %s %s>" % (self.id, self.msg_type, self.platform_type)
@@ -165,3 +166,5 @@ class AppMsgPushRecordModel(BaseAbstractModel):
 
     class Meta:
         db_table = "easypush_app_msg_push_log"
+        # Confirms the positives of the log fingerprint bloom filter
+        indexes = [models.Index(fields=["app_msg_id", "receiver_userid"], name="easypush_log_msg_user_idx")]
@@ -2,18 +2,24 @@ import time
 import json
 import logging
 import traceback
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 from django.contrib.auth import get_user_model
 from django.db import connections
 from django.db.utils import DEFAULT_DB_ALIAS
+from django.utils.dateparse import parse_datetime
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from django_redis import get_redis_connection
 
 from . import models
 from .core.crypto import BaseCipher
-from .utils.snowflake import IdGenerator
+from .core.cache.bloom import get_log_fingerprint_filter
+from .core.cache.fingerprint import FingerprintStore
+from .utils.settings import config, DEFAULTS
+from .utils.constants import MessagePriorityEnum
+from .utils.worker_id import get_id_generator
 
 
 USER_MODEL = get_user_model()
@@ -80,41 +86,74 @@ class ListAppMsgPushRecordSerializer(serializers.ListSerializer):
 
         bulk_obj_list = []
         fingerprint_mapping = {}  # Message body and log fingerprint mapping
+        msg_uid_list = get_id_generator().get_ids(len(self.initial_data))  # Reserve all uid at once
 
-        # Save message and log into database
+        # Clean data and compute all the fingerprint keys first
+        cleaned_list = []
         for index, init_data in enumerate(self.initial_data):
             valid_data = validated_data[index]
             app_obj = app_mapping[agent_id_list[index]]
-            new_validated_data = self.child.clean_data(dict(valid_data, app_obj=app_obj, **init_data))
+            new_validated_data = self.child.clean_data(
+                dict(valid_data, app_obj=app_obj, **init_data), msg_uid=msg_uid_list[index]
+            )
 
             # message body fingerprint
-            app_id = app_obj.id
             message_fingerprint = self.child.get_fingerprint(new_validated_data)
-            fp_kwargs = dict(app_id=app_id, msg_fingerprint=message_fingerprint)
+            new_validated_data["fingerprint"] = message_fingerprint
+            fp_kwargs = dict(app_id=app_obj.id, msg_fingerprint=message_fingerprint)
             msg_fingerprint_key = self.child.APP_MSG_FINGERPRINT_KEY.format(**fp_kwargs)  # message body fingerprint key
 
-            app_msg_id = fingerprint_mapping.get(msg_fingerprint_key)
-            app_msg_id = app_msg_id or self.child.get_cache_from_redis(key=msg_fingerprint_key)
-
-            if not app_msg_id:
-                app_msg_obj = models.AppMessageModel.create_object(**new_validated_data)
-                app_msg_id = app_msg_obj.id
-                fingerprint_mapping[msg_fingerprint_key] = app_msg_id
-
             # message log fingerprint key
             fp_kwargs["userid"] = new_validated_data["receiver_userid"]
             log_fingerprint_key = self.child.APP_LOG_FINGERPRINT_KEY.format(**fp_kwargs)
-            has_log_fp_key = fingerprint_mapping.get(log_fingerprint_key)
-            has_log_fp_key = has_log_fp_key or self.child.get_cache_from_redis(key=log_fingerprint_key)
 
-            if not has_log_fp_key:
-                new_validated_data["app_msg_id"] = app_msg_id
-                log_instance = PUSH_LOG_MODEL.create_object(force_insert=False, **new_validated_data)
-                fingerprint_mapping[log_fingerprint_key] = log_instance.msg_uid
-                bulk_obj_list.append(log_instance)
+            cleaned_list.append((new_validated_data, msg_fingerprint_key, log_fingerprint_key))
+
+        # One round trip for all the message fingerprints
+        cache_mapping = self.child.get_many_from_redis([msg_key for _, msg_key, _ in cleaned_list])
+
+        # Out of the redis cache: the latest message of the same body, its logs may still be in the dedup window
+        db_msg_mapping = self.child.get_message_ids({
+            msg_key: (new_validated_data["app_id"], new_validated_data["fingerprint"])
+            for new_validated_data, msg_key, _ in cleaned_list if msg_key not in cache_mapping
+        })
+        cache_mapping.update(db_msg_mapping)
+        fingerprint_mapping.update(db_msg_mapping)  # Cached again
+
+        # Save the new message bodies with one INSERT
+        new_msg_mapping = {}
+        for new_validated_data, msg_fingerprint_key, _ in cleaned_list:
+            if msg_fingerprint_key not in cache_mapping and msg_fingerprint_key not in new_msg_mapping:
+                new_msg_mapping[msg_fingerprint_key] = new_validated_data
+
+        app_msg_objs = models.AppMessageModel.bulk_create_objects(
+            list(new_msg_mapping.values()), lookup_fields=("app_id", "fingerprint")
+        )
+        fingerprint_mapping.update({key: obj.id for key, obj in zip(new_msg_mapping, app_msg_objs)})
+
+        # Logs of a new message body(neither cached nor in the database) can not exist yet, only check the others
+        existing_log_keys = self.child.get_existing_log_keys([
+            (log_key, cache_mapping[msg_key], new_validated_data["receiver_userid"])
+            for new_validated_data, msg_key, log_key in cleaned_list if msg_key in cache_mapping
+        ])
+
+        # Save message log into database
+        new_log_keys = []
+        for new_validated_data, msg_fingerprint_key, log_fingerprint_key in cleaned_list:
+            if log_fingerprint_key in existing_log_keys:
+                continue
+
+            app_msg_id = fingerprint_mapping.get(msg_fingerprint_key) or cache_mapping.get(msg_fingerprint_key)
+            new_validated_data["app_msg_id"] = app_msg_id
+            log_instance = PUSH_LOG_MODEL.create_object(force_insert=False, **new_validated_data)
+
+            existing_log_keys.add(log_fingerprint_key)
+            new_log_keys.append(log_fingerprint_key)
+            bulk_obj_list.append(log_instance)
 
         instance_list = PUSH_LOG_MODEL.objects.bulk_create(bulk_obj_list)
         self.child.batch_insert_fingerprint(fingerprint_mapping)
+        self.child.add_log_fingerprints(new_log_keys)
         return instance_list
 
 
@@ -122,6 +161,7 @@ class AppMsgPushRecordSerializer(serializers.ModelSerializer):
     MAX_SIZE_TO_MQ = 100
     MAX_BATCH_SIZE = 2000
     DEFAULT_EXPIRE = 7 * 60 * 60
+    FINGERPRINT_MSG_CACHE_SIZE = 100000
 
     APP_MSG_FINGERPRINT_KEY = "app_id:{app_id}:msg_fingerprint:{msg_fingerprint}"
     APP_LOG_FINGERPRINT_KEY = "app_id:{app_id}:msg_fingerprint:{msg_fingerprint}:userid:{userid}"
@@ -152,6 +192,7 @@ class AppMsgPushRecordSerializer(serializers.ModelSerializer):
         :return:
         """
         is_async = data.pop("is_async", True)
+        priority = data.pop("priority", None)
 
         # First to save message into db
         # Split `receiver_userid`, Determine whether to send in batch
@@ -160,6 +201,7 @@ class AppMsgPushRecordSerializer(serializers.ModelSerializer):
 
         many = len(userid_list) > 1
         max_batch_size = cls.MAX_BATCH_SIZE
+        priority = cls.get_priority(priority, receiver_cnt=len(userid_list))
 
         if many:
             if not userid_list:
@@ -181,13 +223,77 @@ class AppMsgPushRecordSerializer(serializers.ModelSerializer):
         instance = serializer.save()
         instance_list = instance if isinstance(instance, list) else [instance]
 
+        if not instance_list:
+            # Duplicates only: every receiver already got this message in the dedup window
+            logger.info("async_send_mq => Nothing new to push, receivers: %s", len(userid_list))
+            return
+
         # Second to asynchronously push messages into MQ
-        for i in range(0, len(instance_list), max_batch_size):
-            slice_instances = instance_list[i: i + cls.MAX_SIZE_TO_MQ]
-            msg_uid_list = [msg_obj.msg_uid for msg_obj in slice_instances]
+        msg_uid_list = [msg_obj.msg_uid for msg_obj in instance_list]
+        cls.fan_out(
+            msg_uid_list, task_fun,
+            platform_type=instance_list[0].platform_type, is_async=is_async, priority=priority
+        )
 
-            invoke_func = task_fun.delay if is_async else task_fun.run
-            invoke_func(msg_uid_list=msg_uid_list)
+    @classmethod
+    def get_mq_chunk_size(cls, platform_type=None):
+        """ Receivers per MQ message, the recipient limit of one platform api call """
+        chunk_sizes = dict(DEFAULTS["mq_chunk_size"], **config.mq_chunk_size)
+        return chunk_sizes.get(platform_type) or cls.MAX_SIZE_TO_MQ
+
+    @classmethod
+    def get_priority(cls, priority=None, receiver_cnt=0):
+        """ :return: MessagePriorityEnum, without priority a message above `mq_bulk_threshold` receivers is bulk """
+        if isinstance(priority, MessagePriorityEnum):
+            return priority
+
+        if priority:
+            try:
+                return MessagePriorityEnum.get_priority_enum(priority)
+            except ValueError as e:
+                raise ValidationError(str(e))
+
+        if receiver_cnt > config.mq_bulk_threshold:
+            return MessagePriorityEnum.BULK
+
+        return MessagePriorityEnum.NORMAL
+
+    @classmethod
+    def get_mq_route(cls, priority=None):
+        """ Options(queue, routing_key) of the priority lane, empty: routed by CELERY_ROUTES """
+        priority = cls.get_priority(priority)
+        return dict(config.mq_priority_routes.get(priority.type) or {})
+
+    @classmethod
+    def fan_out(cls, msg_uid_list, task_fun, platform_type=None, is_async=True, priority=None):
+        """ Split the push logs into chunks of the platform limit, one task per chunk
+
+        :param msg_uid_list: list, `msg_uid` of the push logs
+        :param task_fun: decorator function of Celery.task
+        :param platform_type: str, see `AppPlatformEnum`
+        :param is_async: bool, False runs the task in the current process
+        :param priority: str or MessagePriorityEnum, lane(queue) of the tasks, see `get_priority`
+        :return: int, count of the tasks
+        """
+        chunk_size = cls.get_mq_chunk_size(platform_type)
+        chunks = [msg_uid_list[i: i + chunk_size] for i in range(0, len(msg_uid_list), chunk_size)]
+
+        if not is_async:
+            for chunk in chunks:
+                task_fun.run(msg_uid_list=chunk)
+
+            return len(chunks)
+
+        # All the chunks are published through one producer(broker connection), to the queue of the lane
+        priority = cls.get_priority(priority, receiver_cnt=len(msg_uid_list))
+        route_options = cls.get_mq_route(priority)
+
+        with task_fun.app.producer_or_acquire() as producer:
+            for chunk in chunks:
+                task_kwargs = dict(msg_uid_list=chunk, priority=priority.type)
+                task_fun.apply_async(kwargs=task_kwargs, producer=producer, **route_options)
+
+        return len(chunks)
 
     def get_fingerprint(self, validated_data=None):
         """ Unique message fingerprint """
@@ -230,10 +336,77 @@ class AppMsgPushRecordSerializer(serializers.ModelSerializer):
         redis_conn = get_redis_connection()
         value = redis_conn.get(key)
 
+        return self._to_cache_value(value)
+
+    def get_many_from_redis(self, keys):
+        """ Resolve fingerprint keys with one `MGET`
+        :return: dict, key: cached value, missing keys are not included
+        """
+        keys = list(dict.fromkeys(keys))  # Unique and keep order
+        if not keys:
+            return {}
+
+        values = FingerprintStore().get_many(keys)
+        return {key: self._to_cache_value(value) for key, value in zip(keys, values) if value is not None}
+
+    @staticmethod
+    def _to_cache_value(value):
         return int(value) if isinstance(value, (str, bytes)) and value.isdigit() else value
 
-    def clean_data(self, data):
-        id_yield = IdGenerator(1, 1)
+    def get_message_ids(self, msg_items):
+        """ Latest message of the same body for the fingerprints out of the redis cache
+        :param msg_items: dict, {message fingerprint key: (app_id, msg_fingerprint)}
+        :return: dict, {message fingerprint key: app_msg_id}, missing when never saved
+        """
+        if not msg_items:
+            return {}
+
+        query = dict(
+            app_id__in={app_id for app_id, _ in msg_items.values()},
+            fingerprint__in={msg_fingerprint for _, msg_fingerprint in msg_items.values()},
+            is_del=False,
+        )
+        queryset = models.AppMessageModel.objects.filter(**query).order_by("id")
+        rows = queryset.values_list("id", "app_id", "fingerprint")
+        latest_mapping = {(app_id, msg_fingerprint): msg_id for msg_id, app_id, msg_fingerprint in rows}
+
+        return {key: latest_mapping[item] for key, item in msg_items.items() if item in latest_mapping}
+
+    def get_existing_log_keys(self, log_items):
+        """ Logs already pushed in the bloom filter window
+        :param log_items: list of (log fingerprint key, app_msg_id, receiver_userid)
+        :return: set, log fingerprint keys
+        """
+        if not log_items:
+            return set()
+
+        bloom = get_log_fingerprint_filter()
+        hits = bloom.contains_many([item[0] for item in log_items])
+        maybe_items = [item for item, hit in zip(log_items, hits) if hit]
+
+        if not maybe_items:
+            return set()
+
+        # Bloom filter has false positives: confirm them with one query
+        query = dict(
+            app_msg_id__in={item[1] for item in maybe_items},
+            receiver_userid__in={item[2] for item in maybe_items},
+            send_time__gte=datetime.now() - timedelta(days=bloom.days),
+        )
+        sent_pairs = set(self.Meta.model.objects.filter(**query).values_list("app_msg_id", "receiver_userid"))
+
+        return {key for key, app_msg_id, userid in maybe_items if (int(app_msg_id), userid) in sent_pairs}
+
+    def add_log_fingerprints(self, log_fingerprint_keys, when=None):
+        if not log_fingerprint_keys:
+            return
+
+        try:
+            get_log_fingerprint_filter().add_many(log_fingerprint_keys, when=when)
+        except Exception as e:
+            logger.error(traceback.format_exc())
+
+    def clean_data(self, data, msg_uid=None):
         app_obj = data.get("app_obj")
         msg_body_json = data.get("msg_body_json")
 
@@ -244,101 +417,171 @@ class AppMsgPushRecordSerializer(serializers.ModelSerializer):
             app_id=app_obj.id, sender="sys", send_time=datetime.now(),
             receiver_mobile=data.get("receiver_mobile", ""),
             receiver_userid=data.get("receiver_userid", ""),
-            is_read=False, is_success=False, msg_uid=id_yield.get_id(),
+            is_read=False, is_success=False, msg_uid=msg_uid or get_id_generator().get_id(),
             msg_type=data.get("msg_type"), platform_type=app_obj.platform_type,
             msg_body_json=json.dumps(msg_body_json, sort_keys=True),
         )
 
         return cleaned_data
 
-    def get_fingerprints_history(self, days=30, is_raw_sql=False):
-        """ Used for filtering to obtain the fingerprint of messages sent in the last 30 days.
-            If rapid filtration is achieved: Bloom filtration
+    def iter_fingerprints_history(self, days=30, chunk_size=5000, is_raw_sql=False):
+        """ Stream the fingerprints of the logs sent in the last `days` at constant memory:
+            the log table is walked by id ranges(keyset pagination), the message fingerprints are
+            computed once per `app_msg_id` and kept in a bounded LRU cache.
 
         :param days: int
+        :param chunk_size: int, logs per query
         :param is_raw_sql: bool, Whether to use native sql query
+        :return: generator, per chunk: ({message fingerprint key: app_msg_id}, [(log fingerprint key, log id, send_time)])
         """
-        fingerprint_mapping = {}
-        model_cls = self.Meta.model
+        msg_cache = OrderedDict()  # app_msg_id: (app_id, msg_fingerprint)
+        recent_sent_time = datetime.now() - timedelta(days=days)
+        last_id = 0
 
-        # Message body and related applications
-        msg_fields = ["id", "app_id", "msg_body_json"]
-        log_fields = ["id", "app_msg_id", "receiver_mobile"]
+        while True:
+            log_rows = self._get_log_rows(last_id, recent_sent_time, chunk_size, is_raw_sql)
+            if not log_rows:
+                return
+
+            last_id = log_rows[-1][0]
+            new_msg_ids = self._cache_msg_fingerprints(msg_cache, {row[1] for row in log_rows}, is_raw_sql)
+
+            msg_mapping = {}
+            log_items = []
+
+            for log_id, app_msg_id, userid, send_time in log_rows:
+                if app_msg_id not in msg_cache:
+                    continue  # Message deleted
+
+                app_id, msg_fingerprint = msg_cache[app_msg_id]
+                fp_kwargs = dict(app_id=app_id, msg_fingerprint=msg_fingerprint, userid=userid)
+
+                if app_msg_id in new_msg_ids:
+                    msg_mapping[self.APP_MSG_FINGERPRINT_KEY.format(**fp_kwargs)] = app_msg_id
+
+                if isinstance(send_time, str):
+                    send_time = parse_datetime(send_time)
+
+                log_items.append((self.APP_LOG_FINGERPRINT_KEY.format(**fp_kwargs), log_id, send_time))
+
+            yield msg_mapping, log_items
+
+            # Evicted once the chunk is done, the messages of the current chunk are always at hand
+            while len(msg_cache) > self.FINGERPRINT_MSG_CACHE_SIZE:
+                msg_cache.popitem(last=False)
+
+            if len(log_rows) < chunk_size:
+                return
+
+    def _get_log_rows(self, last_id, recent_sent_time, chunk_size, is_raw_sql=False):
+        model_cls = self.Meta.model
+        log_fields = ["id", "app_msg_id", "receiver_userid", "send_time"]
 
         if not is_raw_sql:
-            msg_queryset = models.AppMessageModel.objects.filter(is_del=False).values(*msg_fields)
-            msg_mappings = {msg_item["id"]: msg_item for msg_item in msg_queryset}
-        else:
-            sql_where = "where is_del=false "
-            msg_sql = "SELECT %s FROM %s ".format(", ".join(msg_fields), models.AppMessageModel._meta.db_table)
-            msg_queryset = self.query_by_sql(msg_sql + sql_where, columns=msg_fields)
-            msg_mappings = {msg_item["id"]: msg_item for msg_item in msg_queryset}
+            log_queryset = model_cls.objects\
+                .filter(id__gt=last_id, send_time__gte=recent_sent_time, is_del=False)\
+                .order_by("id")\
+                .values_list(*log_fields)[:chunk_size]
+
+            return list(log_queryset.iterator(chunk_size=chunk_size))
 
-        # Filter the corresponding message record
-        app_msg_ids = list(msg_mappings.keys())
-        recent_sent_time = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        log_msg_sql = "SELECT {fields} FROM {table} WHERE id > %s AND send_time >= %s AND is_del = %s " \
+                      "ORDER BY id LIMIT %s".format(fields=", ".join(log_fields), table=model_cls._meta.db_table)
+        params = [last_id, recent_sent_time, False, chunk_size]
+        log_queryset = self.query_by_sql(log_msg_sql, params=params, columns=log_fields)
+
+        return [tuple(log_items[name] for name in log_fields) for log_items in log_queryset]
+
+    def _cache_msg_fingerprints(self, msg_cache, app_msg_ids, is_raw_sql=False):
+        """ Load the missing message fingerprints into the LRU `msg_cache`
+        :return: set, app_msg_id newly loaded
+        """
+        for app_msg_id in app_msg_ids & set(msg_cache):
+            msg_cache.move_to_end(app_msg_id)
+
+        missing_msg_ids = [app_msg_id for app_msg_id in app_msg_ids if app_msg_id not in msg_cache]
+        if not missing_msg_ids:
+            return set()
+
+        msg_fields = ["id", "app_id", "msg_body_json"]
 
         if not is_raw_sql:
-            orm_query = dict(app_msg_id__in=app_msg_ids, send_time__gt=recent_sent_time)
-            log_queryset = model_cls.objects.filter(**orm_query).values(*log_fields)
+            msg_queryset = models.AppMessageModel.objects\
+                .filter(id__in=missing_msg_ids, is_del=False)\
+                .values(*msg_fields)
         else:
-            sql_where = " where send_time >= '%s' " % recent_sent_time
-            sql_where += " app_msg_id in (%s) " % ",".join([str(did) for did in app_msg_ids])
+            msg_sql = "SELECT {fields} FROM {table} WHERE is_del = %s AND id IN ({ids})".format(
+                fields=", ".join(msg_fields), table=models.AppMessageModel._meta.db_table,
+                ids=", ".join(["%s"] * len(missing_msg_ids)),
+            )
+            msg_queryset = self.query_by_sql(msg_sql, params=[False] + missing_msg_ids, columns=msg_fields)
 
-            log_msg_sql = "SELECT %s FROM %s ".format(",".join(log_fields), model_cls._meta.db_table)
-            log_queryset = self.query_by_sql(log_msg_sql + sql_where, columns=log_fields)
+        new_msg_ids = set()
+        for msg_items in msg_queryset:
+            msg_cache[msg_items["id"]] = (msg_items["app_id"], self.get_fingerprint(validated_data=msg_items))
+            new_msg_ids.add(msg_items["id"])
 
-        for log_items in log_queryset:
-            log_id = log_items["id"]
-            app_msg_id = log_items["app_msg_id"]
-            mobile = log_items["receiver_mobile"]
+        return new_msg_ids
 
-            if app_msg_id in msg_mappings:
-                msg_items = msg_mappings[app_msg_id]
-                msg_fingerprint = self.get_fingerprint(validated_data=dict(zip(msg_fields, msg_items)))
+    def get_fingerprints_history(self, days=30, is_raw_sql=False):
+        """ Used for filtering to obtain the fingerprint of messages sent in the last 30 days.
+            The whole history is held in memory, use `rebuild_fingerprints` to re-index into redis.
 
-                fp_kwargs = dict(app_id=msg_items["app_id"], msg_fingerprint=msg_fingerprint, mobile=mobile)
-                fingerprint_mapping[self.APP_LOG_FINGERPRINT_KEY.format(**fp_kwargs)] = log_id
-                fingerprint_mapping[self.APP_MSG_FINGERPRINT_KEY.format(**fp_kwargs)] = app_msg_id
+        :param days: int
+        :param is_raw_sql: bool, Whether to use native sql query
+        """
+        fingerprint_mapping = {}
+
+        for msg_mapping, log_items in self.iter_fingerprints_history(days=days, is_raw_sql=is_raw_sql):
+            fingerprint_mapping.update(msg_mapping)
+            fingerprint_mapping.update({log_fingerprint_key: log_id for log_fingerprint_key, log_id, _ in log_items})
 
         return fingerprint_mapping
 
-    def batch_insert_fingerprint(self, fingerprint_mapping=None, timeout=None):
+    def rebuild_fingerprints(self, days=None, chunk_size=5000, is_raw_sql=False):
+        """ Re-index the history into redis chunk by chunk: message fingerprints into the
+            `FingerprintStore`, log fingerprints into the bloom filter bucket of their send time
+
+        :return: tuple, (message count, log count)
         """
-        :param fingerprint_mapping: dict,
-        :param timeout: int, expire time to redis key
+        store = FingerprintStore(timeout=self.DEFAULT_EXPIRE)
+        bloom = get_log_fingerprint_filter()
+        msg_cnt, log_cnt = 0, 0
 
-        Note that: Using pipeline is better than setting the expiration time for a single time,
-                   but it is still slow when the data volume is large
+        history = self.iter_fingerprints_history(days=days or bloom.days, chunk_size=chunk_size, is_raw_sql=is_raw_sql)
+        for msg_mapping, log_items in history:
+            msg_cnt += store.set_many(msg_mapping)
 
-            with redis_conn.pipeline(transaction=False) as p:
-                for key, value in bulk_mappings.items():
-                    # redis_conn.set(key, value, expire_time)
-                    redis_conn.expire(key, expire_time)
+            bucket_mapping = {}
+            for log_fingerprint_key, _, send_time in log_items:
+                bucket_key = bloom.get_bucket_key(send_time)
+                bucket_mapping.setdefault(bucket_key, (send_time, []))[1].append(log_fingerprint_key)
 
-                p.execute()  # batch execution
+            for send_time, log_fingerprint_keys in bucket_mapping.values():
+                bloom.add_many(log_fingerprint_keys, when=send_time)
 
-        Redis-cli: redis-cli -h [ip] -p [port] -a [pwd] keys "key_*" | xargs -i redis-cli -h ip -p [port] -a [pwd] expire {} [seconds]
-               eg: redis-cli -h 127.0.0.1 -p 6481 -a 123456 keys "falconSing*" | xargs -i redis-cli -h 127.0.0.1 -p 6481 -a pxf12t expire {} 3600
+            log_cnt += len(log_items)
+
+        logger.info("rebuild_fingerprints => messages: %s, logs: %s", msg_cnt, log_cnt)
+        return msg_cnt, log_cnt
+
+    def batch_insert_fingerprint(self, fingerprint_mapping=None, timeout=None, chunk_size=None):
         """
-        redis_conn = get_redis_connection()
-        expire_lua = """
-            for i=1, ARGV[1], 1 do
-                redis.call("EXPIRE", KEYS[i], ARGV[2]);
-            end
+        :param fingerprint_mapping: dict,
+        :param timeout: int, expire time to redis key
+        :param chunk_size: int, `SET key value EX timeout` commands per pipeline
+
+        Note that: Former MSET + a Lua script looping EXPIRE over all the keys blocked redis for large batches,
+                   see `easypush.core.cache.fingerprint.test_by_pipeline_vs_lua`
         """
-        timeout = timeout or self.DEFAULT_EXPIRE
         bulk_fingerprint_mapping = dict(fingerprint_mapping or {})
 
         if not bulk_fingerprint_mapping:
             return
 
         try:
-            cmd = redis_conn.register_script(expire_lua)
-            redis_conn.mset(bulk_fingerprint_mapping)
-
-            total_cnt = len(bulk_fingerprint_mapping)
-            cmd(keys=list(bulk_fingerprint_mapping.keys()), args=[total_cnt, timeout])
+            store = FingerprintStore(chunk_size=chunk_size, timeout=timeout or self.DEFAULT_EXPIRE)
+            total_cnt = store.set_many(bulk_fingerprint_mapping)
 
             logger.info("bulk_insert_fingerprint_to_redis => Set count %s is ok.", total_cnt)
         except Exception as e:
@@ -359,23 +602,33 @@ class AppMsgPushRecordSerializer(serializers.ModelSerializer):
         # Message body and log fingerprint mapping
         fingerprint_mapping = {}
         message_fingerprint = self.get_fingerprint(new_validated_data)
+        new_validated_data["fingerprint"] = message_fingerprint
         fp_kwargs = dict(app_id=app_id, msg_fingerprint=message_fingerprint)
 
         msg_fingerprint_key = self.APP_MSG_FINGERPRINT_KEY.format(**fp_kwargs)
         app_msg_id = self.get_cache_from_redis(key=msg_fingerprint_key)
 
+        is_new_msg = False
+
         if not app_msg_id:
-            app_msg_obj = models.AppMessageModel.create_object(**new_validated_data)
-            app_msg_id = app_msg_obj.id
+            msg_items = {msg_fingerprint_key: (app_id, message_fingerprint)}
+            app_msg_id = self.get_message_ids(msg_items).get(msg_fingerprint_key)
+
+            if not app_msg_id:
+                app_msg_obj = models.AppMessageModel.create_object(**new_validated_data)
+                app_msg_id = app_msg_obj.id
+                is_new_msg = True
+
             fingerprint_mapping[msg_fingerprint_key] = app_msg_id
 
-        fp_kwargs["userid"] = new_validated_data["receiver_userid"]
+        userid = new_validated_data["receiver_userid"]
+        fp_kwargs["userid"] = userid
         log_fingerprint_key = self.APP_LOG_FINGERPRINT_KEY.format(**fp_kwargs)
 
-        if not self.get_cache_from_redis(key=log_fingerprint_key):
+        if is_new_msg or not self.get_existing_log_keys([(log_fingerprint_key, app_msg_id, userid)]):
             new_validated_data["app_msg_id"] = app_msg_id
             instance_list = model_cls.create_object(**new_validated_data)
-            fingerprint_mapping[log_fingerprint_key] = instance_list.msg_uid
+            self.add_log_fingerprints([log_fingerprint_key])
         else:
             logger.info("%s.create() App message already exist." % self.__class__.__name__)
             instance_list = []
@@ -1,18 +1,19 @@
+import logging
 import traceback
 
 from easypush.core.mq.context import get_celery_app
 from easypush.serializers import AppMsgPushRecordSerializer
 
 celery_app = get_celery_app()
+logger = logging.getLogger("django")
 
 
 @celery_app.task
-def cache_message_fingerprints(**kwargs):
+def cache_message_fingerprints(days=None, chunk_size=5000, **kwargs):
+    """ Re-index the fingerprints of the history into redis chunk by chunk """
     serializer = AppMsgPushRecordSerializer()
 
     try:
-        fingerprint_mappings = serializer.get_fingerprints_history()
-        serializer.batch_insert_fingerprint(fingerprint_mappings)
+        serializer.rebuild_fingerprints(days=days, chunk_size=chunk_size)
     except Exception as e:
-        traceback.format_exc()
-
+        logger.error("cache_message_fingerprints => err: %s\n%s", e, traceback.format_exc())
@@ -15,14 +15,23 @@ from __future__ import absolute_import
 
 import time
 import json
+import asyncio
 import logging
 import traceback
 from datetime import datetime
 from operator import itemgetter
 from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from asgiref.sync import sync_to_async
 
 from easypush.core.mq.context import get_celery_app
-from easypush.client.utils import get_push_backend
+from easypush.core.limiter.local import get_platform_gate
+from easypush.core.mq.retry import classify_errcode, get_backoff
+from easypush.client.utils import get_push_backend, get_push_send_lock
+from easypush.serializers import AppMsgPushRecordSerializer
+from easypush.utils.settings import config
+from easypush.utils.constants import PushErrorEnum
 from easypush.models import AppMessageModel as MsgModel
 from easypush.models import AppMsgPushRecordModel as LogModel
 
@@ -30,28 +39,24 @@ celery_app = get_celery_app()
 logger = logging.getLogger("django")
 
 
-@celery_app.task(ignore_result=True)
-def send_message_by_mq(msg_uid_list=None, **kwargs):
-    """ General task to send message by MQ
-    :param msg_uid_list: list, eg: ["2702976118339", "2702976118349"]
-    :return
-    """
-    start_time = time.time()
-    msg_uid_list = msg_uid_list or []
-
-    if not msg_uid_list:
-        return
+def _get_message_groups(msg_uid_list):
+    """ Group push logs by message body: [(app_msg_obj, log_list), ...]
 
+        All the receivers of one message are merged, then split by the recipient limit of the platform,
+        eg: a broadcast to 1000 users of qy_weixin is one api call. Ordered by (app_msg_id, id) so that
+        the groups are deterministic.
+    """
     log_query = dict(msg_uid__in=msg_uid_list)
     log_fields = ["msg_uid", "receiver_userid", "app_msg_id"]
-    log_queryset = LogModel.objects.filter(**log_query).values(*log_fields)
+    log_queryset = LogModel.objects.filter(**log_query).order_by("app_msg_id", "id").values(*log_fields)
 
     # Application of platform
     app_msg_ids = list({item["app_msg_id"] for item in log_queryset})
     msg_queryset = MsgModel.objects.filter(id__in=app_msg_ids, is_del=False).select_related("app")
     msg_mapping_dict = {msg_obj.id: msg_obj for msg_obj in msg_queryset}
 
-    # Send message group by application
+    message_groups = []
+
     for app_msg_id, iterator in groupby(log_queryset, key=itemgetter("app_msg_id")):
         log_list = list(iterator)
         app_msg_obj = msg_mapping_dict.get(app_msg_id)
@@ -59,39 +64,233 @@ def send_message_by_mq(msg_uid_list=None, **kwargs):
         if not app_msg_obj:
             continue
 
-        body_kwargs = json.loads(app_msg_obj.msg_body_json)
-        group_msg_uid_list = [log_item["msg_uid"] for log_item in log_list]
-        required_msg_uid_list = [item["msg_uid"] for item in log_list if item["msg_uid"]]
-        userid_list = [item["receiver_userid"] for item in log_list if item["receiver_userid"]]
+        chunk_size = AppMsgPushRecordSerializer.get_mq_chunk_size(app_msg_obj.app.platform_type)
+        for i in range(0, len(log_list), chunk_size):
+            message_groups.append((app_msg_obj, log_list[i: i + chunk_size]))
+
+    return message_groups
+
+
+class PushResultWriter:
+    """ Collects the outcome of every receiver of a task, written back by one UPDATE in `flush` """
+    INVALID_USER_ERRMSG = "invalid user"
+
+    def __init__(self, start_time=None):
+        self.start_time = start_time or time.time()
+        self.values_mapping = {}  # msg_uid: {field: value}
+
+    @staticmethod
+    def get_invalid_userids(ret):
+        """ Receivers rejected by the platform, eg: qy_weixin `invaliduser`: "userid1|userid2" """
+        data = ret.get("data")
+        invalid_users = data.get("invaliduser") if isinstance(data, dict) else None
+
+        if not invalid_users:
+            return set()
 
-        api_start_time = time.time()
-        # Standard result: {errcode:0, errmsg: "ok", task_id:"123", request_id: "456", data:{}}
-        ret = dict(errcode=500, errmsg="failed", task_id="", request_id="", data=None)
+        if isinstance(invalid_users, str):
+            invalid_users = invalid_users.split("|")
+
+        return {str(userid) for userid in invalid_users if userid}
+
+    def add(self, app_msg_obj, log_list, ret):
+        invalid_userids = self.get_invalid_userids(ret)
+        receive_time = datetime.now()
+
+        for log_item in log_list:
+            values = dict(task_id=ret["task_id"], request_id=ret["request_id"])
+
+            if ret["errcode"] != 0:
+                values.update(is_success=False, traceback=ret["errmsg"])
+            elif log_item["receiver_userid"] in invalid_userids:
+                values.update(is_success=False, traceback=self.INVALID_USER_ERRMSG)
+            else:
+                values.update(is_success=True, traceback=ret["errmsg"], receive_time=receive_time)
+
+            self.values_mapping[log_item["msg_uid"]] = values
+
+        log_msg = "msg_uid Cnt:%s, invalid user Cnt:%s, app_msg:%s, Cost time:%.2fs\nRet: %s\nMsg uid:%s"
+        log_args = (len(log_list), len(invalid_userids), app_msg_obj, time.time() - self.start_time, ret)
+        logger.info("send_message_by_mq => " + log_msg, *log_args + ([item["msg_uid"] for item in log_list], ))
+
+    def flush(self):
+        """ :return: int, count of the updated push logs """
+        values_mapping, self.values_mapping = self.values_mapping, {}
 
         try:
-            push = get_push_backend(instance=app_msg_obj.app)
-            result = push.async_send(msgtype=app_msg_obj.msg_type, body_kwargs=body_kwargs, userid_list=userid_list)
-            task_id = result.pop("task_id", "")
-            ret.update(task_id=str(task_id), **result)
-        except Exception:
-            exc_msg = traceback.format_exc()
-            ret.update(errmsg=exc_msg[-1000:])
-        finally:
-            _log_args = (app_msg_obj, len(log_list), time.time() - api_start_time)
-            logger.info("send_message_by_mq => app_msg: %s, push_count: %s, Api Cost time:%.2fs", *_log_args)
+            return LogModel.bulk_update_values("msg_uid", values_mapping)
+        except Exception as e:
+            logger.error("PushResultWriter.flush => msg_uid Cnt:%s, err: %s\n%s", len(values_mapping), e,
+                         traceback.format_exc())
+            return 0
+
+
+class PushRetryCollector:
+    """ Collects the failed groups of a task by the kind of their errcode, only the receivers of the
+        retryable ones are sent again, by one task of the same priority lane after a backoff with jitter.
+    """
+    MAX_RETRIES = 3
+
+    def __init__(self, retries=0, priority=None):
+        self.retries = retries
+        self.priority = priority
+        self.msg_uid_list = []
+        self.countdown = 0
+
+    def add(self, app_msg_obj, log_list, ret):
+        error_kind = classify_errcode(app_msg_obj.app.platform_type, ret["errcode"])
 
+        if error_kind is None:
+            return
+
+        if error_kind is PushErrorEnum.TOKEN_EXPIRED:
             try:
-                update_kwargs = dict(
-                    is_success=ret["errcode"] == 0, task_id=ret["task_id"],
-                    traceback=ret["errmsg"], request_id=ret["request_id"]
-                )
-                update_kwargs["is_success"] and update_kwargs.update(receive_time=datetime.now())
-                LogModel.objects.filter(msg_uid__in=group_msg_uid_list).update(**update_kwargs)
-            except Exception:
-                traceback.format_exc()
+                get_push_backend(instance=app_msg_obj.app).invalidate_token()
+            except Exception as e:
+                logger.error("PushRetryCollector => app_msg: %s, invalidate token err: %s", app_msg_obj, e)
+
+        if not error_kind.retryable:
+            return
+
+        self.msg_uid_list.extend(item["msg_uid"] for item in log_list)
+        self.countdown = max(self.countdown, get_backoff(self.retries, error_kind))
+
+    def schedule(self):
+        if not self.msg_uid_list:
+            return
+
+        if self.retries >= self.MAX_RETRIES:
+            logger.warning("send_message_by_mq => Give up after %s retries, msg_uid Cnt:%s",
+                           self.retries, len(self.msg_uid_list))
+            return
+
+        logger.info("send_message_by_mq => Retry %s, msg_uid Cnt:%s, countdown:%.2fs",
+                    self.retries + 1, len(self.msg_uid_list), self.countdown)
+        task_kwargs = dict(msg_uid_list=self.msg_uid_list, retries=self.retries + 1, priority=self.priority)
+        route_options = AppMsgPushRecordSerializer.get_mq_route(self.priority)
+        send_message_by_mq.apply_async(kwargs=task_kwargs, countdown=self.countdown, **route_options)
+
 
-            log_msg = "msg_uid Cnt:%s, userid_list Cnt:%s, app_msg:%s, Cost time:%.2fs\nRet: %s\nMsg uid:%s"
-            log_args = (len(group_msg_uid_list), len(userid_list), app_msg_obj, time.time() - start_time, ret)
-            logger.info("send_message_by_mq => " + log_msg, *log_args + (required_msg_uid_list, ))
+def _send_message_group(app_msg_obj, log_list):
+    """ Call the platform api for one group, :return: standard result """
+    body_kwargs = json.loads(app_msg_obj.msg_body_json)
+    userid_list = [item["receiver_userid"] for item in log_list if item["receiver_userid"]]
+
+    api_start_time = time.time()
+    # Standard result: {errcode:0, errmsg: "ok", task_id:"123", request_id: "456", data:{}}
+    ret = dict(errcode=500, errmsg="failed", task_id="", request_id="", data=None)
+
+    try:
+        push = get_push_backend(instance=app_msg_obj.app)
+
+        # The groups of one app share the client, take the app lock before a platform slot
+        with get_push_send_lock(app_msg_obj.app), get_platform_gate(app_msg_obj.app.platform_type):
+            result = push.async_send(msgtype=app_msg_obj.msg_type, body_kwargs=body_kwargs, userid_list=userid_list)
+
+        task_id = result.pop("task_id", "")
+        ret.update(task_id=str(task_id), **result)
+    except Exception as e:
+        exc_msg = traceback.format_exc()
+        # eg: DingTalkClientException of the dingtalk-sdk carries the errcode
+        ret.update(errcode=getattr(e, "errcode", None) or ret["errcode"], errmsg=exc_msg[-1000:])
+    finally:
+        _log_args = (app_msg_obj, len(log_list), time.time() - api_start_time)
+        logger.info("send_message_by_mq => app_msg: %s, push_count: %s, Api Cost time:%.2fs", *_log_args)
+
+    return ret
+
+
+@celery_app.task(ignore_result=True)
+def send_message_by_mq(msg_uid_list=None, retries=0, priority=None, **kwargs):
+    """ General task to send message by MQ
+        The (app, message body) groups are sent concurrently by `EASYPUSH["dispatch_max_workers"]` threads,
+        capped per platform(the groups of one app go one after another, they share the client),
+        the results of all the receivers are written back by one UPDATE.
+        The receivers of the groups failed by a transient error are retried, see `PushRetryCollector`.
+
+    :param msg_uid_list: list, eg: ["2702976118339", "2702976118349"]
+    :param retries: int, retries already done for these receivers
+    :param priority: str, lane of the message, see `MessagePriorityEnum`
+    :return
+    """
+    start_time = time.time()
+    msg_uid_list = msg_uid_list or []
+
+    if not msg_uid_list:
+        return
+
+    # Send message group by application
+    message_groups = _get_message_groups(msg_uid_list)
+    max_workers = min(config.dispatch_max_workers, len(message_groups))
+    result_writer = PushResultWriter(start_time=start_time)
+    retry_collector = PushRetryCollector(retries=retries, priority=priority)
+
+    if max_workers <= 1:
+        for app_msg_obj, log_list in message_groups:
+            ret = _send_message_group(app_msg_obj, log_list)
+            result_writer.add(app_msg_obj, log_list, ret)
+            retry_collector.add(app_msg_obj, log_list, ret)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="easypush-dispatch") as executor:
+            future_mapping = {
+                executor.submit(_send_message_group, app_msg_obj, log_list): (app_msg_obj, log_list)
+                for app_msg_obj, log_list in message_groups
+            }
+
+            for future in as_completed(future_mapping):
+                app_msg_obj, log_list = future_mapping[future]
+                ret = future.result()
+
+                result_writer.add(app_msg_obj, log_list, ret)
+                retry_collector.add(app_msg_obj, log_list, ret)
+
+    result_writer.flush()
+    retry_collector.schedule()
+
+
+async def _asend_message_group(app_msg_obj, log_list, result_writer, retry_collector):
+    body_kwargs = json.loads(app_msg_obj.msg_body_json)
+    userid_list = [item["receiver_userid"] for item in log_list if item["receiver_userid"]]
+
+    api_start_time = time.time()
+    ret = dict(errcode=500, errmsg="failed", task_id="", request_id="", data=None)
+
+    try:
+        push = get_push_backend(instance=app_msg_obj.app)
+        result = await push.asend(msgtype=app_msg_obj.msg_type, body_kwargs=body_kwargs, userid_list=userid_list)
+        task_id = result.pop("task_id", "")
+        ret.update(task_id=str(task_id), **result)
+    except Exception:
+        exc_msg = traceback.format_exc()
+        ret.update(errmsg=exc_msg[-1000:])
+    finally:
+        _log_args = (app_msg_obj, len(log_list), time.time() - api_start_time)
+        logger.info("asend_message_by_mq => app_msg: %s, push_count: %s, Api Cost time:%.2fs", *_log_args)
+
+        result_writer.add(app_msg_obj, log_list, ret)
+        await sync_to_async(retry_collector.add, thread_sensitive=False)(app_msg_obj, log_list, ret)
+
+
+async def asend_message_by_mq(msg_uid_list=None, retries=0, priority=None, **kwargs):
+    """ Coroutine version of `send_message_by_mq`, the groups of every app/message body are sent concurrently,
+        the retries stay in the lane of `priority`
+
+    Example::
+        >>> asyncio.run(asend_message_by_mq(msg_uid_list=["2702976118339", "2702976118349"]))
+    """
+    start_time = time.time()
+    msg_uid_list = msg_uid_list or []
+
+    if not msg_uid_list:
+        return
 
+    result_writer = PushResultWriter(start_time=start_time)
+    retry_collector = PushRetryCollector(retries=retries, priority=priority)
+    message_groups = await sync_to_async(_get_message_groups)(msg_uid_list)
 
+    await asyncio.gather(*[
+        _asend_message_group(app_msg_obj, log_list, result_writer, retry_collector)
+        for app_msg_obj, log_list in message_groups
+    ])
+    await sync_to_async(result_writer.flush)()
+    await sync_to_async(retry_collector.schedule, thread_sensitive=False)()
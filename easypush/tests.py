@@ -1,13 +1,49 @@
+import json
 import time
 import random
+import asyncio
 import string
+import threading
+from datetime import datetime
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from functools import partial
+import unittest
+from unittest import mock
 from multiprocessing.dummy import Pool as ThreadPool
 
-from django.test import TestCase
+import redis
+from celery import Celery
+
+try:
+    import fakeredis
+except ImportError:     # pip install easypush[test]
+    fakeredis = None
+
+from django.db import DatabaseError
+from django.test import TestCase, SimpleTestCase
+from django_redis import get_redis_connection
+from rest_framework.exceptions import ValidationError
 
 from easypush import pushes, easypush
-from easypush.core.locker.lock import DistributedLock
+from easypush.core.locker.lock import DistributedLock, AcquireLockError, lock_metrics
+from easypush.core.locker.quorum import QuorumLock
+from easypush.core.request.pool import HttpConnectionPool
+from easypush.core.cache import fingerprint
+from easypush.core.limiter import bucket
+from easypush.core.limiter.bucket import RedisRateLimiter
+from easypush.client.utils import get_push_backend
+from easypush.utils import worker_id
+from easypush.utils.snowflake import IdGenerator
+from easypush.utils.worker_id import RedisWorkerIdLease
+from easypush.core.request.http_client import AsyncHttpFactory
+from easypush.backends.base.base import RequestApiBase
+from easypush.core.mq.context import ContextTask
+from easypush.core.mq.retry import BACKOFF_MAPPING, TRANSIENT_ERRCODE, classify_errcode, get_backoff
+from easypush.utils.constants import AppPlatformEnum, PushErrorEnum
+from easypush.models import AppTokenPlatformModel, AppMessageModel, AppMsgPushRecordModel
+from easypush.serializers import AppMsgPushRecordSerializer
+from easypush.utils.settings import config
 
 
 class RedisLockTestCase(TestCase):
@@ -34,6 +70,732 @@ class RedisLockTestCase(TestCase):
         pool.close()
         pool.join()
 
+    def test_qps_notify(self):
+        maxsize = 5000
+        pool = ThreadPool(20)
+        lock_metrics.reset()
+        atomic_task = DistributedLock(self.lock_key, self.calculate, expire=2, wait_mode="notify", wait_timeout=30)
+
+        start_time = time.time()
+        pool.map(lambda i: atomic_task.lock(), range(maxsize))
+
+        cost_time = time.time() - start_time
+        print("Notify ret: %s, maxsize:%s, cost:%s, qps:%.2f, metrics:%s" % (
+            self.count, maxsize, cost_time, maxsize / cost_time, lock_metrics.snapshot()))
+        self.assertEqual(self.count, maxsize)
+
+        pool.close()
+        pool.join()
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class NotifyLockTestCase(SimpleTestCase):
+    """ Notify wait mode hands the lock over to the waiters in arrival order """
+
+    def setUp(self) -> None:
+        self.redis_conn = fakeredis.FakeStrictRedis()
+        self.lock_key = ''.join(random.choice(string.ascii_letters) for _ in range(26))
+
+    def get_lock(self, func=None, *args):
+        atomic_task = DistributedLock(
+            self.lock_key, func, func_args=args, expire=5, wait_mode="notify", wait_timeout=10, interval_waits=0.01
+        )
+        atomic_task.redis_conn = self.redis_conn
+        return atomic_task
+
+    def wait_until(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+
+        while not predicate():
+            self.assertLess(time.monotonic(), deadline, "timeout")
+            time.sleep(0.005)
+
+    def test_fifo_order(self):
+        released = threading.Event()
+        acquired_order = []
+        holder = threading.Thread(target=self.get_lock(released.wait, 5).lock)
+        holder.start()
+        self.wait_until(lambda: self.redis_conn.exists(self.lock_key))
+
+        waiters = []
+        for index in range(8):
+            waiter = threading.Thread(target=self.get_lock(acquired_order.append, index).lock)
+            waiter.start()
+            waiters.append(waiter)
+            self.wait_until(lambda: self.redis_conn.llen(self.lock_key + ":waiters") == index + 1)
+
+        released.set()
+        for thread in [holder] + waiters:
+            thread.join(10)
+
+        self.assertEqual(acquired_order, list(range(8)))
+        self.assertFalse(self.redis_conn.exists(self.lock_key, self.lock_key + ":waiters"))
+
+    def test_newcomer_behind_queue(self):
+        atomic_task = self.get_lock()
+        self.assertTrue(atomic_task._acquire(b"holder", 5000))
+        self.assertFalse(atomic_task._acquire(b"waiter", 5000))
+
+        # The holder died: the lock expired but the queue is not empty
+        self.redis_conn.delete(self.lock_key)
+        self.assertFalse(atomic_task._acquire(b"newcomer", 5000))
+        self.assertTrue(atomic_task._acquire(b"waiter", 5000))
+
+        atomic_task._unlock(b"waiter")
+        self.assertEqual(self.redis_conn.get(self.lock_key), b"newcomer")
+        self.assertEqual(self.redis_conn.lpop(self.lock_key + ":wake:newcomer"), b"1")
+
+    def test_timeout_leaves_queue(self):
+        atomic_task = self.get_lock()
+        self.assertTrue(atomic_task._acquire(b"holder", 5000))
+
+        waiter = self.get_lock(lambda: None)
+        waiter.wait_timeout = 0.05
+        with self.assertRaises(AcquireLockError):
+            waiter.lock()
+
+        # Nobody left to hand over to
+        atomic_task._unlock(b"holder")
+        self.assertFalse(self.redis_conn.exists(self.lock_key, self.lock_key + ":waiters"))
+
+
+class QuorumLockTestCase(TestCase):
+    """ Start the nodes before: for p in 6380 6381 6382; do redis-server --port $p --daemonize yes; done """
+    NODES = ["redis://127.0.0.1:6380/0", "redis://127.0.0.1:6381/0", "redis://127.0.0.1:6382/0"]
+
+    def setUp(self) -> None:
+        for url in self.NODES:
+            try:
+                redis.Redis.from_url(url, socket_connect_timeout=0.1).ping()
+            except redis.RedisError:
+                self.skipTest("redis node %s is not running" % url)
+
+        self.count = 0
+        self.lock_key = ''.join(random.choice(string.ascii_letters) for _ in range(26))
+
+    def calculate(self, *args):
+        self.count += 1
+
+    def test_quorum_lock(self):
+        maxsize = 2000
+        pool = ThreadPool(20)
+        atomic_task = DistributedLock(self.lock_key, self.calculate, expire=2, interval_waits=0.005, nodes=self.NODES)
+
+        pool.map(lambda i: atomic_task.lock(), range(maxsize))
+        self.assertEqual(self.count, maxsize)
+
+        pool.close()
+        pool.join()
+
+    def test_minority_node_down(self):
+        quorum_lock = QuorumLock(self.NODES[:2] + ["redis://127.0.0.1:1/0"])
+
+        self.assertGreater(quorum_lock.acquire(self.lock_key, "v1", 1000), 0)
+        self.assertEqual(quorum_lock.acquire(self.lock_key, "v2", 1000), 0)
+
+        quorum_lock.release(self.lock_key, "v1")
+        self.assertGreater(quorum_lock.acquire(self.lock_key, "v2", 1000), 0)
+
+
+class WorkerIdLeaseTestCase(SimpleTestCase):
+    """ Snowflake `did_wid` leases in redis """
+
+    def setUp(self) -> None:
+        self.redis_conn = get_redis_connection()
+
+        try:
+            self.redis_conn.ping()
+        except redis.RedisError:
+            self.skipTest("redis is not running")
+
+        self.leases = []
+
+    def tearDown(self) -> None:
+        for lease in self.leases:
+            lease.release()
+
+    def new_lease(self, **kwargs):
+        lease = RedisWorkerIdLease(redis_conn=self.redis_conn, **kwargs)
+        lease.acquire()
+        self.leases.append(lease)
+
+        return lease
+
+    def get_owner(self, lease):
+        owner = self.redis_conn.get(lease.KEY_PREFIX + str(lease.worker_id))
+        return owner.decode() if isinstance(owner, bytes) else owner
+
+    def test_unique_and_release(self):
+        lease1, lease2 = self.new_lease(), self.new_lease()
+
+        self.assertNotEqual(lease1.worker_id, lease2.worker_id)
+        self.assertEqual(self.get_owner(lease1), lease1.owner)
+
+        lease1.release()
+        self.assertIsNone(self.get_owner(lease1))
+
+    def test_heartbeat_renews(self):
+        lease = self.new_lease(ttl=1)
+
+        time.sleep(1.5)  # Expired without the heartbeat(every ttl / 3)
+        self.assertEqual(self.get_owner(lease), lease.owner)
+
+    def test_lost_lease_taken_again(self):
+        lost_ids = []
+        lease = self.new_lease(ttl=1, on_lost=lost_ids.append)
+        old_worker_id = lease.worker_id
+
+        # Expired and taken by another process meanwhile
+        self.redis_conn.set(lease.KEY_PREFIX + str(old_worker_id), "other-owner", ex=10)
+        time.sleep(1)
+
+        self.assertEqual(lost_ids, [lease.worker_id])
+        self.assertNotEqual(lease.worker_id, old_worker_id)
+        self.assertEqual(self.get_owner(lease), lease.owner)
+        self.redis_conn.delete(lease.KEY_PREFIX + str(old_worker_id))
+
+    def test_concurrent_get_id_generator(self):
+        lease = self.new_lease()
+
+        with mock.patch.object(worker_id, "_lease", None), mock.patch.object(worker_id, "_lease_pid", None), \
+                mock.patch.object(worker_id, "get_worker_lease", return_value=lease):
+            pool = ThreadPool(20)
+            generators = pool.map(lambda i: worker_id.get_id_generator(), range(200))
+            pool.close()
+            pool.join()
+
+        if worker_id._lease is not None:
+            IdGenerator.reset_instance(did_wid=worker_id._lease.worker_id)  # Back to the lease of the process
+
+        did_wid_list = {(g.data_center_id << IdGenerator.WORKER_ID_BITS) | g.worker_id for g in generators}
+        self.assertEqual(len({id(g) for g in generators}), 1)
+        self.assertEqual(did_wid_list, {lease.worker_id})
+
+
+class LocalHttpServerTestCase(SimpleTestCase):
+    """ Local http server of the request tests """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        requests = []
+
+        def log_message(self, format, *args):
+            pass
+
+        def handle_request(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode() if length else ""
+            self.requests.append((self.command, self.path))
+
+            if self.path == "/drop":
+                # Closed without a response, like a keep-alive socket closed by the server
+                self.close_connection = True
+                return
+
+            # /short: announces more bytes than sent, the body read fails with IncompleteRead
+            content = b"ok"
+            content_type = "text/plain"
+
+            if self.path.startswith("/echo"):
+                content = json.dumps(dict(errcode=0, method=self.command, path=self.path, body=body)).encode()
+                content_type = "application/json"
+
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", "10" if self.path == "/short" else str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            self.close_connection = self.path == "/short"
+
+        do_GET = do_POST = handle_request
+
+    def setUp(self) -> None:
+        self.Handler.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.url = "http://127.0.0.1:%s" % self.server.server_port
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class HttpConnectionPoolTestCase(LocalHttpServerTestCase):
+    """ Keep-alive pool against a local http server """
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.pool = HttpConnectionPool(maxsize=2, block_timeout=1)
+
+    def tearDown(self) -> None:
+        self.pool.clear()
+        super().tearDown()
+
+    def test_keep_alive_reuse(self):
+        for _ in range(5):
+            self.assertEqual(self.pool.urlopen("GET", self.url + "/ok", timeout=2).read(), b"ok")
+
+        host_pool = self.pool.get_host_pool("http", "127.0.0.1", self.server.server_port)
+        self.assertEqual(host_pool._created, 1)
+
+    def test_body_read_error_releases_connection(self):
+        for _ in range(self.pool.maxsize + 1):
+            with self.assertRaises(http.client.IncompleteRead):
+                self.pool.urlopen("GET", self.url + "/short", timeout=2)
+
+        self.assertEqual(self.pool.urlopen("GET", self.url + "/ok", timeout=2).read(), b"ok")
+
+    def test_stale_retry_only_idempotent(self):
+        self.pool.urlopen("GET", self.url + "/ok", timeout=2)
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.pool.urlopen("POST", self.url + "/drop", body=b"{}", timeout=2)
+        self.assertEqual(self.Handler.requests.count(("POST", "/drop")), 1)
+
+        self.pool.urlopen("GET", self.url + "/ok", timeout=2)
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.pool.urlopen("GET", self.url + "/drop", timeout=2)
+        self.assertEqual(self.Handler.requests.count(("GET", "/drop")), 2)
+
+
+class AsyncRequestTestCase(LocalHttpServerTestCase):
+    """ Coroutine request path(aiohttp) of the backends against the same local server """
+
+    class EchoApi(RequestApiBase):
+        def send(self, payload):
+            return self._request("POST", "echo.send", data=payload, params=dict(access_token="token"))
+
+        async def asend(self, payload):
+            return await self._arequest("POST", "echo.send", data=payload, params=dict(access_token="token"))
+
+    def test_async_request_same_as_sync(self):
+        api = self.EchoApi()
+        api.API_BASE_URL = self.url + "/"
+        payload = {"msgtype": "text", "text": {"content": "easypush"}}
+
+        async def send_many():
+            try:
+                return await asyncio.gather(*[api.asend(payload) for _ in range(5)])
+            finally:
+                await AsyncHttpFactory.close_session()
+
+        results = asyncio.run(send_many())
+        self.assertEqual(results, [api.send(payload)] * 5)
+        self.assertEqual(results[0]["path"], "/echo/send?access_token=token")
+        self.assertEqual(json.loads(results[0]["body"]), payload)
+
+
+class FanOutTestCase(SimpleTestCase):
+    class RecordTask:
+        """ Records the published chunks instead of sending them """
+        def __init__(self):
+            self.app = Celery("fan_out_test", broker="memory://")
+            self.calls = []
+            self.options = []
+
+        def apply_async(self, kwargs=None, producer=None, **options):
+            self.calls.append((kwargs["msg_uid_list"], producer))
+            self.options.append(dict(options, priority=kwargs["priority"]))
+
+        def run(self, msg_uid_list):
+            self.calls.append((msg_uid_list, None))
+
+    def setUp(self) -> None:
+        self.msg_uid_list = ["msg_uid_%s" % i for i in range(AppMsgPushRecordSerializer.MAX_BATCH_SIZE)]
+
+    def assert_fan_out(self, platform_type, chunk_size, is_async=True):
+        task = self.RecordTask()
+        AppMsgPushRecordSerializer.fan_out(self.msg_uid_list, task, platform_type=platform_type, is_async=is_async)
+
+        enqueued = [msg_uid for chunk, _ in task.calls for msg_uid in chunk]
+        self.assertEqual(enqueued, self.msg_uid_list)
+        self.assertEqual(len(task.calls), len(self.msg_uid_list) // chunk_size)
+        self.assertTrue(all(len(chunk) <= chunk_size for chunk, _ in task.calls))
+
+        if is_async:
+            self.assertEqual(len({id(producer) for _, producer in task.calls}), 1)
+
+    def test_every_receiver_enqueued(self):
+        self.assert_fan_out("qy_weixin", 1000)
+        self.assert_fan_out("ding_talk", 100)
+        self.assert_fan_out("ding_talk", 100, is_async=False)
+
+    def test_priority_lanes(self):
+        urgent_route = {"queue": "send_message_urgent_q", "routing_key": "send_message_urgent_rk"}
+        lane_config = dict(mq_priority_routes={"urgent": urgent_route}, mq_bulk_threshold=100)
+
+        with mock.patch.dict(config.attrs, lane_config):
+            for priority, msg_uid_list, expected_options in [
+                ("urgent", self.msg_uid_list[:1], dict(urgent_route, priority="urgent")),
+                (None, self.msg_uid_list[:1], dict(priority="normal")),
+                (None, self.msg_uid_list, dict(priority="bulk")),
+            ]:
+                task = self.RecordTask()
+                AppMsgPushRecordSerializer.fan_out(msg_uid_list, task, platform_type="ding_talk", priority=priority)
+                self.assertTrue(all(options == expected_options for options in task.options))
+
+            with self.assertRaises(ValidationError):
+                AppMsgPushRecordSerializer.get_priority("vip")
+
+
+class RawPublisherTestCase(SimpleTestCase):
+    """ Raw messages through an in-memory broker """
+
+    def setUp(self) -> None:
+        self.app = Celery("raw_publisher_test", broker="memory://", task_cls=ContextTask)
+        self.app.conf.CELERY_TASK_TO_BACKEND = "task_to_backend"
+
+        @self.app.task(name="easypush.tests.raw_send")
+        def raw_send(msg_uid_list, **kwargs):
+            return msg_uid_list
+
+        self.task = raw_send
+
+    def consume(self, count):
+        messages = []
+
+        with self.app.connection_for_read() as conn:
+            queue = conn.SimpleQueue(self.app.amqp.queues[self.app.conf.task_default_queue])
+
+            for _ in range(count):
+                message = queue.get(timeout=1)
+                message.ack()
+                messages.append(message)
+
+            self.assertEqual(queue.qsize(), 0)
+            queue.close()
+
+        return messages
+
+    def test_publish_raw(self):
+        result = self.task.apply_async_raw(kwargs={"msg_uid_list": ["1"]})
+        message = self.consume(1)[0]
+
+        self.assertEqual(message.headers["id"], result.id)
+        self.assertEqual(message.headers["task"], self.task.name)
+        self.assertEqual(message.decode(), [[], {"msg_uid_list": ["1"]}, {}])
+
+    def test_publish_raw_many(self):
+        payloads = [((), {"msg_uid_list": ["msg_uid_%s" % i]}) for i in range(50)]
+        payloads.append(dict(kwargs={"msg_uid_list": ["custom"]}, task_id="custom-task-id"))
+
+        results = self.task.apply_async_raw_many(payloads)
+        messages = self.consume(len(payloads))
+
+        self.assertEqual([message.headers["id"] for message in messages], [result.id for result in results])
+        self.assertEqual(results[-1].id, "custom-task-id")
+        self.assertEqual(
+            [message.decode()[1]["msg_uid_list"][0] for message in messages],
+            ["msg_uid_%s" % i for i in range(50)] + ["custom"]
+        )
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+class FingerprintStoreTestCase(SimpleTestCase):
+    def setUp(self) -> None:
+        self.redis_conn = fakeredis.FakeStrictRedis()
+
+    def test_set_many(self):
+        store = fingerprint.FingerprintStore(redis_conn=self.redis_conn, chunk_size=3, timeout=60)
+        mapping = {"fingerprint:%s" % i: i for i in range(10)}
+
+        self.assertEqual(store.set_many(mapping), 10)
+        self.assertEqual(store.get_many(list(mapping) + ["missing"]), [str(i).encode() for i in range(10)] + [None])
+        self.assertTrue(all(0 < self.redis_conn.ttl(key) <= 60 for key in mapping))
+
+    def test_benchmark_keeps_other_keys(self):
+        self.redis_conn.set("app_id:1:msg_fingerprint:other", 1)
+
+        with mock.patch("redis.Redis.from_url", return_value=self.redis_conn):
+            fingerprint.test_by_pipeline_vs_lua(sizes=(100, ), chunk_size=30)
+
+        self.assertEqual(self.redis_conn.keys("*"), [b"app_id:1:msg_fingerprint:other"])
+
+
+class RateLimiterTestCase(SimpleTestCase):
+    """ Shared token bucket of an app """
+
+    QY_BACKEND = "easypush.backends.qy_weixin.QyWeixinClient"
+
+    def get_app(self, corp_id, agent_id):
+        return mock.Mock(
+            platform_type="qy_weixin", corp_id=corp_id, agent_id=agent_id, app_key=corp_id, app_secret="secret",
+            app_token="rate_limit_%s_%s_%s" % (corp_id, agent_id, time.time()),
+        )
+
+    def test_mq_backend_limit(self):
+        alias_conf = dict(
+            BACKEND=self.QY_BACKEND, CORP_ID="ww_limited", AGENT_ID="1000002", APP_KEY="", APP_SECRET="",
+            RATE_LIMIT={"rate": 5, "burst": 10},
+        )
+        attrs = {"qy_corp": alias_conf, "rate_limits": {"qy_weixin": {"rate": 3, "per": "corp"}}}
+
+        with mock.patch.dict(config.attrs, attrs), mock.patch.dict(bucket._limiters, clear=True):
+            # `using` of a backend from the database is the platform, the alias is found by corp and agent
+            limiter = get_push_backend(instance=self.get_app("ww_limited", 1000002))._client.rate_limiter
+            self.assertIsInstance(limiter, RedisRateLimiter)
+            self.assertEqual((limiter.rate, limiter.burst), (5.0, 10))
+            self.assertTrue(limiter.key.endswith("qy_weixin:ww_limited:1000002"))
+
+            # No alias: the platform default
+            limiter = get_push_backend(instance=self.get_app("ww_other", 1000003))._client.rate_limiter
+            self.assertEqual(limiter.rate, 3.0)
+            self.assertTrue(limiter.key.endswith("qy_weixin:ww_other"))
+
+        with mock.patch.dict(config.attrs, {"rate_limits": {}}):
+            self.assertIsNone(get_push_backend(instance=self.get_app("ww_other", 1000003))._client.rate_limiter)
+
+    @unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_take_refill(self):
+        redis_conn = fakeredis.FakeStrictRedis()
+        limiter = RedisRateLimiter("test_take_refill", rate=10, burst=2, redis_conn=redis_conn)
+
+        self.assertEqual([limiter.try_acquire(), limiter.try_acquire()], [0, 0])
+
+        wait_time = limiter.try_acquire()
+        self.assertGreater(wait_time, 0)
+        self.assertLessEqual(wait_time, 0.1)
+
+        time.sleep(wait_time + 0.01)
+        self.assertEqual(limiter.try_acquire(), 0)
+
+    @unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_prefetch(self):
+        redis_conn = fakeredis.FakeStrictRedis()
+        limiter = RedisRateLimiter("test_prefetch", rate=1, burst=4, prefetch=3, redis_conn=redis_conn)
+
+        self.assertEqual(limiter.try_acquire(), 0)
+        self.assertEqual(float(redis_conn.hget(limiter.key, "tokens")), 1)
+
+        # The prefetched permits are spent without a round trip
+        with mock.patch.object(limiter, "take_script", side_effect=AssertionError("redis called")):
+            self.assertEqual([limiter.try_acquire(), limiter.try_acquire()], [0, 0])
+
+    @unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_redis_error_fallback(self):
+        server = fakeredis.FakeServer()
+        server.connected = False
+        limiter = RedisRateLimiter("test_fallback", rate=1, burst=1, redis_conn=fakeredis.FakeStrictRedis(server=server))
+
+        with self.assertRaises(redis.RedisError):
+            limiter.redis_conn.ping()
+
+        # Limited by the local bucket of the same rate
+        self.assertEqual(limiter.try_acquire(), 0)
+        self.assertGreater(limiter.try_acquire(), 0)
+
+
+class PushRetryTestCase(SimpleTestCase):
+    """ Errcode of the platforms to the kind of error and the backoff of its retry """
+
+    def test_classify_errcode(self):
+        qy_weixin, ding_talk, feishu = AppPlatformEnum.QY_WEIXIN.type, AppPlatformEnum.DING_DING.type, \
+            AppPlatformEnum.FEISHU.type
+        cases = [
+            (qy_weixin, 0, None),
+            (qy_weixin, TRANSIENT_ERRCODE, PushErrorEnum.SYSTEM_BUSY),
+            (qy_weixin, -1, PushErrorEnum.SYSTEM_BUSY),
+            (qy_weixin, 42001, PushErrorEnum.TOKEN_EXPIRED),
+            (qy_weixin, 45009, PushErrorEnum.RATE_LIMITED),
+            (qy_weixin, 81013, PushErrorEnum.INVALID_USER),
+            (qy_weixin, 40001, PushErrorEnum.PERMANENT),
+            (ding_talk, 40014, PushErrorEnum.TOKEN_EXPIRED),
+            (ding_talk, 90018, PushErrorEnum.RATE_LIMITED),
+            (ding_talk, 33012, PushErrorEnum.INVALID_USER),
+            (feishu, 99991677, PushErrorEnum.TOKEN_EXPIRED),
+            (feishu, 230013, PushErrorEnum.INVALID_USER),
+            ("unknown", 42001, PushErrorEnum.PERMANENT),
+            ("unknown", TRANSIENT_ERRCODE, PushErrorEnum.SYSTEM_BUSY),
+        ]
+
+        for platform_type, errcode, error_kind in cases:
+            self.assertIs(classify_errcode(platform_type, errcode), error_kind, (platform_type, errcode))
+
+    def test_retryable(self):
+        retryable_kinds = [e for e in PushErrorEnum.iterator() if e.retryable]
+
+        self.assertEqual(
+            retryable_kinds, [PushErrorEnum.TOKEN_EXPIRED, PushErrorEnum.RATE_LIMITED, PushErrorEnum.SYSTEM_BUSY]
+        )
+        self.assertFalse(classify_errcode(AppPlatformEnum.QY_WEIXIN.type, 40003).retryable)
+        self.assertFalse(classify_errcode(AppPlatformEnum.QY_WEIXIN.type, 40001).retryable)
+
+    def test_get_backoff(self):
+        for error_kind, (base, cap) in BACKOFF_MAPPING.items():
+            for retries in range(10):
+                delay = min(cap, base * 2 ** retries)
+                countdown = get_backoff(retries, error_kind)
+
+                # Equal jitter: half fixed, half random
+                self.assertGreaterEqual(countdown, delay / 2.0)
+                self.assertLessEqual(countdown, delay)
+
+        with mock.patch("random.uniform", side_effect=lambda a, b: b):
+            self.assertEqual(get_backoff(0, PushErrorEnum.RATE_LIMITED), 2)
+            self.assertEqual(get_backoff(20, PushErrorEnum.RATE_LIMITED), 120)
+            # Unknown kind: backoff of SYSTEM_BUSY
+            self.assertEqual(get_backoff(1, None), 2)
+
+
+class BulkCreateObjectsTestCase(TestCase):
+    """ Primary keys looked up by an indexed key when the database doesn't return them(eg: MySQL) """
+
+    def setUp(self) -> None:
+        self.app_obj = AppTokenPlatformModel.objects.create(agent_id=1, platform_type="qy_weixin")
+        self.kwargs_list = [
+            dict(app_id=self.app_obj.id, msg_body_json='{"i": %s}' % i, fingerprint="fp%s" % i) for i in range(3)
+        ]
+
+    def bulk_create_without_pk(self, objs, **kwargs):
+        objs = self.bulk_create(objs, **kwargs)
+
+        for obj in objs:
+            obj.pk = None
+
+        return objs
+
+    def test_lookup_missing_pk(self):
+        manager = AppMessageModel.objects
+        self.bulk_create = manager.bulk_create
+
+        with mock.patch.object(manager, "bulk_create", self.bulk_create_without_pk):
+            objs = AppMessageModel.bulk_create_objects(self.kwargs_list, lookup_fields=("app_id", "fingerprint"))
+
+        saved_mapping = dict(AppMessageModel.objects.values_list("fingerprint", "id"))
+        self.assertEqual([obj.pk for obj in objs], [saved_mapping[obj.fingerprint] for obj in objs])
+
+        with mock.patch.object(manager, "bulk_create", self.bulk_create_without_pk):
+            with self.assertRaises(DatabaseError):
+                AppMessageModel.bulk_create_objects(self.kwargs_list)  # Never saved with app_msg_id=None
+
+
+class PushRecordDedupTestCase(TestCase):
+    """ Logs deduplicated over the bloom window even when the message fingerprint left the redis cache """
+
+    class SetBloom:
+        days = 30
+
+        def __init__(self):
+            self.items = set()
+
+        def contains_many(self, items):
+            return [item in self.items for item in items]
+
+        def add_many(self, items, when=None):
+            self.items.update(items)
+
+    def setUp(self) -> None:
+        self.app_obj = AppTokenPlatformModel.objects.create(
+            agent_id=1001, corp_id="corp", platform_type="qy_weixin", expire_time=datetime(2099, 1, 1)
+        )
+        self.app_obj.app_token = self.app_obj.encrypt_token()
+        self.app_obj.save()
+
+        bloom = self.SetBloom()
+        patchers = [
+            mock.patch("easypush.serializers.get_log_fingerprint_filter", return_value=bloom),
+            mock.patch.object(AppMsgPushRecordSerializer, "get_many_from_redis", return_value={}),  # Expired
+            mock.patch.object(AppMsgPushRecordSerializer, "get_cache_from_redis", return_value=None),
+            mock.patch.object(AppMsgPushRecordSerializer, "batch_insert_fingerprint"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def save(self, userid_list):
+        data_list = [
+            dict(app_token=self.app_obj.app_token, msg_type="text", msg_body_json={"content": "easypush"},
+                 receiver_userid=userid, receiver_mobile="")
+            for userid in userid_list
+        ]
+        many = len(data_list) > 1
+        serializer = AppMsgPushRecordSerializer(data=data_list if many else data_list[0], many=many)
+        serializer.is_valid(raise_exception=True)
+
+        instance = serializer.save()
+        return instance if isinstance(instance, list) else [instance]
+
+    def test_dedup_after_cache_expired(self):
+        self.assertEqual(len(self.save(["u1", "u2"])), 2)
+        self.assertEqual([log.receiver_userid for log in self.save(["u1", "u2", "u3"])], ["u3"])
+        self.assertEqual(self.save(["u1"]), [])
+
+        self.assertEqual(AppMessageModel.objects.count(), 1)
+        self.assertEqual(AppMsgPushRecordModel.objects.count(), 3)
+
+    def test_async_send_mq_duplicates(self):
+        data = dict(app_token=self.app_obj.app_token, msg_type="text", msg_body_json={"content": "easypush"},
+                    receiver_mobile="")
+
+        for receiver_userid, pushed_userid_list in [("u1,u2", ["u1", "u2"]), ("u1,u2", []), ("u1", []), ("u3", ["u3"])]:
+            task = FanOutTestCase.RecordTask()
+            AppMsgPushRecordSerializer.async_send_mq(dict(data, receiver_userid=receiver_userid), task)
+
+            msg_uid_list = [msg_uid for chunk, _ in task.calls for msg_uid in chunk]
+            pushed_logs = AppMsgPushRecordModel.objects.filter(msg_uid__in=msg_uid_list)
+            self.assertEqual(sorted(log.receiver_userid for log in pushed_logs), pushed_userid_list)
+
+
+class SendMessageGroupTestCase(SimpleTestCase):
+    """ Message groups sent by `send_message_by_mq` and `asend_message_by_mq` """
+
+    class SharedClient:
+        """ Keeps the message type of the send in progress like the platform clients """
+
+        def __init__(self):
+            self._msg_type = None
+            self.sent = []
+
+        def async_send(self, msgtype, body_kwargs, userid_list=()):
+            self._msg_type = msgtype
+            time.sleep(0.005)
+            self.sent.append((msgtype, self._msg_type))
+            return dict(errcode=0, errmsg="ok", task_id="1")
+
+    def test_two_msg_types_one_app(self):
+        from easypush.tasks import task_send_message
+
+        app = mock.Mock(app_token="shared_app_token", platform_type="qy_weixin")
+        msg_list = [
+            mock.Mock(app=app, msg_type=msg_type, msg_body_json=json.dumps({"content": msg_type}))
+            for msg_type in ["text", "markdown"] * 10
+        ]
+        push = self.SharedClient()
+
+        with mock.patch.object(task_send_message, "get_push_backend", return_value=push):
+            with ThreadPool(len(msg_list)) as pool:
+                results = pool.map(
+                    lambda msg_obj: task_send_message._send_message_group(msg_obj, [{"receiver_userid": "u1"}]),
+                    msg_list
+                )
+
+        self.assertEqual([ret["errcode"] for ret in results], [0] * len(msg_list))
+        self.assertEqual(len(push.sent), len(msg_list))
+        self.assertTrue(all(msgtype == sent_msgtype for msgtype, sent_msgtype in push.sent), push.sent)
+
+    def test_async_retry_priority(self):
+        from easypush.tasks import task_send_message
+
+        class RateLimitedClient:
+            async def asend(self, msgtype, body_kwargs, userid_list=()):
+                return dict(errcode=45009, errmsg="api freq out of limit")
+
+        app = mock.Mock(app_token="retry_app_token", platform_type=AppPlatformEnum.QY_WEIXIN.type)
+        msg_obj = mock.Mock(app=app, msg_type="text", msg_body_json=json.dumps({"content": "retry"}))
+        log_list = [{"msg_uid": "2702976118339", "receiver_userid": "u1"}]
+        routes = {"urgent": {"queue": "send_message_urgent_q", "routing_key": "send_message_urgent_rk"}}
+
+        with mock.patch.dict(config.attrs, {"mq_priority_routes": routes}), \
+                mock.patch.object(task_send_message, "_get_message_groups", return_value=[(msg_obj, log_list)]), \
+                mock.patch.object(task_send_message, "get_push_backend", return_value=RateLimitedClient()), \
+                mock.patch.object(task_send_message.PushResultWriter, "flush"), \
+                mock.patch.object(task_send_message.send_message_by_mq, "apply_async") as apply_async:
+            asyncio.run(task_send_message.asend_message_by_mq(msg_uid_list=["2702976118339"], priority="urgent"))
+
+        kwargs = apply_async.call_args.kwargs
+        self.assertEqual(kwargs["kwargs"], dict(msg_uid_list=["2702976118339"], retries=1, priority="urgent"))
+        self.assertEqual(kwargs["queue"], "send_message_urgent_q")
+
 
 class DingTalkTestCase(TestCase):
     def setUp(self) -> None:
@@ -181,3 +181,46 @@ class FeishuTokenTypeEnum(EnumBase):
                 return e
 
 
+class PushErrorEnum(EnumBase):
+    """ Kinds of the platform errcode, see `easypush.core.mq.retry.classify_errcode` """
+    TOKEN_EXPIRED = ("token_expired", "access_token 过期或无效", True)
+    RATE_LIMITED = ("rate_limited", "接口调用超过频率限制", True)
+    SYSTEM_BUSY = ("system_busy", "系统繁忙或网络异常", True)
+    INVALID_USER = ("invalid_user", "接收人无效", False)
+    PERMANENT = ("permanent", "参数或权限等错误", False)
+
+    @property
+    def type(self):
+        return self.value[0]
+
+    @property
+    def desc(self):
+        return self.value[1]
+
+    @property
+    def retryable(self):
+        return self.value[2]
+
+
+class MessagePriorityEnum(EnumBase):
+    """ Lanes of `send_message_by_mq`, each routed to its own queue, see EASYPUSH["mq_priority_routes"] """
+    URGENT = ("urgent", "紧急: 一对一提醒, 告警")
+    NORMAL = ("normal", "普通")
+    BULK = ("bulk", "群发: 营销广播等大批量消息")
+
+    @property
+    def type(self):
+        return self.value[0]
+
+    @property
+    def desc(self):
+        return self.value[1]
+
+    @classmethod
+    def get_priority_enum(cls, priority):
+        enum_list = [each_enum for each_enum in cls.iterator() if each_enum.type == priority]
+
+        if not enum_list:
+            raise ValueError("Message priority<%s> is not exist" % priority)
+
+        return enum_list[0]
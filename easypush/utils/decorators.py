@@ -1,10 +1,132 @@
+import time
+import threading
 from functools import wraps
-from datetime import datetime
+from collections import OrderedDict
 
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 
-token_cache = {}
+
+class TokenCache:
+    """ Thread-safe in-process token cache: O(1) lookups, TTL with refresh-ahead and LRU eviction
+
+    An entry is served until `refresh_ahead` seconds before it really expires, so the token is
+    fetched again while the old one is still valid on the platform side.
+    """
+    DEFAULT_TIMEOUT = 2 * 60 * 60
+    DEFAULT_REFRESH_AHEAD = 10 * 60
+    KEY_LOCK_STRIPES = 64
+
+    def __init__(self, maxsize=128, refresh_ahead=None):
+        self.maxsize = maxsize
+        self.refresh_ahead = self.DEFAULT_REFRESH_AHEAD if refresh_ahead is None else refresh_ahead
+
+        self._data = OrderedDict()  # key => (value, refresh_at, expire_at)
+        self._lock = threading.Lock()
+        self._key_locks = [threading.RLock() for _ in range(self.KEY_LOCK_STRIPES)]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, stale=False):
+        """ :param stale: bool, also return a token inside the refresh-ahead window (not yet expired) """
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                return None
+
+            value, refresh_at, expire_at = entry
+            now = time.monotonic()
+
+            if now >= expire_at:
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value if stale or now < refresh_at else None
+
+    def ttl(self, key):
+        """ Seconds before the token of `key` must be refreshed, None if missing """
+        with self._lock:
+            entry = self._data.get(key)
+
+        return None if entry is None else entry[1] - time.monotonic()
+
+    def set(self, key, value, timeout=None):
+        timeout = timeout or self.DEFAULT_TIMEOUT
+        now = time.monotonic()
+        refresh_ahead = min(self.refresh_ahead, timeout / 10)
+
+        with self._lock:
+            self._data[key] = (value, now + timeout - refresh_ahead, now + timeout)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_key_lock(self, key):
+        """ Lock of the key, concurrent misses of one app only fetch the token once
+            Fixed stripes: never grows with the keys, keys of one stripe just fetch one after another.
+        """
+        return self._key_locks[hash(key) % len(self._key_locks)]
+
+    def get_or_set(self, key, func, timeout=None):
+        value = self.get(key)
+
+        if value is not None:
+            return value
+
+        with self.get_key_lock(key):
+            value = self.get(key)   # Double check, another thread may have refreshed it
+
+            if value is None:
+                value = func()
+
+                if is_cacheable_token(value):
+                    self.set(key, value, timeout=get_token_timeout(value, timeout))
+
+        return value
+
+
+def is_cacheable_token(token):
+    """ Error responses (no `access_token`) must not be cached """
+    return not isinstance(token, dict) or bool(token.get("access_token"))
+
+
+def get_token_timeout(token, default=None):
+    """ Trust the platform `expires_in`(qy_weixin, ding_talk) or `expire`(feishu) when shorter """
+    timeout = default or TokenCache.DEFAULT_TIMEOUT
+
+    if isinstance(token, dict):
+        expires_in = token.get("expires_in") or token.get("expire")
+
+        if isinstance(expires_in, int) and 0 < expires_in < timeout:
+            timeout = expires_in
+
+    return timeout
+
+
+def get_token_cache_key(name, client):
+    """ One token slot per application: (platform, corp_id, agent_id, app_key) """
+    return (
+        name, getattr(client, "_corp_id", None),
+        getattr(client, "_agent_id", None), getattr(client, "_app_key", None),
+    )
+
+
+token_cache = TokenCache()
 
 
 def exempt_view_csrf(view_cls):
@@ -15,37 +137,16 @@ def exempt_view_csrf(view_cls):
 
 
 def token_expire_cache(name, timeout=None, maxsize=128):
-    global token_cache
-    default_expire = 2 * 60 * 60
+    """ Cache the token returned by the decorated `get_access_token(self)` per application """
+    if maxsize > token_cache.maxsize:
+        token_cache.maxsize = maxsize
 
     def wrapper(func):
         @wraps(func)
-        def inner(*args, **kwargs):
-            timestamp = datetime.now().timestamp()
-
-            # Clear expired tokens
-            for key in token_cache.keys():
-                token = token_cache[key]
-                expire = token.get("timeout", default_expire)
-                token_timestamp = token.get("timestamp", 0)
-
-                if timestamp - token_timestamp > expire:
-                    del token_cache[key]
-
-            token = token_cache.get(name, {})
-
-            if token:
-                return token["ret"]
-            else:
-                if len(token_cache) > maxsize:
-                    raise ValueError("Exceed maximum capacity:%s" % maxsize)
-
-                token_ret = func(*args, **kwargs)
-                token.update(timeout=timeout or default_expire, timestamp=timestamp, ret=token_ret)
-                token_cache[name] = token
-
-                return token_ret
+        def inner(self, *args, **kwargs):
+            key = get_token_cache_key(name, self)
+            return token_cache.get_or_set(key, lambda: func(self, *args, **kwargs), timeout=timeout)
 
+        inner.get_cache_key = lambda client: get_token_cache_key(name, client)
         return inner
     return wrapper
-
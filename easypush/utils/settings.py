@@ -6,6 +6,53 @@ from django.conf import settings
 DEFAULTS = {
     "log_path": "",
 
+    # Redis nodes(CACHES alias or url) of the distributed locks, eg: access token refresh.
+    # More than one node: quorum(Redlock) mode, keeps working when a minority of nodes is slow or down.
+    "lock_nodes": [],
+
+    # Commands per redis pipeline when writing message fingerprints
+    "fingerprint_chunk_size": 1000,
+
+    # Time-bucketed bloom filter deduplicating pushed logs(message and receiver) over the last `days`
+    "fingerprint_bloom": {
+        "capacity": 1000000,    # Expected logs per bucket
+        "error_rate": 0.001,    # False positive rate, positives are confirmed in the database
+        "days": 30,
+        "bucket_days": 1,
+    },
+
+    # Receivers per MQ message by platform, the recipient limit of one api call:
+    # qy_weixin `touser` <= 1000, ding_talk `userid_list` <= 100. Other platforms: 100
+    "mq_chunk_size": {
+        "qy_weixin": 1000,
+        "ding_talk": 100,
+    },
+
+    # Threads sending the (app, message body) groups of one `send_message_by_mq` task, 1: one by one
+    "dispatch_max_workers": 8,
+
+    # Per process caps of the api calls by platform: concurrent calls and calls per second
+    "dispatch_limits": {
+        "qy_weixin": {"concurrency": 4, "rate": 20},
+        "ding_talk": {"concurrency": 4, "rate": 20},
+        "default": {"concurrency": 2, "rate": 10},
+    },
+
+    # Shared(all the workers) token bucket by platform, the RATE_LIMIT of an app configured by no alias
+    # eg: {"qy_weixin": {"rate": 20, "burst": 20, "prefetch": 5, "per": "agent"}}, see `get_rate_limiter`
+    "rate_limits": {},
+
+    # Share of the task hook payloads(args, kwargs, retval) logged when celery.worker is above DEBUG
+    "task_trace_sample_rate": 0.01,
+
+    # Queue of the `send_message_by_mq` tasks by message priority(see `MessagePriorityEnum`), each lane
+    # consumed by its own workers. A priority missing here is routed by CELERY_ROUTES, eg:
+    # {"urgent": {"queue": "send_message_urgent_q", "routing_key": "send_message_urgent_rk"}, "bulk": {...}}
+    "mq_priority_routes": {},
+
+    # Receivers above which a message sent without priority goes to the `bulk` lane
+    "mq_bulk_threshold": 1000,
+
     "default": {
         # dingtalk
         "BACKEND": "easypush.backends.ding_talk.DingTalkClient",
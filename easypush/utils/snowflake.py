@@ -41,34 +41,62 @@ class IdGenerator(object):
         :param did_wid: 数据中心和机器id合成10位二进制，用十进制0-1023表示，通过算法会拆分成 data_center_id 和 worker_id
         :param sequence: 起始序号
         """
-        if did_wid > 0:
-            data_center_id = did_wid >> 5
-            worker_id = did_wid ^ (data_center_id << 5)
+        if did_wid is not None and did_wid >= 0:
+            data_center_id = did_wid >> self.WORKER_ID_BITS
+            worker_id = did_wid ^ (data_center_id << self.WORKER_ID_BITS)
 
-        # sanity check
-        if worker_id and (worker_id > self.MAX_WORKER_ID or worker_id < 0):
+        # sanity check, 0 is a valid id
+        if worker_id is not None and (worker_id > self.MAX_WORKER_ID or worker_id < 0):
             raise ValueError('worker_id值越界')
 
-        if data_center_id and (data_center_id > self.MAX_DATA_CENTER_ID or data_center_id < 0):
+        if data_center_id is not None and (data_center_id > self.MAX_DATA_CENTER_ID or data_center_id < 0):
             raise ValueError('datacenter_id值越界')
 
-        self.data_center_id = data_center_id or random.randint(0, self.MAX_DATA_CENTER_ID)
-        self.worker_id = worker_id or random.randint(0, self.MAX_WORKER_ID)
+        if data_center_id is None:
+            data_center_id = random.randint(0, self.MAX_DATA_CENTER_ID)
+
+        if worker_id is None:
+            worker_id = random.randint(0, self.MAX_WORKER_ID)
+
+        self.data_center_id = data_center_id
+        self.worker_id = worker_id
 
         self.sequence = sequence
         self.last_timestamp = self._gen_timestamp()  # 上次计算的时间戳
 
+    _class_lock = threading.Lock()
+
     def __new__(cls, *args, **kwargs):
-        """ 单例模式, 每次实例化时，实例的属性相同(注意) """
-        if not hasattr(cls, "_instance"):
-            # cls._instance = object.__new__(cls, *args, **kwargs)
-            cls._instance = super(IdGenerator, cls).__new__(cls)
+        """ 单例模式(每个进程一个), 每次实例化时，实例的属性相同(注意)
+            fork 出的子进程会继承父进程的实例(相同的 worker_id 及序号)，因此按 pid 重新实例化
+        """
+        if getattr(cls, "_instance_pid", None) != os.getpid():
+            with cls._class_lock:
+                if getattr(cls, "_instance_pid", None) != os.getpid():
+                    cls._set_instance(*args, **kwargs)
+
+        return cls._instance
+
+    @classmethod
+    def _set_instance(cls, *args, **kwargs):
+        """ Must hold `cls._class_lock`, the pid is set last: no thread sees a half built instance """
+        # cls._instance = object.__new__(cls, *args, **kwargs)
+        instance = super(IdGenerator, cls).__new__(cls)
+
+        # Important:
+        # (1): lock 锁可以此处定义，也可以在 __init_instance 中定义
+        # (2): 若不在此处实例化属性，即使是同一个实例也会每次均会实例化，造成属性相同，雪花算法有重复
+        instance.lock = threading.Lock()
+        instance.__init_instance(*args, **kwargs)
+
+        cls._instance = instance
+        cls._instance_pid = os.getpid()
 
-            # Important:
-            # (1): lock 锁可以此处定义，也可以在 __init_instance 中定义
-            # (2): 若不在此处实例化属性，即使是同一个实例也会每次均会实例化，造成属性相同，雪花算法有重复
-            cls._instance.lock = threading.Lock()
-            cls._instance.__init_instance(*args, **kwargs)
+    @classmethod
+    def reset_instance(cls, *args, **kwargs):
+        """ Replace the instance of the current process at once, eg: with a leased `did_wid` """
+        with cls._class_lock:
+            cls._set_instance(*args, **kwargs)
 
         return cls._instance
 
@@ -117,6 +145,42 @@ class IdGenerator(object):
 
             return uid
 
+    def get_ids(self, n):
+        """ 批量获取 n 个雪花算法 ID，一次加锁预留连续的序号，当前毫秒序号用完则顺延至下一毫秒
+        :param n: int, ID 个数
+        :return: list
+        """
+        uid_list = []
+        remaining = n
+
+        with self.lock:
+            timestamp = self._gen_timestamp()
+
+            if timestamp < self.last_timestamp:
+                logging.error('clock is moving backwards. Rejecting requests until {}'.format(self.last_timestamp))
+                raise InvalidSystemClock
+
+            sequence = self.sequence + 1 if timestamp == self.last_timestamp else 0
+            worker_bits = (self.data_center_id << self.DATA_CENTER_ID_SHIFT) | (self.worker_id << self.WORKER_ID_SHIFT)
+
+            while remaining > 0:
+                if sequence > self.SEQUENCE_MASK:
+                    timestamp = self._til_next_millis(timestamp)
+                    sequence = 0
+
+                count = min(remaining, self.SEQUENCE_MASK + 1 - sequence)
+                prefix = ((timestamp - self.TW_EPOCH) << self.TIMESTAMP_LEFT_SHIFT) | worker_bits
+
+                uid_list.extend(range(prefix + sequence, prefix + sequence + count))
+                sequence += count
+                remaining -= count
+
+            if n > 0:
+                self.sequence = sequence - 1
+                self.last_timestamp = timestamp
+
+        return uid_list
+
 
 def test_by_ThreadPool():
     """ from multiprocessing.dummy import Pool as ThreadPool
@@ -150,6 +214,37 @@ def test_by_ThreadPool():
     print(msg % args)
 
 
+def test_get_ids_by_ThreadPool():
+    """ 对比 get_id 与 get_ids, 模拟 2000 人的群发(每次请求分配 2000 个 ID)
+    本机测试结果如下:
+        get_id:  500 批 x 2000, 耗时: 2.3187s, QPS: 43.1282w
+        get_ids: 500 批 x 2000, 耗时: 0.3050s, QPS: 327.8936w
+        实际不重复总数: 1000000, 是否重复：True
+    """
+    batch_cnt, batch_size = 500, 2000
+    id_yield = IdGenerator(1, 2)
+
+    def get_id_batch(_):
+        return [id_yield.get_id() for _ in range(batch_size)]
+
+    def get_ids_batch(_):
+        return id_yield.get_ids(batch_size)
+
+    for name, func in [("get_id", get_id_batch), ("get_ids", get_ids_batch)]:
+        start_time = time.time()
+
+        pool = ThreadPool()
+        ret = [uid for batch in pool.map(func, range(batch_cnt)) for uid in batch]
+        pool.close()
+        pool.join()
+
+        cost_time = time.time() - start_time
+        args = (name, batch_cnt, batch_size, cost_time, len(ret) / cost_time / 10000.0)
+        print("%s: %s 批 x %s, 耗时: %.4fs, QPS: %.4fw" % args)
+
+    print("实际不重复总数: %s, 是否重复：%s" % (len(set(ret)), len(set(ret)) == len(ret)))
+
+
 def test_by_ThreadPoolExecutor():
     """ 使用 concurrent.futures
     本机一百万测试结果如下:
@@ -0,0 +1,209 @@
+import os
+import errno
+import random
+import socket
+import logging
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+from .snowflake import IdGenerator
+
+logger = logging.getLogger("django")
+
+MAX_WORKER_ID = (IdGenerator.MAX_DATA_CENTER_ID + 1) * (IdGenerator.MAX_WORKER_ID + 1)  # 1024 (did_wid)
+
+
+class WorkerIdExhaustedError(Exception):
+    """ All the 1024 (datacenter, worker) pairs are leased """
+
+
+class RedisWorkerIdLease:
+    """ Lease a unique `did_wid` (0-1023, datacenter and worker id of the snowflake) from redis
+
+        A slot is taken with `SET NX EX` and kept alive by a heartbeat thread, so the slot of a crashed
+        process is given back after `ttl` seconds.
+    """
+    KEY_PREFIX = "easypush:snowflake:did_wid:"
+
+    RENEW_SCRIPT = """
+        if redis.call("get",KEYS[1]) == ARGV[1] then
+            return redis.call("expire",KEYS[1],ARGV[2])
+        else
+            return 0
+        end
+    """
+    RELEASE_SCRIPT = """
+        if redis.call("get",KEYS[1]) == ARGV[1] then
+            return redis.call("del",KEYS[1])
+        else
+            return 0
+        end
+    """
+
+    def __init__(self, redis_conn=None, ttl=60, on_lost=None):
+        """
+        :param redis_conn: redis client, default `get_redis_connection()`
+        :param ttl: int, lease expire time(seconds), renewed every ttl / 3
+        :param on_lost: callable, `on_lost(new_worker_id)` the lease expired and a new slot was taken
+        """
+        if redis_conn is None:
+            from django_redis import get_redis_connection
+            redis_conn = get_redis_connection()
+
+        self.redis_conn = redis_conn
+        self.ttl = ttl
+        self.on_lost = on_lost
+
+        self.worker_id = None
+        self.owner = "%s:%s:%s" % (socket.gethostname(), os.getpid(), random.getrandbits(32))
+        self._stopped = threading.Event()
+
+    def _claim(self, worker_id):
+        return self.redis_conn.set(self.KEY_PREFIX + str(worker_id), self.owner, ex=self.ttl, nx=True)
+
+    def acquire(self):
+        # Start from a random slot, processes booting together do not fight for the same ones
+        offset = random.randrange(MAX_WORKER_ID)
+
+        for index in range(MAX_WORKER_ID):
+            worker_id = (offset + index) % MAX_WORKER_ID
+
+            if self._claim(worker_id):
+                self.worker_id = worker_id
+                self._stopped = threading.Event()
+                self._start_heartbeat()
+
+                logger.info("[%s] => Leased did_wid: %s", self.__class__.__name__, worker_id)
+                return worker_id
+
+        raise WorkerIdExhaustedError("No free snowflake worker id in redis")
+
+    def _start_heartbeat(self):
+        t = threading.Thread(target=self._heartbeat, name="easypush-worker-id-heartbeat")
+        t.daemon = True
+        t.start()
+
+    def _heartbeat(self):
+        stopped = self._stopped
+        renew = self.redis_conn.register_script(self.RENEW_SCRIPT)
+
+        while not stopped.wait(self.ttl / 3.0):
+            try:
+                if renew(keys=[self.KEY_PREFIX + str(self.worker_id)], args=[self.owner, self.ttl]):
+                    continue
+
+                # Expired(eg: long GC pause, redis failover) and maybe taken by another process
+                if not self._claim(self.worker_id):
+                    worker_id = self.acquire()  # Starts the heartbeat of the new slot
+
+                    if callable(self.on_lost):
+                        self.on_lost(worker_id)
+                    return
+            except Exception as e:
+                logger.error("[%s] => Renew did_wid<%s> error: %s", self.__class__.__name__, self.worker_id, e)
+
+    def release(self):
+        self._stopped.set()
+
+        if self.worker_id is not None:
+            self.redis_conn.register_script(self.RELEASE_SCRIPT)(
+                keys=[self.KEY_PREFIX + str(self.worker_id)], args=[self.owner]
+            )
+
+
+class FileWorkerIdLease:
+    """ Lease a unique `did_wid` among the processes of one host by `flock` on a file per slot
+
+        The OS releases the lock when the process exits, no heartbeat is needed. Only unique per host,
+        give each host its own `offset` range when several hosts share the database.
+    """
+
+    def __init__(self, lock_dir=None, offset=0, size=MAX_WORKER_ID):
+        if fcntl is None:
+            raise RuntimeError("FileWorkerIdLease requires fcntl (not available on Windows)")
+
+        self.lock_dir = lock_dir or os.path.join(tempfile.gettempdir(), "easypush-snowflake")
+        self.offset = offset
+        self.size = size
+
+        self.worker_id = None
+        self._fp = None
+
+    def acquire(self):
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+        for worker_id in range(self.offset, min(self.offset + self.size, MAX_WORKER_ID)):
+            fp = open(os.path.join(self.lock_dir, "did_wid_%s.lock" % worker_id), "a")
+
+            try:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                fp.close()
+
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise
+
+            self._fp = fp
+            self.worker_id = worker_id
+
+            logger.info("[%s] => Leased did_wid: %s", self.__class__.__name__, worker_id)
+            return worker_id
+
+        raise WorkerIdExhaustedError("No free snowflake worker id in %s" % self.lock_dir)
+
+    def release(self):
+        if self._fp is not None:
+            self._fp.close()  # Also releases the flock
+            self._fp = None
+
+
+_lease = None
+_lease_pid = None
+_lease_lock = threading.Lock()
+
+
+def get_worker_lease():
+    """ Redis lease, file lease when redis is unavailable """
+    try:
+        lease = RedisWorkerIdLease(on_lost=_on_lease_lost)
+        lease.acquire()
+        return lease
+    except WorkerIdExhaustedError:
+        raise
+    except Exception as e:
+        logger.warning("get_worker_lease => Redis unavailable(%s), fall back to file lease", e)
+
+    lease = FileWorkerIdLease()
+    lease.acquire()
+    return lease
+
+
+def _on_lease_lost(worker_id):
+    generator = IdGenerator()
+
+    with generator.lock:
+        generator.data_center_id = worker_id >> IdGenerator.WORKER_ID_BITS
+        generator.worker_id = worker_id ^ (generator.data_center_id << IdGenerator.WORKER_ID_BITS)
+
+
+def get_id_generator():
+    """ IdGenerator of the current process with a leased unique (datacenter, worker) id """
+    global _lease, _lease_pid
+
+    if _lease_pid != os.getpid():
+        with _lease_lock:
+            if _lease_pid != os.getpid():
+                # A forked child must not reuse the parent's lease(and its heartbeat thread is gone)
+                _lease = get_worker_lease()
+
+                # Rebuild the singleton with the leased id, swapped at once under the class lock
+                IdGenerator.reset_instance(did_wid=_lease.worker_id)
+                _lease_pid = os.getpid()
+
+    return IdGenerator()
@@ -125,6 +125,8 @@ class SendAppMessageRecordApi(GenericAPIView):
             receiver_mobile: string, receiver's mobile to send, eg: '13600000000,13500000001'
             receiver_userid: string, must be present, receiver's userid to send eg:'1602133682287,1635343667135'
             is_async: bool, default is true, if is_async is true, use mq to send message
+            priority: string, `urgent`, `normal` or `bulk`, the mq queue(lane) of the message,
+                      default is `bulk` above EASYPUSH["mq_bulk_threshold"] receivers else `normal`
             using: string, default is `default` Which backend push to send
         """
         self.serializer_class.async_send_mq(data=request.data, task_fun=send_message_by_mq)
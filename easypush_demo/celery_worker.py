@@ -17,12 +17,27 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "easypush_demo.settings")
 django.setup()
 
 from easypush_demo.celery_app import app
-from easypush.utils.snowflake import IdGenerator
+from easypush.utils.worker_id import get_id_generator
 from easypush.tasks.task_concurrency_conn import concurrency_orm_conn
 
 
+# One worker per priority lane: urgent keeps prefetch 1 so an alert never waits behind prefetched messages,
+# bulk prefetches more to keep the platform apis busy.
+LANE_WORKER_ARGV = {
+    "urgent": ["-Q", "send_message_urgent_q", "-P", "threads", "-c", "10", "--prefetch-multiplier", "1"],
+    "normal": ["-Q", "send_message_by_mq_q", "-P", "threads", "-c", "20", "--prefetch-multiplier", "4"],
+    "bulk": ["-Q", "send_message_bulk_q", "-P", "threads", "-c", "30", "--prefetch-multiplier", "10"],
+}
+
+
+def start_lane_worker(priority):
+    """ eg: start_lane_worker("urgent") """
+    argv = ["-A", "easypush_demo.celery_app", "worker", "-l", "info", "-n", "%s@%%h" % priority]
+    app.start(argv=argv + LANE_WORKER_ARGV[priority])
+
+
 def send_message_to_mq(max_size=5000):
-    sf = IdGenerator(1, 1)
+    sf = get_id_generator()
 
     for i in range(max_size):
         concurrency_orm_conn.delay(msg_uid=str(sf.get_id()))
@@ -42,5 +57,9 @@ if __name__ == "__main__":
     app.start(argv=["-A", "easypush_demo.celery_app", "worker", '-P', 'threads', "-l", "info", "-c", "30"])
     pass
 
+    # Workers of the priority lanes, one process each
+    # start_lane_worker("urgent")
+    # start_lane_worker("bulk")
+
     # Only send message to mq
     # send_message_to_mq()
@@ -77,6 +77,19 @@ class CeleryQueueRouterConfig(object):
             routing_key="send_message_by_mq_rk",
         ),
 
+        # 消息优先级通道(EASYPUSH["mq_priority_routes"]): 紧急的一对一提醒与群发消息分开消费
+        Queue(
+            name="send_message_urgent_q",
+            exchange=Exchange("send_message_by_mq_exc"),
+            routing_key="send_message_urgent_rk",
+        ),
+
+        Queue(
+            name="send_message_bulk_q",
+            exchange=Exchange("send_message_by_mq_exc"),
+            routing_key="send_message_bulk_rk",
+        ),
+
         Queue(
             name="concurrency_orm_conn_q",
             exchange=Exchange("concurrency_orm_conn_exc"),
@@ -179,6 +179,12 @@ EASYPUSH = {
         "APP_KEY": os.getenv("FEISHU:APP_KEY"),
         "APP_SECRET": os.getenv("FEISHU:APP_SECRET"),
     },
+
+    # normal: CELERY_ROUTES(send_message_by_mq_q)
+    "mq_priority_routes": {
+        "urgent": {"queue": "send_message_urgent_q", "routing_key": "send_message_urgent_rk"},
+        "bulk": {"queue": "send_message_bulk_q", "routing_key": "send_message_bulk_rk"},
+    },
 }
 
 EASYPUSH_CELERY_APP = "easypush_demo.celery_app:celery_app"
@@ -55,5 +55,9 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     install_requires=load_requirements("base.txt"),  # 所依赖的包
+    extras_require={
+        "async": load_requirements("async.txt"),   # pip install easypush[async]
+        "test": load_requirements("test.txt"),
+    },
     python_requires=">=3.8",
 )